@@ -1,36 +1,70 @@
-import subprocess
+import asyncio
 import pandas as pd
 import os
 import json
-import multiprocessing as mp
-from subprocess import PIPE
+import signal
+import socket
+import sys
+from asyncio.subprocess import PIPE
+from .forkserver import ForkServer
+from .rworker import RWorker, get_r_packages
 from .lang import Lang
+from .util import print_warn
 from .wrangler import *
+from .manifest import Manifest, FILE_MANIFEST
+from .pack import PackReader, FILE_PACK
+from .universeindex import UniverseIndex, FILE_UNIVERSES
 
 
 class BobaRun:
-    def __init__(self, folder, jobs=1, batch_size=0):
+    def __init__(self, folder, jobs=1, preload=None, tree=False, cache=None,
+                 cache_size=1024):
         # attributes
         self.folder = folder
         self.dir_log = os.path.join(folder, DIR_LOG)
         self.file_log = os.path.join(self.dir_log, 'logs.csv')
-        self.pool = None
+        self.running = False
+        self.stopped = False
+        self.loop = None    # the event loop, while the universes are running
+        self.tasks = []
         self.exit_code = []
 
-        # read summary
-        data = pd.read_csv(self.folder + '/summary.csv')
-        self.size = data.shape[0]
-
-        # multiprocessing attributes
+        # read the universe index, or the summary of an older multiverse
+        if os.path.exists(os.path.join(folder, FILE_UNIVERSES)):
+            index = UniverseIndex.read(folder)
+            self.size = index.size
+            # the ids are sparse if we compiled a sample of the multiverse
+            self.ids = index.get_ids()
+            # identical universes share a script, see boba compile --dedup
+            self.scripts = {u: get_universe_script(index.get_script(u),
+                                                   index.ext)
+                            for u in self.ids}
+            index.close()
+        else:
+            data = pd.read_csv(self.folder + '/summary.csv')
+            self.size = data.shape[0]
+            self.ids = list(range(1, self.size + 1))
+            self.scripts = dict(zip(self.ids, data['Filename'].to_list()))
+
+        # the number of universes running at a time
         if jobs == 0:
-            jobs = mp.cpu_count()
-        if batch_size == 0:
-            batch_size = min(int(self.size**0.5), int(self.size / jobs) + 1)
+            jobs = os.cpu_count()
         self.jobs = jobs
-        self.batch_size = batch_size
+
+        # run the universes in warm processes if preload is not None. It is a
+        # list of python modules to import, or scripts to run, or a list of R
+        # packages to load, once
+        self.preload = preload
+
+        # run python universes as a tree of processes, see forktree.py. The
+        # tree saves checkpoints to the cache folder, if any, and keeps the
+        # cache under the size in MB
+        self.tree = tree or cache is not None
+        self.cache = os.path.abspath(cache) if cache is not None else None
+        self.cache_size = cache_size
 
         # language
-        fn = data['Filename'].to_list()[0]
+        fn = self.scripts[self.ids[0]]
         try:
             with open(self.folder + '/lang.json', 'r') as f:
                 self.lang = Lang(fn, supported_langs=json.load(f))
@@ -51,12 +85,18 @@ class BobaRun:
         if self.is_running():
             return
 
-        # initialize process pool
-        self.pool = mp.Pool(self.jobs)
+        self.running = True
+        self.stopped = False
+        try:
+            self._run_multiverse(universes, resume)
+        finally:
+            self.running = False
+
 
+    def _run_multiverse(self, universes, resume):
         # by default, run all universes
         if not len(universes):
-            universes = list(range(1, self.size + 1))
+            universes = list(self.ids)
 
         if not resume:
             # before execute
@@ -71,33 +111,181 @@ class BobaRun:
             with open(self.file_log, 'w') as log:
                 log.write('uid,exit_code\n')
 
-        # callback that is run for each retrieved result.
-        # FIXME: if stopped, the last batch will not invoke the callback
-        def check_result(r):
-            self.exit_code += [[res[0], res[1]] for res in r]
-            # write the results to our logs
-            with open(self.file_log, 'a') as f_log:
-                for res in r:
-                    f_log.write(f'{res[0]},{res[1]}\n')
-
-        # run each batch of universes as a separate task
-        while len(universes):
-            batch = []
-            while len(universes) and len(batch) < self.batch_size:
-                u = get_universe_script(universes.pop(0), self.lang.get_ext())
-                batch.append(u)
-
-            self.pool.apply_async(run_batch_of_universes,
-                args=(self.folder, batch, self.lang.supported_langs),
-                callback=check_result)
-
-        # collect all the results
-        self.pool.close()
-        self.pool.join()
+        # run each distinct script once, and fan the result back out to all
+        # universes that share the script
+        fanout = {}
+        for u in universes:
+            uid = get_universe_id_from_script(self.scripts[u])
+            fanout.setdefault(uid, []).append(u)
+        asyncio.run(self._run_scripts(list(fanout.keys()), fanout))
 
         # after execute
         self.run_commands_in_folder('post_exe.sh')
-        self.pool = None
+
+
+    async def _run_scripts(self, scripts, fanout):
+        """
+        Run the scripts from one event loop, with self.jobs workers that each
+        wait on one universe at a time, and log the exit code of each universe
+        as soon as it is done.
+        """
+        self.loop = asyncio.get_running_loop()
+        source = open_script_source(self.folder)
+        todo = iter(scripts)
+        f_log = open(self.file_log, 'a')
+        n = max(1, min(self.jobs, len(scripts)))
+        servers = [] if self._use_tree() else \
+            await self._start_servers(n, source)
+
+        def record(uid, rc):
+            res = [[u, rc] for u in fanout[uid]]
+            self.exit_code += res
+            for u, rc in res:
+                f_log.write(f'{u},{rc}\n')
+            f_log.flush()
+
+        async def worker(server):
+            # the workers share the iterator, so each script runs once
+            for uid in todo:
+                if self.stopped:
+                    return
+                script = get_universe_script(uid, self.lang.get_ext())
+                try:
+                    _, rc = await run_universe_async(self.folder, script,
+                        self.lang.supported_langs, source, server)
+                except (OSError, ValueError, RuntimeError) as e:
+                    # log the universe as failed, like one that crashed
+                    print_warn('Cannot run {}: {}'.format(script, e))
+                    rc = -1
+                record(uid, rc)
+
+        try:
+            if self._use_tree():
+                self.tasks = [asyncio.ensure_future(
+                    self._run_tree(scripts, record))]
+            else:
+                self.tasks = [asyncio.ensure_future(worker(s))
+                              for s in servers]
+            # a stopped worker raises CancelledError, which we ignore
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            self.loop = None
+            self.tasks = []
+            f_log.close()
+            for s in dict.fromkeys(servers):
+                if s is not None:
+                    await s.stop()
+            if isinstance(source, PackReader):
+                source.close()
+
+
+    def _use_tree(self):
+        """ Whether we run the universes as a tree of processes. """
+        if not self.tree:
+            return False
+        if not hasattr(os, 'fork'):
+            print_warn('The process tree is not available on this platform')
+        elif not self.lang.is_python() or len(self.lang.get_cmd()) != 1:
+            print_warn('The process tree only runs python universes')
+        else:
+            return True
+        self.tree = False
+        return False
+
+
+    async def _run_tree(self, scripts, record):
+        """ Run the scripts as a tree of processes, and print the output of
+        each universe once it is done. """
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = ('import sys; sys.path.insert(0, {!r}); '
+                'from boba.forktree import main; del sys.path[0]; '
+                'main()').format(root)
+        files = [get_universe_script(uid, self.lang.get_ext())
+                 for uid in scripts]
+        args = [self.folder, str(self.jobs)]
+        if self.cache is not None:
+            args += [self.cache, str(int(self.cache_size * (1 << 20)))]
+
+        # the tree is in its own process group, so we can kill all of it
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', code, *args, stdin=PIPE, stdout=PIPE,
+            start_new_session=True)
+        done = set()
+        try:
+            proc.stdin.write(json.dumps(files).encode('utf-8'))
+            proc.stdin.close()
+            async for line in proc.stdout:
+                uid, rc = [int(x) for x in line.split()]
+                done.add(uid)
+                _print_logs(self.folder, uid)
+                record(uid, rc)
+            await proc.wait()
+        finally:
+            if proc.returncode is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await proc.wait()
+
+        # universes in a process that crashed
+        for uid in scripts:
+            if uid not in done:
+                print_warn('Universe {} did not finish'.format(uid))
+                record(uid, -1)
+
+
+    async def _start_servers(self, n, source):
+        """
+        Start the warm processes that run the universes, if we use them.
+        Python universes share one fork server, and each worker of R
+        universes has its own R process.
+
+        :return: a list with the server of each of the n workers, or None if
+            the worker starts a new process for each universe.
+        """
+        none = [None] * n
+        if self.preload is None:
+            return none
+        if len(self.lang.get_cmd()) != 1 or not (self.lang.is_python()
+                                                 or self.lang.is_r()):
+            print_warn('Warm processes only run python and R universes')
+            return none
+
+        if self.lang.is_python():
+            if not hasattr(os, 'fork') or not hasattr(socket, 'AF_UNIX'):
+                print_warn('The fork server is not available on this platform')
+                return none
+            servers = [ForkServer(self.preload)] * n
+            start = [servers[0].start(os.path.join(self.folder, DIR_SCRIPT))]
+        else:
+            # also load the packages that the first universe loads
+            packages = self.preload + get_r_packages(
+                self._read_script(self.ids[0], source))
+            servers = [RWorker(list(dict.fromkeys(packages)))
+                       for _ in range(n)]
+            start = [s.start() for s in servers]
+
+        try:
+            await asyncio.gather(*start)
+        except (OSError, RuntimeError) as e:
+            for s in dict.fromkeys(servers):
+                await s.stop()
+            print_warn('{}\nRunning without warm processes'.format(e))
+            return none
+        return servers
+
+
+    def _read_script(self, universe, source):
+        """ Read the script of a universe. """
+        script = self.scripts[universe]
+        fn = os.path.join(self.folder, DIR_SCRIPT, script)
+        if os.path.exists(fn):
+            with open(fn) as f:
+                return f.read()
+        if source is not None:
+            return source.render(get_universe_id_from_script(script))
+        return ''
 
 
     def resume_multiverse(self, universes=[]):
@@ -111,7 +299,7 @@ class BobaRun:
 
         # default argument
         if not len(universes):
-            universes = list(range(1, self.size + 1))
+            universes = list(self.ids)
 
         # recover previous progress from log file
         df = pd.read_csv(self.file_log)
@@ -124,26 +312,39 @@ class BobaRun:
 
 
     def stop(self):
-        """ Stop all outstanding work in the pool """
-        if self.pool is not None:
+        """ Stop all outstanding work. It is safe to call from another thread,
+        and kills the universes that are running. """
+        if self.is_running():
             print('Terminating')
-            # stop all workers
-            # note that everything after pool.join() will still run
-            self.pool.terminate()
+            # no new universes will start, and the post-exe hook still runs
+            self.stopped = True
+            loop = self.loop
+            if loop is not None:
+                try:
+                    loop.call_soon_threadsafe(self._cancel_tasks)
+                except RuntimeError:
+                    # the loop is already closed
+                    pass
+
+
+    def _cancel_tasks(self):
+        for t in self.tasks:
+            t.cancel()
 
 
     def is_running(self):
         """ Whether the multiverse is currently running """
-        return self.pool is not None
+        return self.running
 
 
     def run_from_cli(self, run_all=True, num=1, thru=-1):
         """ Entry point of boba run CLI """
         # get the id of all the universes we want to run
         thru = num if thru == -1 else thru
-        start = 1 if run_all else num
-        end = self.size if run_all else thru
-        universes = list(range(start, end + 1))
+        if run_all:
+            universes = list(self.ids)
+        else:
+            universes = [u for u in self.ids if num <= u <= thru]
 
         # run
         self.run_multiverse(universes)
@@ -163,42 +364,107 @@ class BobaRun:
         self.run_commands_in_folder('post_exe.sh')
 
 
-# these two functions can't be in the class because multiprocess
-# does not know how to properly serialize functions in classes
-def run_batch_of_universes(folder, universes, supported_langs):
-    """ Run a batch of universes """
-    batch = []
-    for universe in universes:
-        batch.append(run_universe(folder, universe, supported_langs))
+def open_script_source(folder):
+    """
+    Open the source of scripts that are not in the code folder, which is
+    either a pack file or the manifest of a virtual multiverse.
+    """
+    if os.path.exists(os.path.join(folder, FILE_PACK)):
+        return PackReader(os.path.join(folder, FILE_PACK))
+    if os.path.exists(os.path.join(folder, FILE_MANIFEST)):
+        return Manifest.read(folder)
+    return None
+
+
+def run_universe(folder, script, supported_langs, source=None):
+    """ Run one universe, and wait until it is done """
+    return asyncio.run(run_universe_async(folder, script, supported_langs,
+                                          source))
+
+
+async def run_universe_async(folder, script, supported_langs, source=None,
+                             server=None):
+    """ Run one universe in the running event loop """
+    universe_id = get_universe_id_from_script(script)
+    fn = os.path.join(folder, DIR_SCRIPT, script)
+    if source is None or os.path.exists(fn):
+        return await _run_script(folder, script, supported_langs, server)
+
+    # write the script, and remove it once the universe is done
+    with open(fn, 'w') as f:
+        f.write(source.render(universe_id))
+    try:
+        return await _run_script(folder, script, supported_langs, server)
+    finally:
+        os.remove(fn)
 
-    return batch
+
+def _print_logs(folder, universe_id):
+    """ Print the logs of a universe that is done """
+    universe_name_fmt = '[' + get_universe_name(universe_id) + ']'
+    log_dir = os.path.join(folder, DIR_LOG)
+    with open(os.path.join(log_dir, get_universe_log(universe_id))) as log:
+        for output in log:
+            print(universe_name_fmt + " " + output, end='')
+
+    fn = os.path.join(log_dir, get_universe_error_log(universe_id))
+    if os.path.exists(fn):
+        with open(fn) as err_log:
+            print(universe_name_fmt + ' error:\n' + err_log.read(), end='')
+
+
+async def _read_lines(stream):
+    """ Read a stream line by line, without a limit on the line length """
+    buf = b''
+    while True:
+        chunk = await stream.read(1 << 16)
+        if not chunk:
+            break
+        lines = (buf + chunk).split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if buf:
+        yield buf
 
 
-def run_universe(folder, script, supported_langs):
-    """ Run one universe """
+async def _run_script(folder, script, supported_langs, server=None):
+    """ Run the script of one universe, in the warm process if any """
     cmds = Lang(script, supported_langs=supported_langs).get_cmd()
 
     universe_id = get_universe_id_from_script(script)
     universe_name_fmt = '[' + get_universe_name(universe_id) + ']'
+    log_dir = os.path.join(folder, DIR_LOG)
+    cwd = os.path.join(folder, DIR_SCRIPT)
     for cmd in cmds:
-        out = subprocess.Popen(cmd, cwd=os.path.join(folder, DIR_SCRIPT),
-                            stdout=PIPE, stderr=PIPE)
-
-        log_dir = os.path.join(folder, DIR_LOG)
-        with open(os.path.join(log_dir, get_universe_log(universe_id)), 'w') as log:
-            while True:
-                # blocks here until next line is availible.
-                output = out.stdout.readline().decode('utf-8')
-                if output == '' and out.poll() is not None:
-                    break
-                if output:
-                    print(universe_name_fmt + " " + output, end='')
-                    log.write(output)
-                rc = out.poll()
-
-        err = out.communicate()[1]
+        if server is not None:
+            out = await server.run(os.path.join(cwd, script), cwd)
+        else:
+            out = await asyncio.create_subprocess_exec(*cmd, cwd=cwd,
+                                                       stdout=PIPE, stderr=PIPE)
+
+        try:
+            with open(os.path.join(log_dir, get_universe_log(universe_id)), 'w') as log:
+                async def read_output():
+                    async for line in _read_lines(out.stdout):
+                        output = line.decode('utf-8')
+                        print(universe_name_fmt + " " + output, end='')
+                        log.write(output)
+
+                # read stderr at the same time, so a full pipe can't block
+                _, err = await asyncio.gather(read_output(), out.stderr.read())
+                await out.wait()
+        finally:
+            # we are stopped, so kill the universe
+            if out.returncode is None:
+                try:
+                    out.kill()
+                except ProcessLookupError:
+                    pass
+                await out.wait()
+
         err_decoded = err.decode('utf-8')
-        if err_decoded is not '':
+        if err_decoded != '':
             with open(os.path.join(log_dir, get_universe_error_log(universe_id)), 'w') as err_log:
                 err_log.write(err_decoded)
             
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""
+An on-disk cache of the state of python universes, so a later run can pick up
+where universes diverge instead of running the shared code again.
+
+A checkpoint holds the variables of the script, the random state, and the
+output so far. We key it by the code that ran, and it also records the files
+that the code read, so it is stale once any of them changes. We find the files
+with an audit hook, which does not see a file that a C extension opens without
+python. The cache is bounded in size, and we evict the least recently used
+checkpoints.
+
+Functions and classes that the script defines can't be pickled by value, so we
+define them again, by running the import, def and class statements of the
+code, before we unpickle the rest.
+"""
+
+import hashlib
+import importlib
+import io
+import os
+import pickle
+import random
+import site
+import sys
+import tempfile
+import types
+
+# the names that belong to the module, not to the script
+SKIP = {'__name__', '__file__', '__builtins__', '__loader__', '__spec__',
+        '__package__', '__cached__'}
+
+# checkpoints of another python or boba version can't be read
+VERSION = 'boba-1 ' + sys.version
+
+
+def _closed_file():
+    f = io.BytesIO()
+    f.close()
+    return f
+
+
+class _Pickler(pickle.Pickler):
+    """ Pickle modules by name, and closed files, which are left over from
+    "with open(...) as f", as some closed file. """
+
+    def reducer_override(self, obj):
+        if isinstance(obj, types.ModuleType):
+            return importlib.import_module, (obj.__name__,)
+        if isinstance(obj, io.IOBase) and obj.closed:
+            return _closed_file, ()
+        return NotImplemented
+
+
+def _is_defined(value):
+    """ Whether the value is a function or a class of the script. """
+    return isinstance(value, (types.FunctionType, type)) and \
+        getattr(value, '__module__', None) == '__main__'
+
+
+def _get_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CheckpointCache:
+    """ A folder of checkpoints, one file per key. """
+
+    def __init__(self, folder, max_size=1 << 30):
+        """
+        :param folder: the folder of the cache, which we create if needed.
+        :param max_size: the largest total size of the checkpoints, in bytes.
+        """
+        self.folder = os.path.abspath(folder)
+        self.max_size = max_size
+        self.inputs = {}
+        os.makedirs(self.folder, exist_ok=True)
+
+        # files that we never count as inputs
+        self._ignore = [self.folder] + [os.path.join(p, '') for p in set([
+            sys.prefix, sys.base_prefix, sys.exec_prefix,
+            sys.base_exec_prefix, site.USER_SITE or sys.prefix])]
+
+    def track(self, ignore=()):
+        """
+        Record the files that this process, and the processes it forks, open
+        for reading from now on.
+
+        :param ignore: more folders whose files are not inputs.
+        """
+        self._ignore += [os.path.join(os.path.abspath(p), '') for p in ignore]
+
+        def hook(event, args):
+            if event != 'open' or not isinstance(args[0], str):
+                return
+            mode, flags = args[1], args[2]
+            if mode is None:
+                if flags & (os.O_WRONLY | os.O_RDWR):
+                    return
+            elif 'r' not in mode or '+' in mode:
+                return
+            path = os.path.abspath(args[0])
+            if path not in self.inputs and '__pycache__' not in path and \
+                    not any(path.startswith(p) for p in self._ignore):
+                self.inputs[path] = None
+
+        sys.addaudithook(hook)
+
+    def _get_path(self, key):
+        name = hashlib.sha256((VERSION + key).encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, name + '.pkl')
+
+    def save(self, key, env, stdout, stderr):
+        """
+        Save a checkpoint, unless the state can't be pickled.
+
+        :param key: identifies the code that ran.
+        :param env: the namespace of the script.
+        :param stdout: the output of the code so far, as bytes.
+        :param stderr: the error output of the code so far, as bytes.
+        :return: whether we saved the checkpoint.
+        """
+        state = {}
+        redo = []
+        for k, v in env.items():
+            if k in SKIP:
+                continue
+            if _is_defined(v) and v.__qualname__ == k:
+                redo.append(k)
+            else:
+                state[k] = v
+
+        rng = {'random': random.getstate()}
+        if 'numpy' in sys.modules:
+            rng['numpy'] = sys.modules['numpy'].random.get_state()
+
+        tmp = None
+        try:
+            inputs = []
+            for path in list(self.inputs):
+                if os.path.isfile(path):
+                    st = os.stat(path)
+                    inputs.append((path, st.st_size, st.st_mtime_ns,
+                                   _get_digest(path)))
+
+            fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'inputs': inputs, 'stdout': stdout,
+                             'stderr': stderr, 'redo': redo}, f)
+                _Pickler(f).dump((state, rng))
+            os.replace(tmp, self._get_path(key))
+        except Exception:
+            if tmp is not None:
+                self._remove(tmp)
+            return False
+
+        self.evict()
+        return True
+
+    def get(self, key):
+        """
+        Find a checkpoint whose inputs have not changed.
+
+        :param key: identifies the code that ran.
+        :return: the checkpoint, or None.
+        """
+        path = self._get_path(key)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+
+        with f:
+            try:
+                entry = pickle.load(f)
+            except Exception:
+                entry = None
+            if entry is None or not self._is_fresh(entry['inputs']):
+                f.close()
+                self._remove(path)
+                return None
+            entry['data'] = f.read()
+
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    @staticmethod
+    def _is_fresh(inputs):
+        for path, size, mtime, digest in inputs:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if st.st_size != size:
+                return False
+            if st.st_mtime_ns != mtime and _get_digest(path) != digest:
+                return False
+        return True
+
+    @staticmethod
+    def restore(entry, env):
+        """
+        Load the variables and the random state of a checkpoint, after we
+        define the functions and classes of the script again.
+
+        :param entry: the checkpoint from get.
+        :param env: the namespace of the script.
+        :raise Exception: if we can't load the checkpoint.
+        """
+        state, rng = pickle.loads(entry['data'])
+        missing = [k for k in entry['redo'] if k not in env]
+        if missing:
+            raise ValueError('Cannot define ' + ', '.join(missing))
+        env.update(state)
+
+        random.setstate(rng['random'])
+        if 'numpy' in rng:
+            import numpy
+            numpy.random.set_state(rng['numpy'])
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """ Remove the least recently used checkpoints until the cache is no
+        larger than the maximum size. """
+        entries = []
+        for fn in os.listdir(self.folder):
+            if fn.endswith('.pkl'):
+                try:
+                    st = os.stat(os.path.join(self.folder, fn))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, fn))
+
+        total = sum([e[1] for e in entries])
+        for _, size, fn in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(os.path.join(self.folder, fn))
+            total -= size
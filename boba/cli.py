@@ -4,8 +4,8 @@
 import click
 import shutil
 import os
-import pandas as pd
 from .parser import Parser
+from .counter import Counter
 from .output.csvmerger import CSVMerger
 from .bobarun import BobaRun
 
@@ -17,14 +17,69 @@ from .bobarun import BobaRun
               default='.', show_default=True)
 @click.option('--lang', help='Language, can be python/R [default: inferred from file extension]',
               default=None)
-def compile(script, out, lang):
+@click.option('--jobs', default=1, show_default=True,
+              help='The number of processes used to generate the universes.')
+@click.option('--writers', default=1, show_default=True,
+              help='The number of background threads writing the universe '
+                   'scripts, or 0 to write them synchronously.')
+@click.option('--fsync', is_flag=True,
+              help='Flush all universe scripts to disk at the end.')
+@click.option('--incremental', is_flag=True,
+              help='Only rewrite the universe scripts that have changed, and '
+                   'keep the logs of the other universes.')
+@click.option('--dedup', is_flag=True,
+              help='Write identical universes only once.')
+@click.option('--virtual', is_flag=True,
+              help='Do not write the universe scripts, but render each script '
+                   'from a manifest when it runs.')
+@click.option('--pack', is_flag=True,
+              help='Write all universe scripts into a single pack file.')
+@click.option('--compress', is_flag=True,
+              help='Compress the scripts in the pack file.')
+@click.option('--yes', '-y', is_flag=True,
+              help='Do not ask for confirmation for a large multiverse.')
+@click.option('--limit', default=None, type=int,
+              help='Abort if there are more universes than this.')
+@click.option('--sample', default=None, type=int,
+              help='Only generate this many universes, drawn uniformly at '
+                   'random from all universes.')
+@click.option('--seed', default=None, type=int,
+              help='The random seed for --sample.')
+@click.option('--cover', default=None, type=int,
+              help='Only generate a small set of universes in which every '
+                   'combination of this many options, across decisions, '
+                   'appears at least once. Use 2 for pairwise coverage.')
+def compile(script, out, lang, jobs, writers, fsync, incremental, dedup,
+            virtual, pack, compress, yes, limit, sample, seed, cover):
     """Generate multiverse analysis from specifications."""
 
     check_path(script)
+    if virtual and incremental:
+        raise click.UsageError('--virtual cannot be used with --incremental')
+    if pack and (virtual or incremental or jobs != 1):
+        raise click.UsageError('--pack cannot be used with --virtual, '
+                               '--incremental, or multiple jobs')
+    if compress and not pack:
+        raise click.UsageError('--compress requires --pack')
+    if sample is not None and (virtual or pack or cover is not None):
+        raise click.UsageError('--sample cannot be used with --virtual, '
+                               '--pack, or --cover')
+    if sample is not None and sample < 1:
+        raise click.UsageError('--sample must be a positive number')
+    if cover is not None and (virtual or pack):
+        raise click.UsageError('--cover cannot be used with --virtual or '
+                               '--pack')
+    if cover is not None and cover < 1:
+        raise click.UsageError('--cover must be a positive number')
+    if seed is not None and sample is None:
+        raise click.UsageError('--seed requires --sample')
 
     click.echo('Creating multiverse from {}'.format(script))
     ps = Parser(script, out, lang)
-    ps.main()
+    ps.main(jobs=jobs, writers=writers, fsync=fsync, incremental=incremental,
+            dedup=dedup, virtual=virtual, pack=pack, compress=compress,
+            confirm=not yes, limit=limit, sample=sample, seed=seed,
+            cover=cover)
 
     ex = """To execute the multiverse, run the following commands:
     boba run --all
@@ -33,6 +88,29 @@ def compile(script, out, lang):
     click.secho(ex, fg='green')
 
 
+@click.command()
+@click.option('--script', '-s', help='Path to template script',
+              default='./template.py', show_default=True)
+@click.option('--lang', help='Language, can be python/R [default: inferred from file extension]',
+              default=None)
+def count(script, lang):
+    """Count the universes without generating them."""
+
+    check_path(script)
+    ps = Parser(script, '.', lang)
+    ct = Counter(ps)
+    click.echo('{} universes'.format(ct.count()))
+
+    breakdown = ct.breakdown()
+    if len(breakdown):
+        click.echo('\n{:<20}{:<30}{:>15}'.format('Decision', 'Option',
+                                                 'Universes'))
+    for dec, res in breakdown.items():
+        for i, (opt, n) in enumerate(res):
+            click.echo('{:<20}{:<30}{:>15}'.format(dec if i == 0 else '',
+                                                   opt[:29], n))
+
+
 def check_path(p):
     """Check if the path exists"""
     if not os.path.exists(p):
@@ -56,10 +134,15 @@ def print_help(err=''):
               help='Execute all universes')
 @click.option('--thru', default=-1, help='Run until this universe number')
 @click.option('--jobs', default=1, help='The number of universes that can be running at a time.')
-@click.option('--batch_size', default=0, help='The approximate number of universes a processor will run in a row.')
+@click.option('--warm', '--fork', 'warm', is_flag=True, help='Run python or R universes in warm processes, without starting an interpreter per universe.')
+@click.option('--preload', default='', help='Comma-separated python modules to import, .py scripts to run, or R packages to load, once in the warm processes. Implies --warm.')
+@click.option('--tree', is_flag=True, help='Run the code that python universes share once, and fork where they differ.')
+@click.option('--cache', default=None, help='A folder to save the state of python universes where they diverge, so later runs can start from there. Implies --tree. A checkpoint is stale once a file that python opened for the universe changes, but files that C extensions open directly are not tracked.')
+@click.option('--cache_size', default=1024, show_default=True, help='The largest size of the cache, in MB.')
 @click.option('--dir', 'folder', help='Multiverse directory',
               default='./multiverse', show_default=True)
-def run(folder, run_all, num, thru, jobs, batch_size):
+def run(folder, run_all, num, thru, jobs, warm, preload, tree, cache,
+        cache_size):
     """ Execute the generated universe scripts.
 
     Run all universes: boba run --all
@@ -71,8 +154,14 @@ def run(folder, run_all, num, thru, jobs, batch_size):
 
     check_path(folder)
 
-    df = pd.read_csv(folder + '/summary.csv')
-    num_universes = df.shape[0]
+    # scripts to preload are relative to where we are, not the code folder
+    preload = [p.strip() for p in preload.split(',') if p.strip()]
+    preload = [os.path.abspath(p) if p.endswith('.py') else p for p in preload]
+    br = BobaRun(folder, jobs, preload if warm or len(preload) else None,
+                 tree, cache, cache_size)
+    num_universes = br.size
+    # a sample of the multiverse keeps the universe ids of the full multiverse
+    last = br.ids[-1] if num_universes else 0
 
     if not run_all:
         if thru == -1:
@@ -81,10 +170,11 @@ def run(folder, run_all, num, thru, jobs, batch_size):
             print_help()
         if thru < num:
             print_help('The thru parameter cannot be less than the num parameter.')
-        if num > num_universes or thru > num_universes:
-            print_help(f'There are only {num_universes} universes.')
+        if num > last or thru > last:
+            print_help(f'There are only {num_universes} universes.'
+                       if last == num_universes
+                       else f'The last universe is {last}.')
 
-    br = BobaRun(folder, jobs, batch_size)
     br.run_from_cli(run_all, num, thru)
 
 
@@ -116,6 +206,7 @@ def main():
 
 
 main.add_command(compile)
+main.add_command(count)
 main.add_command(run)
 main.add_command(merge)
 
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from types import CodeType
+from typing import List
 from .baseparser import ParseError
 from .conditionparser import ConditionParser, TokenType
 
@@ -14,6 +16,27 @@ class Constraint:
     index: int = -1
     skip: bool = False
     condition: str = ''
+    # the decisions and blocks that the condition reads
+    inputs: List = field(default_factory=lambda: [])
+    # the condition compiled once, so we do not parse it on every evaluation
+    code: CodeType = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.compile()
+
+    def compile(self):
+        if self.condition:
+            self.code = compile(self.condition, '<constraint>', 'eval')
+
+    def __getstate__(self):
+        # code objects can't be pickled, so recompile in the other process
+        state = self.__dict__.copy()
+        state['code'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
 
 
 class ConstraintParser:
@@ -105,40 +128,6 @@ class ConstraintParser:
                 ConstraintParser._throw(msg, constraint)
             m = n
 
-    @staticmethod
-    def _convert_link(link, decs, bl_decs):
-        """ Convert linked decisions to constraints """
-        res = []
-        ls = []
-        size = 0
-
-        # first, turn variable/block decisions into a shared format
-        for l in link:
-            tp = 'variable' if l in decs else 'block'
-            opt = decs[l].value if l in decs \
-                else list(map(lambda x: x.split(':')[1], bl_decs[l]))
-            ls.append({'type': tp, 'name': l, 'options': opt})
-            size = len(opt)
-
-        # then, construct pairwise dependencies
-        for i in range(size):
-            for l in ls:
-                cond = ''
-                for j in ls:
-                    if j != l:
-                        if j['type'] == 'variable':
-                            cond += ' and ({}.index < 0 or {}.index == {})'\
-                                .format(j['name'], j['name'], i)
-                        else:
-                            cond += ' and {} == {}'.format(j['name'], j['options'][i])
-                cs = {l['type']: l['name'], 'condition': cond[5:], '_source': 'link'}
-                if l['type'] == 'block':
-                    cs['option'] = l['options'][i]
-                else:
-                    cs['index'] = i
-                res.append(cs)
-        return res
-
     @staticmethod
     def _verify_json_syntax(block, param, opt, constraint, idx):
         """ Check if the json has the correct combination of fields. """
@@ -219,23 +208,23 @@ class ConstraintParser:
 
     def _infer_procedural_deps(self, c, block, variable, cond):
         """ Infer procedural edges from parsed condition """
-        # skip constraints added by us, for example links
-        if '_source' not in c:
-            dec = block if block else variable
-            # current node should depend on all decisions on the LHS
-            for i in range(0, len(cond), 2):
-                v = cond[i].value
-                self.procedural.add('{}-{}'.format(v, dec))
+        dec = block if block else variable
+        # current node should depend on all decisions on the LHS
+        for i in range(0, len(cond), 2):
+            v = cond[i].value
+            self.procedural.add('{}-{}'.format(v, dec))
 
     def read_constraints(self, code_parser, dec_parser):
         """ Read the constraints from the JSON spec. """
         cons = ConstraintParser._read_optional(self.spec, 'constraints', [])
 
-        decs = dec_parser.decisions
+        # the options after sampling and expanding ranges
+        decs = dec_parser.discrete_decisions
         bls = code_parser.get_block_names()
         bl_decs = code_parser.get_decisions()
 
-        # first separate links and conditions
+        # first separate links and conditions. Links are handled by the parser
+        # when enumerating universes, so they do not become constraints.
         pure_cons = []
         for c in cons:
             # read link
@@ -243,14 +232,16 @@ class ConstraintParser:
             if link:
                 ConstraintParser._verify_link(link, decs, bl_decs, c)
                 self.links.append(link)
-                pure_cons += ConstraintParser._convert_link(link, decs, bl_decs)
             else:
                 pure_cons.append(c)
 
+        # decisions that are sampled jointly take the same point
+        self.links += dec_parser.joint_links
+
         # add inline constraints
         pure_cons += code_parser.inline_constraints
 
-        # then parse all conditions, including generated ones from link
+        # then parse all conditions
         for c in pure_cons:
             # read block
             block = ConstraintParser._read_optional(c, 'block')
@@ -289,7 +280,9 @@ class ConstraintParser:
             recon = self._recon(code, parsed_decs, cond)
 
             # save
-            constraint = Constraint(block, param, opt, idx, skip, recon)
+            inputs = [parsed_decs[i].value
+                      for i in range(0, len(parsed_decs), 2)]
+            constraint = Constraint(block, param, opt, idx, skip, recon, inputs)
             key = ConstraintParser._create_key(constraint)
             self.constraints[key] = constraint
 
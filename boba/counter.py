@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+from .constraintparser import ConstraintParser
+
+# kinds of steps in the program of a code path
+NODE = 0
+VAR = 1
+
+
+class Counter:
+    """
+    Count the universes of a multiverse exactly, without generating them.
+
+    We walk each code path like the enumeration in Parser, but only through
+    the steps that matter for counting: entering a node, where we evaluate
+    its constraints, and reaching a placeholder variable, where we branch if
+    the variable is not bound yet. The number of universes below a branch
+    point only depends on the part of the state that later steps can
+    observe, so we memoize it under that part of the state. With sparse
+    constraints, most branch points share their count with their siblings,
+    and the cost grows with the number of distinct states rather than the
+    number of universes.
+    """
+
+    def __init__(self, parser):
+        self.ps = parser
+        self.paths = parser._get_code_paths()
+        self.options = parser._get_options()
+        self.blocks = parser.code_parser.get_decisions()
+        self._programs = {}
+        self._memos = {}  # code path -> memo of the counts without restriction
+
+    def count(self, restrict=None):
+        """
+        Count the universes.
+
+        :param restrict: a dict of decision -> option index, to only count
+            the universes that take these options. A decision is a
+            placeholder variable or a block decision, and a universe does not
+            take a block option if the block is skipped.
+        """
+        return sum([self.count_path(i, restrict)
+                    for i in range(len(self.paths))])
+
+    def breakdown(self):
+        """
+        Count the universes that take each option of each decision.
+
+        :return: a dict of decision -> a list of (option, count).
+        """
+        res = {}
+        for d in self.ps.dec_parser.get_decs():
+            res[d] = [(o, self.count({d: k}))
+                      for k, o in enumerate(self.options[d])]
+        for b, opts in self.blocks.items():
+            res[b] = [(o.split(':')[1], self.count({b: k}))
+                      for k, o in enumerate(opts)]
+        return res
+
+    def count_path(self, idx, restrict=None):
+        """ Count the universes on a code path. """
+        start = self._start(idx)
+        if start is None:
+            return 0
+        env, group = start
+
+        # block options are fixed by the code path
+        for d, k in (restrict or {}).items():
+            if d in self.blocks and self.blocks[d][k] not in self.ps.paths[idx]:
+                return 0
+
+        # the memo only holds for one restriction, so we keep the one without
+        if restrict:
+            return self._count_from(idx, 0, env, group, {}, restrict)
+        memo = self._memos.setdefault(idx, {})
+        return self._count_from(idx, 0, env, group, memo, {})
+
+    def count_shards(self, idx):
+        """
+        Count the universes on a code path by the option they take at the
+        first branch point, which is how Parser splits a path into shards.
+
+        :return: a list with the count of each option of the first variable
+            we branch on, or [1] if the path has a single universe without a
+            branch point, or [] if it has none.
+        """
+        start = self._start(idx)
+        if start is None:
+            return []
+        env, group = start
+
+        ps = self.ps
+        steps, keys = self._get_program(idx)
+        memo = self._memos.setdefault(idx, {})
+        t = 0
+        while t < len(steps):
+            kind, nd, end = steps[t]
+            if kind == NODE:
+                keep = ps._check_block(env, nd)
+                if keep is None:
+                    return []
+                if not keep:
+                    ps._skip_node(env, nd)
+                    t = end
+                    continue
+            elif env[ConstraintParser.make_index_var(nd)] < 0:
+                res = [0] * len(self.options[nd])
+                g = ps.linked_vars.get(nd)
+                for k in self._get_allowed(env, nd, group, {}):
+                    ps._bind(env, nd, self.options[nd][k], k)
+                    if g is not None and g not in group:
+                        group[g] = [k, nd]
+                    res[k] = self._count_from(idx, t + 1, env, group, memo, {})
+                    ps._unbind(env, nd)
+                    if g in group and group[g][1] == nd:
+                        del group[g]
+                return res
+            t += 1
+        return [1]
+
+    def unrank(self, universe_id):
+        """
+        Find the universe with the given id, which is its position in the
+        order that Parser enumerates the universes, without enumerating the
+        universes before it.
+
+        :return: a tuple (path, decisions, skipped), where decisions is a
+            list of (variable, option index) in the order they are bound,
+            and skipped is a list of skipped nodes.
+        """
+        rank = universe_id - 1
+        if rank >= 0:
+            for idx in range(len(self.paths)):
+                n = self.count_path(idx)
+                if rank < n:
+                    return self._unrank_path(idx, rank)
+                rank -= n
+        raise IndexError('There is no universe {}'.format(universe_id))
+
+    def sample(self, n, seed=None):
+        """
+        Draw universes uniformly at random, without replacement.
+
+        :param n: the number of universes, or all universes if there are
+            fewer than n.
+        :param seed: the random seed.
+        :return: a sorted list of universe ids.
+        """
+        total = self.count()
+        ranks = random.Random(seed).sample(range(total), min(n, total))
+        return [r + 1 for r in sorted(ranks)]
+
+    def find(self, restrict):
+        """
+        Find the first universe that takes the given options.
+
+        :param restrict: a dict of decision -> option index, see count.
+        :return: the universe id, or None if no universe takes the options.
+        """
+        offset = 0
+        for idx in range(len(self.paths)):
+            if self.count_path(idx, restrict) > 0:
+                return offset + self._find_path(idx, restrict) + 1
+            offset += self.count_path(idx)
+        return None
+
+    def _start(self, idx):
+        """ Get the environment and the link groups at the start of a code
+        path, or None if the linked blocks on the path disagree. """
+        ps = self.ps
+        env = ps._make_env(ps.paths[idx])
+
+        # link groups, see Parser._enumerate
+        group = {}
+        for nd in ps.paths[idx]:
+            if nd in ps.linked_options:
+                g, k = ps.linked_options[nd]
+                if group.setdefault(g, [k, None])[0] != k:
+                    return None
+        return env, group
+
+    def _unrank_path(self, idx, rank):
+        """ Find the universe at the given position on a code path. """
+        ps = self.ps
+        steps, keys = self._get_program(idx)
+        env, group = self._start(idx)
+        memo = self._memos.setdefault(idx, {})
+        decisions = []
+        skipped = []
+
+        t = 0
+        while t < len(steps):
+            kind, nd, end = steps[t]
+            if kind == NODE:
+                keep = ps._check_block(env, nd)
+                if keep is None:
+                    raise IndexError('Universe is out of range')
+                if not keep:
+                    skipped.append(nd)
+                    ps._skip_node(env, nd)
+                    t = end
+                    continue
+            elif env[ConstraintParser.make_index_var(nd)] < 0:
+                # skip over the options whose universes all come before
+                g = ps.linked_vars.get(nd)
+                for k in self._get_allowed(env, nd, group, {}):
+                    ps._bind(env, nd, self.options[nd][k], k)
+                    if g is not None and g not in group:
+                        group[g] = [k, nd]
+                    n = self._count_from(idx, t + 1, env, group, memo, {})
+                    if rank < n:
+                        decisions.append((nd, k))
+                        break
+                    rank -= n
+                    ps._unbind(env, nd)
+                    if g in group and group[g][1] == nd:
+                        del group[g]
+                else:
+                    raise IndexError('Universe is out of range')
+            t += 1
+
+        return idx, decisions, skipped
+
+    def _find_path(self, idx, restrict):
+        """ Find the position of the first universe on a code path that
+        takes the given options. """
+        ps = self.ps
+        steps, keys = self._get_program(idx)
+        env, group = self._start(idx)
+        memo = self._memos.setdefault(idx, {})
+        memo_restrict = {}
+        rank = 0
+
+        t = 0
+        while t < len(steps):
+            kind, nd, end = steps[t]
+            if kind == NODE:
+                if not ps._check_block(env, nd):
+                    ps._skip_node(env, nd)
+                    t = end
+                    continue
+            elif env[ConstraintParser.make_index_var(nd)] < 0:
+                # skip over the options that do not lead to such a universe
+                g = ps.linked_vars.get(nd)
+                for k in self._get_allowed(env, nd, group, {}):
+                    ps._bind(env, nd, self.options[nd][k], k)
+                    if g is not None and g not in group:
+                        group[g] = [k, nd]
+                    if self._count_from(idx, t + 1, env, group, memo_restrict,
+                                        restrict):
+                        break
+                    rank += self._count_from(idx, t + 1, env, group, memo, {})
+                    ps._unbind(env, nd)
+                    if g in group and group[g][1] == nd:
+                        del group[g]
+            t += 1
+
+        return rank
+
+    def _count_from(self, idx, t, env, group, memo, restrict):
+        """
+        Count the universes below a state of a code path. The environment and
+        the link groups are restored before we return.
+
+        :param t: the step to start from.
+        :param memo: counts of the branch points we have visited.
+        :param restrict: a dict of placeholder variable -> option index.
+        """
+        ps = self.ps
+        steps, keys = self._get_program(idx)
+
+        # a universe only counts if it takes the restricted options
+        extra, expected = self._get_expected(restrict)
+
+        skipped = []
+
+        # each branch point is [step, memo key, allowed options, the next
+        # option to try, the count so far, and the length of skipped]
+        stack = []
+
+        try:
+            while True:
+                # walk forward to the next branch point, or get the count
+                value = None
+                while t < len(steps):
+                    kind, nd, end = steps[t]
+                    if kind == NODE:
+                        keep = ps._check_block(env, nd)
+                        if keep is None:
+                            value = 0
+                            break
+                        if not keep:
+                            skipped.append(nd)
+                            ps._skip_node(env, nd)
+                            t = end
+                            continue
+                    elif env[ConstraintParser.make_index_var(nd)] < 0:
+                        key = self._get_key(t, keys[t], env, extra)
+                        if key in memo:
+                            value = memo[key]
+                        else:
+                            opts = self._get_allowed(env, nd, group, restrict)
+                            stack.append([t, key, opts, 0, 0, len(skipped)])
+                        break
+                    t += 1
+                else:
+                    value = int(tuple([env.get(x) for x in extra]) ==
+                                expected)
+
+                # add the count to the latest branch point, and try its next
+                # option
+                while stack:
+                    frame = stack[-1]
+                    if value is not None:
+                        frame[4] += value
+                        value = None
+
+                    v = steps[frame[0]][1]
+                    ps._unbind(env, v)
+                    g = ps.linked_vars.get(v)
+                    if g in group and group[g][1] == v:
+                        del group[g]
+                    for nd in skipped[frame[5]:]:
+                        ps._unskip_node(env, nd)
+                    del skipped[frame[5]:]
+
+                    if frame[3] < len(frame[2]):
+                        k = frame[2][frame[3]]
+                        frame[3] += 1
+                        ps._bind(env, v, self.options[v][k], k)
+                        if g is not None and g not in group:
+                            group[g] = [k, v]
+                        t = frame[0] + 1
+                        break
+
+                    memo[frame[1]] = frame[4]
+                    value = frame[4]
+                    stack.pop()
+                else:
+                    return value
+        finally:
+            # nodes skipped before the first branch point
+            for nd in skipped:
+                ps._unskip_node(env, nd)
+
+    def _get_allowed(self, env, v, group, restrict):
+        """ Get the options of a placeholder variable we can take now. """
+        ks = range(len(self.options[v]))
+        g = self.ps.linked_vars.get(v)
+        if g in group:
+            ks = [group[g][0]]
+        if v in restrict:
+            ks = [k for k in ks if k == restrict[v]]
+        return [k for k in ks if self.ps._check_option(env, v, k)]
+
+    @staticmethod
+    def _get_key(t, key, env, extra):
+        """ The part of the state that the steps from t onwards observe. """
+        values, flags, names = key
+        return (t, tuple([env[v] for v in values]),
+                tuple([env[v] >= 0 for v in flags]),
+                tuple([n in env for n in names]),
+                tuple([env.get(v) for v in extra]))
+
+    def _get_expected(self, restrict):
+        """ Get the names in the environment that a restriction observes,
+        and the values they must have at the end of the universe. """
+        extra = []
+        expected = []
+        for d, k in restrict.items():
+            if d in self.blocks:
+                extra.append(d)
+                expected.append(self.blocks[d][k].split(':')[1])
+            else:
+                extra.append(ConstraintParser.make_index_var(d))
+                expected.append(k)
+        return extra, tuple(expected)
+
+    def _get_program(self, idx):
+        """
+        Convert a code path into a list of steps, and find what each step
+        after a branch point can observe.
+
+        :return: (steps, keys), where each step is (NODE, node, the step
+            after the node) or (VAR, variable, None), and keys maps a VAR step
+            to the index variables whose value we observe, the index
+            variables where we only observe if they are bound, and the names
+            of skippable nodes that we observe.
+        """
+        if idx in self._programs:
+            return self._programs[idx]
+
+        ps = self.ps
+        path = self.paths[idx]
+        spans = ps._node_spans(path)
+        steps = []
+        for i, (nd, ch) in enumerate(path):
+            if i in spans:
+                steps.append([NODE, nd, None])
+            if ch.variable:
+                steps.append([VAR, ch.variable, None])
+
+        # the step after each node, for when the node is skipped
+        end = len(steps)
+        for t in range(len(steps) - 1, -1, -1):
+            if steps[t][0] == NODE:
+                steps[t][2] = end
+                end = t
+
+        skippable = set()
+        for nd in ps.paths[idx]:
+            for n in [nd, nd.split(':')[0]]:
+                if n in ps.constraints and ps.constraints[n].skip:
+                    skippable.add(nd.split(':')[0])
+
+        # walk backwards, collecting what the remaining steps observe
+        decs = ps.dec_parser.decisions
+        read = set()
+        used = set()
+        keys = {}
+        for t in range(len(steps) - 1, -1, -1):
+            kind, nd, _ = steps[t]
+            if kind == NODE:
+                cons = dict.fromkeys([nd, nd.split(':')[0]])
+            else:
+                used.add(nd)
+                # linked variables observe the rest of their group
+                g = ps.linked_vars.get(nd)
+                read.update([v for v in ps.linked_vars
+                             if ps.linked_vars[v] == g and v != nd])
+                cons = ['{}:{}'.format(ConstraintParser.make_index_var(nd), k)
+                        for k in range(len(self.options[nd]))]
+            for c in cons:
+                if c in ps.constraints:
+                    read.update(ps.constraints[c].inputs)
+
+            if kind == VAR:
+                values = sorted([v for v in read if v in decs])
+                flags = sorted([v for v in used if v not in read])
+                names = sorted([n for n in read if n in skippable])
+                keys[t] = ([ConstraintParser.make_index_var(v) for v in values],
+                           [ConstraintParser.make_index_var(v) for v in flags],
+                           names)
+
+        steps = [tuple(s) for s in steps]
+        self._programs[idx] = (steps, keys)
+        return steps, keys
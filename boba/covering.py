@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from itertools import combinations, product
+
+
+class CoveringArray:
+    """
+    Pick a small set of universes in which every combination of t options,
+    across t different decisions, appears at least once. The decisions are
+    the placeholder variables and the block decisions.
+
+    Some combinations are not taken by any universe because of constraints,
+    links or code paths, so we only cover the combinations for which a
+    restricted count is positive. We build the set greedily, like AETG: each
+    new universe starts from a combination that is not covered yet, then we
+    fix one decision at a time to the option that covers the most new
+    combinations, as long as some universe still takes all fixed options.
+    The universe is the first one that takes the fixed options, and it may
+    cover more combinations than we asked for.
+    """
+
+    def __init__(self, counter, strength=2):
+        """
+        :param counter: a Counter of the multiverse.
+        :param strength: the number of options in each combination.
+        """
+        self.counter = counter
+        self.decisions = [(d, len(counter.options[d]))
+                          for d in counter.ps.dec_parser.get_decs()]
+        self.decisions += [(b, len(opts)) for b, opts in
+                           counter.blocks.items()]
+        self.strength = min(strength, len(self.decisions))
+        self._order = {d: i for i, (d, _) in enumerate(self.decisions)}
+
+    def get_combinations(self):
+        """ Get the combinations that some universe takes, as tuples of
+        (decision, option index) in the order of the decisions. """
+        res = []
+        for decs in combinations(self.decisions, self.strength):
+            names = [d for d, _ in decs]
+            for ks in product(*[range(n) for _, n in decs]):
+                comb = tuple(zip(names, ks))
+                if self.counter.count(dict(comb)) > 0:
+                    res.append(comb)
+        return res
+
+    def generate(self):
+        """
+        Pick the universes.
+
+        :return: a sorted list of universe ids.
+        """
+        # a dict keeps the combinations in order, so the result is stable
+        uncovered = dict.fromkeys(self.get_combinations())
+
+        ids = set()
+        while uncovered:
+            fixed = dict(next(iter(uncovered)))
+            for d, n in self.decisions:
+                if d in fixed:
+                    continue
+                gains = [(self._get_gain(uncovered, fixed, d, k), k)
+                         for k in range(n)]
+                gains.sort(key=lambda x: -x[0])
+                for gain, k in gains:
+                    if gain == 0:
+                        break
+                    fixed[d] = k
+                    if self.counter.count(fixed) > 0:
+                        break
+                    del fixed[d]
+
+            uid = self.counter.find(fixed)
+            ids.add(uid)
+            for comb in self._get_covered(uid):
+                uncovered.pop(comb, None)
+
+        return sorted(ids)
+
+    def _get_gain(self, uncovered, fixed, d, k):
+        """ Count the combinations we would cover by also fixing d to k. """
+        n = 0
+        for others in combinations(fixed.items(), self.strength - 1):
+            comb = tuple(sorted(others + ((d, k),),
+                                key=lambda x: self._order[x[0]]))
+            n += comb in uncovered
+        return n
+
+    def _get_covered(self, universe_id):
+        """ Get the combinations that a universe takes. """
+        idx, decisions, skipped = self.counter.unrank(universe_id)
+        taken = dict(decisions)
+        path = set(self.counter.ps.paths[idx]) - set(skipped)
+        for b, opts in self.counter.blocks.items():
+            for k, opt in enumerate(opts):
+                if opt in path:
+                    taken[b] = k
+
+        taken = [(d, taken[d]) for d, _ in self.decisions if d in taken]
+        return combinations(taken, self.strength)
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import bisect
 import json
-import random
+import math
 from dataclasses import dataclass
+from decimal import Decimal
+from statistics import NormalDist
+
+import numpy as np
 from .baseparser import ParseError, BaseParser
 
 
@@ -24,11 +29,103 @@ class DiscretizationFn:
         self.required_params = required_params
         self.optional_params = optional_params
 
+class OptionRange:
+    """
+    Evenly spaced numeric options, computed by index instead of stored. In the
+    options of a decision, {"range": [start, stop, step]} works like the
+    python range but also takes floats, {"linspace": [start, stop, num]} has
+    num options from start to stop, inclusive, and {"logspace": [start, stop,
+    num]} has num options from 10^start to 10^stop.
+    """
+    kinds = ['range', 'linspace', 'logspace']
+
+    def __init__(self, kind, args):
+        if not isinstance(args, list) or len(args) != 3 or not all(
+                [isinstance(a, (int, float)) and not isinstance(a, bool)
+                 for a in args]):
+            msg = 'expected "{}" to be a list of three numbers, got {}'
+            raise ParseError(msg.format(kind, args))
+        self.kind = kind
+        self.start, self.stop, self.step = args
+
+        if kind == 'range':
+            if self.step == 0:
+                raise ParseError('the step of "range" cannot be zero')
+            # count in decimal, so the error of a float step such as 0.2
+            # does not add the stop as an option
+            start, stop, step = [Decimal(repr(a)) for a in args]
+            self.num = max(0, math.ceil((stop - start) / step))
+            # round away the error of adding up the steps, e.g. 0.1 * 3
+            self.digits = max([OptionRange._get_digits(a) for a in args])
+        else:
+            if not isinstance(self.step, int) or self.step < 1:
+                msg = 'expected the number of "{}" options to be a positive int'
+                raise ParseError(msg.format(kind))
+            self.num = self.step
+
+    @staticmethod
+    def _get_digits(x):
+        """ Get the number of digits after the decimal point. """
+        exponent = Decimal(repr(x)).normalize().as_tuple().exponent
+        return max(0, -exponent)
+
+    def __len__(self):
+        return self.num
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.num
+        if not 0 <= i < self.num:
+            raise IndexError('option index out of range')
+
+        if self.kind == 'range':
+            v = self.start + i * self.step
+            return v if self.digits == 0 else round(v, self.digits)
+        if self.num == 1:
+            v = self.start
+        elif i == self.num - 1:
+            v = self.stop
+        else:
+            v = self.start + i * (self.stop - self.start) / (self.num - 1)
+        return float(v) if self.kind == 'linspace' else 10.0 ** v
+
+
+class OptionList:
+    """
+    The options of a decision when some of them are an OptionRange. It works
+    like a list, but only computes an option when we ask for its index.
+    """
+    def __init__(self, parts):
+        """
+        :param parts: a list of lists and OptionRange.
+        """
+        self.parts = parts
+        self.offsets = [0]
+        for p in parts:
+            self.offsets.append(self.offsets[-1] + len(p))
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('option index out of range')
+        j = bisect.bisect_right(self.offsets, i) - 1
+        return self.parts[j][i - self.offsets[j]]
+
+    def __iter__(self):
+        for p in self.parts:
+            yield from p
+
+
 class DecisionParser(BaseParser):
     def __init__(self):
         super(DecisionParser, self).__init__('')
         self.decisions = {}
         self.discrete_decisions = {}
+        self.joint_links = []
 
     @staticmethod
     def _is_syntax_start(ch):
@@ -53,32 +150,62 @@ class DecisionParser(BaseParser):
 
 
     @staticmethod
-    def get_within_range(function, args, distribution_range, exclusive):
-        """bind the output of the provided function within the provided range"""
+    def check_range(distribution_range):
+        """check that the range is not empty"""
         if distribution_range[1] <= distribution_range[0]:
             raise ValueError('max value: ' + str(distribution_range[1]) + ' is less than min value: ' + str(distribution_range[0]))
-        
-        val = function(*args)
-        while (val < distribution_range[0] or val > distribution_range[1] or
-              ((val == distribution_range[0] or val == distribution_range[1]) and exclusive)):
-            val = function(*args)
 
-        return val
+    @staticmethod
+    def clip_to_range(samples, distribution_range, exclusive):
+        """keep the samples within the range. The samples are drawn within the
+        range, so this only moves a sample that rounding put on or past an end"""
+        low, high = distribution_range
+        if exclusive:
+            low, high = np.nextafter(low, np.inf), np.nextafter(high, -np.inf)
+        return np.clip(samples, low, high)
+
+    @staticmethod
+    def truncated_normal(u, mean, std_dev, distribution_range):
+        """map uniform samples in [0, 1) to a normal distribution truncated to
+        the range, by scaling them between the CDF of both ends and inverting
+        the CDF"""
+        low, high = distribution_range
+        # the CDF loses precision in the upper tail, so mirror the range
+        # into the lower tail
+        mirror = low + high > 2 * mean
+        if mirror:
+            low, high = 2 * mean - high, 2 * mean - low
+
+        dist = NormalDist(mean, std_dev)
+        def cdf(x):
+            return 0.5 * math.erfc((mean - x) / (std_dev * math.sqrt(2)))
+
+        p = cdf(low) + (cdf(high) - cdf(low)) * u
+        p = np.clip(p, np.nextafter(0, 1), np.nextafter(1, 0))
+        samples = np.array([dist.inv_cdf(q) for q in p.tolist()])
+        return 2 * mean - samples if mirror else samples
 
     @staticmethod
-    def random_uniform(minimum, maximum, args):
-        """randomly sample a number from a uniform distribution"""
+    def random_uniform(rng, count, minimum, maximum, args, u=None):
+        """randomly sample numbers from a uniform distribution, or map the
+        uniform samples u in [0, 1) to it"""
         exclusive = args.get('exclusive', False)
         DecisionParser.check_var_types([minimum, maximum, exclusive], 
                         [float, float, bool], 
                         ['min', 'max', 'exclusive'])
 
         distr_range = [minimum, maximum]
-        return DecisionParser.get_within_range(random.uniform, distr_range, distr_range, exclusive)
+        DecisionParser.check_range(distr_range)
+        if u is None:
+            samples = rng.uniform(minimum, maximum, count)
+        else:
+            samples = minimum + (maximum - minimum) * u
+        return DecisionParser.clip_to_range(samples, distr_range, exclusive)
 
     @staticmethod
-    def rand_x_normal(function, args):
-        """randomly sample a number from any type of normal distribution"""
+    def rand_x_normal(rng, count, log, args, u=None):
+        """randomly sample numbers from a normal or lognormal distribution, or
+        map the uniform samples u in [0, 1) to it"""
         mean = args.get('mean', 0.0)
         std_dev = args.get('std_dev', 1.0)
         exclusive = args.get('exclusive', False)
@@ -95,24 +222,74 @@ class DecisionParser(BaseParser):
         elif distribution_range and len(distribution_range) == 2:
             DecisionParser.check_var_types(distribution_range, [float, float], ['range[0]', 'range[1]'])
 
-        if distribution_range:
-            return DecisionParser.get_within_range(function, [mean, std_dev], distribution_range, exclusive)
+        if not distribution_range and u is None:
+            if log:
+                return rng.lognormal(mean, std_dev, count)
+            return rng.normal(mean, std_dev, count)
+        if not distribution_range:
+            samples = DecisionParser.truncated_normal(u, mean, std_dev, [-math.inf, math.inf])
+            return np.exp(samples) if log else samples
+
+        DecisionParser.check_range(distribution_range)
+        u = rng.random(count) if u is None else u
+        if not log:
+            samples = DecisionParser.truncated_normal(u, mean, std_dev, distribution_range)
         else:
-            return function(mean, std_dev)
+            # truncate the underlying normal distribution instead
+            if distribution_range[1] <= 0:
+                raise ValueError('a lognormal distribution has no values in range: ' + str(distribution_range))
+            low = math.log(distribution_range[0]) if distribution_range[0] > 0 else -math.inf
+            high = math.log(distribution_range[1])
+            samples = np.exp(DecisionParser.truncated_normal(u, mean, std_dev, [low, high]))
+        return DecisionParser.clip_to_range(samples, distribution_range, exclusive)
 
     @staticmethod
-    def random_lognormal(args):
-        """randomly sample a number from a lognormal distribution"""
-        return DecisionParser.rand_x_normal(random.lognormvariate, args)
+    def random_lognormal(rng, count, args, u=None):
+        """randomly sample numbers from a lognormal distribution"""
+        return DecisionParser.rand_x_normal(rng, count, True, args, u)
 
     @staticmethod
-    def random_normal(args):
-        """randomly sample a number from a normal distribution"""
-        return DecisionParser.rand_x_normal(random.normalvariate, args)
+    def random_normal(rng, count, args, u=None):
+        """randomly sample numbers from a normal distribution"""
+        return DecisionParser.rand_x_normal(rng, count, False, args, u)
 
     @staticmethod
-    def discretize(obj, discretization_method, count):
-        """discretizes a continuous variable into 'count' descrete options."""
+    def latin_hypercube(rng, count, dims):
+        """split each dimension of [0, 1) into 'count' intervals and take one
+        point in each interval, pairing the intervals of different dimensions
+        at random"""
+        u = (np.arange(count)[:, None] + rng.random((count, dims))) / count
+        for j in range(dims):
+            u[:, j] = rng.permutation(u[:, j])
+        return u
+
+    @staticmethod
+    def halton(rng, count, dims):
+        """the first 'count' points of the Halton sequence in [0, 1) ^ dims,
+        with a random shift of each dimension"""
+        primes = []
+        p = 2
+        while len(primes) < dims:
+            if all(p % q for q in primes):
+                primes.append(p)
+            p += 1
+
+        u = np.zeros((count, dims))
+        for j, p in enumerate(primes):
+            i = np.arange(count)
+            f = 1.0
+            while i.any():
+                f /= p
+                u[:, j] += f * (i % p)
+                i //= p
+        return (u + rng.random(dims)) % 1.0
+
+    @staticmethod
+    def discretize(obj, discretization_method, count, rng=None, u=None):
+        """discretizes a continuous variable into 'count' descrete options.
+        All options are drawn at once from the random generator, which is
+        seeded from the OS if not given. If the uniform samples u are given,
+        the options are u mapped to the distribution instead."""
         discretization_methods = {
             'uniform': DiscretizationFn(DecisionParser.random_uniform, ['min', 'max'], ['exclusive']), 
             'lognormal': DiscretizationFn(DecisionParser.random_lognormal, [], ['mean', 'std_dev', 'exclusive', 'range']), 
@@ -140,38 +317,50 @@ class DecisionParser(BaseParser):
                 continue
 
         param_values.append(optional_params)
-        fn = method.function
-        samples = []
-        for i in range(count):
-            samples.append(fn(*param_values))
-
-        return samples
+        rng = rng if rng is not None else np.random.default_rng()
+        if u is not None:
+            samples = method.function(rng, len(u), *param_values, u=u)
+        else:
+            samples = method.function(rng, count, *param_values)
+        return [float(x) for x in samples]
 
     @staticmethod
     def _read_discrete_options(s, allow_empty_list=False):
-        """reads an option, converting all continuous values into discrete ones"""
+        """reads an option, converting all continuous values into discrete ones.
+        If there are ranges, we return an OptionList that computes the values
+        of the ranges on demand"""
         generated_res = []
+        parts = []
         res = DecisionParser._read_options(s, allow_empty_list)
         for val in res:
-            if isinstance(val, dict):
+            kind = [k for k in OptionRange.kinds if isinstance(val, dict) and k in val]
+            if kind and 'sample' not in val:
+                parts.extend([generated_res, OptionRange(kind[0], val[kind[0]])])
+                generated_res = []
+            elif isinstance(val, dict):
                 try:
                     sampling_method = str(DecisionParser._read_json_safe(val, "sample"))
                     count = int(DecisionParser._read_json_safe(val, "count"))
+                    # each option has its own generator, so the samples do
+                    # not depend on the other options or on global state
                     try:
                         seed = int(DecisionParser._read_json_safe(val, "seed"))
-                        random.seed(seed)
+                        rng = np.random.default_rng(seed)
                     except (ParseError, TypeError):
-                        pass
+                        rng = np.random.default_rng()
 
-                    generated_res.extend(DecisionParser.discretize(val, sampling_method, count))
+                    generated_res.extend(DecisionParser.discretize(val, sampling_method, count, rng))
                 except (ParseError, TypeError):
                     raise ParseError('expected "sample" and "count" to be defined as string and int respectively in object:\n' + str(s))
             elif isinstance(val, list):
-                generated_res.append(DecisionParser._read_discrete_options(val, True))
+                # the value of a single option, so we expand the ranges
+                generated_res.append(list(DecisionParser._read_discrete_options(val, True)))
             else:
                 generated_res.append(val)
 
-        return generated_res
+        if len(parts) == 0:
+            return generated_res
+        return OptionList([p for p in parts + [generated_res] if len(p)])
 
     @staticmethod
     def _read_options(s, allow_empty_list=False):
@@ -207,19 +396,76 @@ class DecisionParser(BaseParser):
             if w in self.decisions:
                 raise ParseError('Duplicate variable/block name "{}"'.format(w))
 
+    def _read_joint(self, spec, dec_spec):
+        """
+        Read the groups of continuous decisions that are sampled jointly, and
+        draw 'count' points of each group in the unit hypercube. The decisions
+        in a group are linked, so the group adds 'count' universes instead of
+        a cross product.
+        :return: a dict of decision name -> its coordinate of the points
+        """
+        joint_methods = {
+            'lhs': DecisionParser.latin_hypercube,
+            'halton': DecisionParser.halton
+        }
+
+        # decisions with a single option that is sampled
+        sampled = []
+        for d in dec_spec:
+            opts = d.get('options')
+            if isinstance(opts, list) and len(opts) == 1 and \
+                    isinstance(opts[0], dict) and 'sample' in opts[0]:
+                sampled.append(d.get('var'))
+
+        res = {}
+        joint_spec = spec['joint'] if 'joint' in spec else []
+        for j in joint_spec:
+            method = str(DecisionParser._read_json_safe(j, 'method'))
+            if method not in joint_methods:
+                raise ParseError('The joint sampling method "{}" is not supported'.format(method))
+            count = DecisionParser._read_json_safe(j, 'count')
+            if not isinstance(count, int) or count < 1:
+                raise ParseError('Expected "count" to be a positive int in:\n{}'.format(j))
+
+            # by default, sample all continuous decisions not in a group yet
+            decs = j['decisions'] if 'decisions' in j else \
+                [v for v in sampled if v not in res]
+            if len(decs) == 0:
+                raise ParseError('No decisions to sample jointly in:\n{}'.format(j))
+            for v in decs:
+                if v not in sampled:
+                    msg = 'Cannot sample "{}" jointly, it must have exactly one option with "sample"'
+                    raise ParseError(msg.format(v))
+                if v in res or decs.count(v) > 1:
+                    raise ParseError('Decision "{}" is sampled jointly more than once'.format(v))
+
+            rng = np.random.default_rng(j['seed'] if 'seed' in j else None)
+            u = joint_methods[method](rng, count, len(decs))
+            for i, v in enumerate(decs):
+                res[v] = u[:, i]
+            self.joint_links.append(list(decs))
+
+        return res
+
     def read_decisions(self, spec):
         """
         Read decisions from the JSON spec.
         :return:
         """
         dec_spec = spec['decisions'] if 'decisions' in spec else []
+        joint = self._read_joint(spec, dec_spec)
         for d in dec_spec:
             desc = d['desc'] if 'desc' in d else 'Decision {}'.format(d['var'])
 
             var = self._check_type(DecisionParser._read_json_safe(d, 'var'),
                                    DecisionParser._is_id_token, 'id')
             value = DecisionParser._read_options(DecisionParser._read_json_safe(d, 'options'))
-            discrete_value = DecisionParser._read_discrete_options(DecisionParser._read_json_safe(d, 'options'))
+            if var in joint:
+                # the group decides the number of options and the seed
+                opt = value[0]
+                discrete_value = DecisionParser.discretize(opt, str(opt['sample']), len(joint[var]), u=joint[var])
+            else:
+                discrete_value = DecisionParser._read_discrete_options(DecisionParser._read_json_safe(d, 'options'))
 
             # check if two variables have the same name
             if var in self.decisions:
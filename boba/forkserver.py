@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+"""
+A fork server to run python universes without paying for the interpreter
+startup and the imports in every universe.
+
+The server is a long-lived python process that imports the preloaded modules
+once, then forks a fresh child for each universe and runs the script in the
+child as __main__. A universe still runs in its own process, so it can't
+change the state of the server or of other universes.
+
+The client sends a request over a unix socket, together with the write end of
+a pipe for stdout and stderr. The server replies with the pid of the child
+once it forks, and with the exit code once the child exits.
+"""
+
+import array
+import asyncio
+import importlib
+import json
+import os
+import runpy
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+
+# the largest request we read, including the path of the script
+MAX_MESSAGE = 1 << 16
+
+
+def _send_request(sock, msg, fds):
+    """ Send a request and the file descriptors over a unix socket. """
+    data = json.dumps(msg).encode('utf-8') + b'\n'
+    anc = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+    sock.sendmsg([data], anc)
+
+
+def _recv_request(sock):
+    """ Receive a request and the file descriptors from a unix socket. """
+    fds = array.array('i')
+    size = socket.CMSG_SPACE(2 * fds.itemsize)
+    data, anc, _, _ = sock.recvmsg(MAX_MESSAGE, size)
+    for level, kind, d in anc:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(d[:len(d) - (len(d) % fds.itemsize)])
+
+    # the rest of the message, if it arrives in pieces
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(MAX_MESSAGE)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode('utf-8')), list(fds)
+
+
+def _get_exit_code(status):
+    """ Convert the status from waitpid to a return code like Popen. """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _run_child(msg, fds):
+    """ Run a universe in the forked child. Never returns. """
+    code = 0
+    try:
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in fds:
+            os.close(fd)
+        os.chdir(msg['cwd'])
+
+        # act like "python script", as far as the script can tell
+        script = msg['script']
+        sys.argv = [script]
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+
+        # python reseeds random after a fork, but numpy would draw the same
+        # numbers in every universe
+        if 'numpy' in sys.modules:
+            sys.modules['numpy'].random.seed()
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def serve(path, preload):
+    """
+    Run the server until the client closes our stdin.
+
+    :param path: the path of the unix socket to listen on.
+    :param preload: a list of modules to import, or python scripts to run.
+    """
+    for p in preload:
+        if p.endswith('.py'):
+            runpy.run_path(p)
+        else:
+            importlib.import_module(p)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+
+    # wake up select when a child exits
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda *args: None)
+
+    print('ready', flush=True)
+    stdin = sys.stdin.fileno()
+    children = {}
+    while True:
+        ready, _, _ = select.select([listener, wake_r, stdin], [], [])
+
+        if stdin in ready and not os.read(stdin, 1024):
+            # the client is gone
+            break
+
+        if wake_r in ready:
+            os.read(wake_r, 1024)
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                conn = children.pop(pid, None)
+                if conn is not None:
+                    try:
+                        conn.sendall('{}\n'.format(_get_exit_code(status))
+                                     .encode('utf-8'))
+                    except OSError:
+                        pass
+                    conn.close()
+
+        if listener in ready:
+            conn, _ = listener.accept()
+            try:
+                msg, fds = _recv_request(conn)
+            except (OSError, ValueError):
+                conn.close()
+                continue
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for f in [listener, conn] + list(children.values()):
+                    f.close()
+                os.close(wake_r)
+                os.close(wake_w)
+                _run_child(msg, fds)
+
+            for fd in fds:
+                os.close(fd)
+            conn.sendall('{}\n'.format(pid).encode('utf-8'))
+            children[pid] = conn
+
+
+async def _open_reader(fd):
+    """ Wrap the read end of a pipe in an asyncio StreamReader. """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    await loop.connect_read_pipe(lambda: protocol, os.fdopen(fd, 'rb', 0))
+    return reader
+
+
+class ForkedProcess:
+    """
+    A universe that the fork server runs. It has the part of the Process
+    interface of asyncio.create_subprocess_exec that we use.
+    """
+
+    def __init__(self, pid, stdout, stderr, reader, writer):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self._reader = reader
+        self._writer = writer
+
+    async def wait(self):
+        if self.returncode is None:
+            line = await self._reader.readline()
+            # the server is gone, so we do not know how the child exited
+            self.returncode = int(line) if line else -1
+            self._writer.close()
+        return self.returncode
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+
+
+class ForkServer:
+    """ The client of a fork server, which starts and stops the server. """
+
+    def __init__(self, preload=None):
+        """
+        :param preload: a list of modules to import, or python scripts to run,
+            in the server.
+        """
+        self.preload = preload or []
+        self.process = None
+        self.folder = None
+        self.path = None
+
+    async def start(self, cwd):
+        """
+        Start the server and wait until it is ready.
+
+        :param cwd: the working directory of the server, where it looks for
+            the modules to preload.
+        :raise RuntimeError: if the server fails to start, for example when a
+            module to preload can't be imported.
+        """
+        self.folder = tempfile.mkdtemp(prefix='boba-')
+        self.path = os.path.join(self.folder, 'fork.sock')
+
+        # the server imports boba from where we are, but does not leave boba
+        # on the path of the universes
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = ('import sys; sys.path.insert(0, {!r}); '
+                'from boba.forkserver import serve; del sys.path[0]; '
+                'serve(sys.argv[1], sys.argv[2:])').format(root)
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', code, self.path, *self.preload, cwd=cwd,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+
+        line = await self.process.stdout.readline()
+        if line != b'ready\n':
+            err = (await self.process.stderr.read()).decode('utf-8')
+            await self.stop()
+            raise RuntimeError('Cannot start the fork server:\n' + err)
+
+    async def stop(self):
+        """ Stop the server and clean up. """
+        if self.process is not None:
+            if self.process.returncode is None:
+                self.process.stdin.close()
+                try:
+                    await asyncio.wait_for(self.process.wait(), 5)
+                except asyncio.TimeoutError:
+                    self.process.kill()
+                    await self.process.wait()
+            self.process = None
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+
+    async def run(self, script, cwd):
+        """
+        Run a script in a forked child of the server.
+
+        :param script: the path of the python script.
+        :param cwd: the working directory of the script.
+        :return: a ForkedProcess.
+        """
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            _send_request(sock, {'script': os.path.abspath(script),
+                                 'cwd': os.path.abspath(cwd)},
+                          [out_w, err_w])
+        except OSError:
+            sock.close()
+            os.close(out_r)
+            os.close(err_r)
+            raise
+        finally:
+            # the child has its own copy
+            os.close(out_w)
+            os.close(err_w)
+
+        sock.setblocking(False)
+        reader, writer = await asyncio.open_unix_connection(sock=sock)
+        line = await reader.readline()
+        if not line:
+            writer.close()
+            os.close(out_r)
+            os.close(err_r)
+            raise OSError('The fork server is gone')
+
+        stdout = await _open_reader(out_r)
+        stderr = await _open_reader(err_r)
+        return ForkedProcess(int(line), stdout, stderr, reader, writer)
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run python universes as a tree of processes, so the code that universes share
+runs once.
+
+We parse each universe into its top-level statements, where the statements in
+an "if __name__ == '__main__':" guard count as top-level, and put the
+universes into a prefix tree of statements. A process runs the statements of
+a node in the shared module namespace, and forks a child for each branch, so
+every universe only runs the statements that are unique to it. A universe
+gets the output of the whole prefix in its log, as if it ran alone.
+
+At most "jobs" processes run statements at a time. The processes pass tokens
+through a pipe, like the jobserver of make: a process holds a token while it
+runs statements, gives it back when it waits on its children, and a parent
+takes a token for each child that it forks.
+
+The tree reports the exit code of each universe as a line of "id code" on its
+stdout, after it writes the log files of the universe.
+
+A statement that reads __file__ or sys.argv runs in the process of each
+universe, as their value differs by universe. We can't tell if a function
+from another module reads them, so such a function gets the values of the
+first universe if shared code calls it.
+
+With a checkpoint cache, a process saves the state where universes diverge,
+and a later process that runs the same statements loads the deepest
+checkpoint instead, see checkpoint.py.
+"""
+
+import ast
+import hashlib
+import json
+import os
+import random
+import select
+import shutil
+import sys
+import tempfile
+import traceback
+import types
+
+from .bobarun import open_script_source
+from .checkpoint import CheckpointCache, SKIP
+from .wrangler import DIR_LOG, DIR_SCRIPT, get_universe_id_from_script, \
+    get_universe_log, get_universe_error_log
+
+
+class _Node:
+    """ A statement in the prefix tree. """
+    __slots__ = ['code', 'script', 'children', 'ends', 'parent', 'source',
+                 'redo', 'key']
+
+    def __init__(self, code=None, script=None, parent=None, source='',
+                 redo=False):
+        self.code = code        # the compiled statement
+        self.script = script    # the first script that runs the statement
+        self.children = {}      # key of the next statement -> node
+        self.ends = []          # ids of the universes that end here
+        self.parent = parent
+        self.source = source
+        self.redo = redo        # whether it defines something, see _restore
+        self.key = None
+
+    def get_universes(self):
+        """ Get the ids of all universes in the subtree. """
+        res = list(self.ends)
+        for ch in self.children.values():
+            res += ch.get_universes()
+        return res
+
+    def get_key(self):
+        """ Get a hash of the statements from the root to this node. """
+        chain = []
+        node = self
+        while node is not None and node.key is None:
+            chain.append(node)
+            node = node.parent
+        key = node.key if node is not None else ''
+        for nd in reversed(chain):
+            h = hashlib.sha256(key.encode('utf-8'))
+            h.update(nd.source.encode('utf-8'))
+            nd.key = key = h.hexdigest()
+        return self.key
+
+
+# the statements that we run again to load a checkpoint
+REDO = (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef,
+        ast.ClassDef)
+
+# the names that differ by universe, see _reads_script
+SCRIPT_NAMES = {'__file__', 'argv'}
+
+# the exit code of a process that gave back its token, so its parent knows
+# not to give it back again. Scripts are unlikely to exit with it
+EXIT_RELEASED = 120
+
+
+def _is_main_guard(node):
+    """ Whether the statement is "if __name__ == '__main__':" """
+    if not isinstance(node, ast.If) or node.orelse:
+        return False
+    t = node.test
+    return isinstance(t, ast.Compare) and len(t.ops) == 1 and \
+        isinstance(t.ops[0], ast.Eq) and isinstance(t.left, ast.Name) and \
+        t.left.id == '__name__' and isinstance(t.comparators[0], ast.Constant) \
+        and t.comparators[0].value == '__main__'
+
+
+def _reads_script(node):
+    """ Whether the statement reads __file__ or sys.argv. """
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name) and n.id in SCRIPT_NAMES or \
+                isinstance(n, ast.Attribute) and n.attr in SCRIPT_NAMES or \
+                isinstance(n, ast.Constant) and n.value in SCRIPT_NAMES:
+            return True
+    return False
+
+
+def get_statements(code, filename='<string>'):
+    """
+    Split a script into top-level statements, where the body of the main
+    guard also counts as top-level.
+
+    :return: a list of (key, statement), where the key identifies the
+        statement by its position and source, and also by the file name if
+        the statement reads __file__ or sys.argv.
+    :raise SyntaxError: if the script is not valid python.
+    """
+    tree = ast.parse(code, filename)
+    body = []
+    for st in tree.body:
+        body += st.body if _is_main_guard(st) else [st]
+    res = []
+    for st in body:
+        key = (st.lineno, st.col_offset, ast.get_source_segment(code, st))
+        if _reads_script(st):
+            key += (filename,)
+        res.append((key, st))
+    return res
+
+
+def build_tree(scripts):
+    """
+    Put the universes into a prefix tree of statements.
+
+    :param scripts: a list of (universe id, path of the script, code).
+    :return: the root, and a list of (universe id, message) that we can't
+        parse.
+    """
+    root = _Node()
+    errors = []
+    for uid, fn, code in scripts:
+        try:
+            statements = get_statements(code, fn)
+        except SyntaxError as e:
+            errors.append((uid, ''.join(
+                traceback.format_exception_only(type(e), e))))
+            continue
+
+        node = root
+        for key, st in statements:
+            if key not in node.children:
+                mod = ast.Module(body=[st], type_ignores=[])
+                node.children[key] = _Node(
+                    compile(mod, fn, 'exec'), fn, node,
+                    '\n'.join(key[2:]), isinstance(st, REDO))
+            node = node.children[key]
+        node.ends.append(uid)
+    return root, errors
+
+
+def _flush():
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+class _Tree:
+    """ The state that all processes of the tree share. """
+
+    def __init__(self, folder, jobs, result_fd, cache=None):
+        self.folder = folder
+        self.cache = cache
+        # the processes run in the folder of the scripts
+        self.dir_log = os.path.abspath(os.path.join(folder, DIR_LOG))
+        self.tmp = tempfile.mkdtemp(prefix='boba-')
+        self.result_fd = result_fd
+        self.tokens_r, self.tokens_w = os.pipe()
+        os.write(self.tokens_w, b'x' * jobs)
+        os.set_blocking(self.tokens_r, False)
+        self.holding = False  # whether this process holds a token
+
+    def acquire(self, pids=None):
+        """ Take a token. While we wait, reap the children in pids that
+        exit, as they might not give back their token. """
+        while True:
+            try:
+                os.read(self.tokens_r, 1)
+                break
+            except BlockingIOError:
+                select.select([self.tokens_r], [], [], 0.1 if pids else None)
+                if pids:
+                    self.reap(pids, os.WNOHANG)
+        self.holding = True
+
+    def release(self):
+        if self.holding:
+            os.write(self.tokens_w, b'x')
+            self.holding = False
+
+    def reap(self, pids, flags=0):
+        """ Wait on the children, remove those that exited from pids, and
+        give back the token of a child that did not. """
+        for pid in list(pids):
+            done, status = os.waitpid(pid, flags)
+            if done == 0:
+                continue
+            pids.remove(pid)
+            if os.WIFSIGNALED(status) or \
+                    os.WEXITSTATUS(status) != EXIT_RELEASED:
+                os.write(self.tokens_w, b'x')
+
+    def exit(self):
+        """ End the process, and tell the parent if we still hold the
+        token. """
+        os._exit(1 if self.holding else EXIT_RELEASED)
+
+    def open_output(self):
+        """ Send stdout and stderr to new files, and return their paths. """
+        _flush()
+        res = []
+        for fd in [1, 2]:
+            f, path = tempfile.mkstemp(dir=self.tmp)
+            os.dup2(f, fd)
+            os.close(f)
+            res.append(path)
+        return res
+
+    @staticmethod
+    def read_output(outputs):
+        """ Read what the processes wrote, as [stdout, stderr] bytes. """
+        _flush()
+        res = []
+        for i in range(2):
+            data = b''
+            for out in outputs:
+                with open(out[i], 'rb') as f:
+                    data += f.read()
+            res.append(data)
+        return res
+
+    def report(self, uid, rc, outputs, message=''):
+        """ Write the logs of a universe, and report its exit code. """
+        logs = self.read_output(outputs)
+        logs[1] += message.encode('utf-8')
+
+        with open(os.path.join(self.dir_log, get_universe_log(uid)), 'wb') as f:
+            f.write(logs[0])
+        if logs[1]:
+            fn = os.path.join(self.dir_log, get_universe_error_log(uid))
+            with open(fn, 'wb') as f:
+                f.write(logs[1])
+        os.write(self.result_fd, '{} {}\n'.format(uid, rc).encode('utf-8'))
+
+    def walk(self, node, env, outputs):
+        """ Run the subtree from the node in this process, which holds a
+        token. Never returns. """
+        try:
+            restored = None
+            res = self._restore(node, env) if self.cache is not None else None
+            if res is not None:
+                restored, out = res
+                node = restored
+                outputs = [out, self.open_output()]
+
+            while True:
+                if node.code is not None and node is not restored:
+                    exec(node.code, env)
+                for uid in node.ends:
+                    self.report(uid, 0, outputs)
+                if len(node.children) != 1:
+                    break
+                node = next(iter(node.children.values()))
+
+            # save the state where the universes diverge
+            if self.cache is not None and len(node.children) > 1 and \
+                    node.code is not None and node is not restored:
+                out, err = self.read_output(outputs)
+                self.cache.save(node.get_key(), env, out, err)
+        except SystemExit as e:
+            code = e.code
+            if code is None:
+                code = 0
+            elif not isinstance(code, int):
+                print(code, file=sys.stderr)
+                code = 1
+            self._fail(node, code, outputs)
+        except BaseException as e:
+            # skip the frame of this function
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            self._fail(node, 1, outputs)
+
+        children = list(node.children.values())
+        if not children:
+            self.release()
+            self.exit()
+
+        # wait on the children without a token, so they can run
+        self.release()
+        pids = []
+        state = random.getstate()
+        for ch in children:
+            self.acquire(pids)
+            _flush()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    # python seeds the random module again after a fork
+                    random.setstate(state)
+                    env['__file__'] = ch.script
+                    sys.argv = [ch.script]
+                    self.walk(ch, env, outputs + [self.open_output()])
+                finally:
+                    self.exit()
+            # the child holds the token now
+            self.holding = False
+            pids.append(pid)
+        self.reap(pids)
+        self.exit()
+
+    def _restore(self, node, env):
+        """
+        Load the deepest checkpoint on the statements that the process would
+        run from the node, up to where a universe ends or the tree branches.
+
+        :return: the node of the checkpoint and the paths of its output, or
+            None if there is no checkpoint that we can load.
+        """
+        chain = [node]
+        while not node.ends and len(node.children) == 1:
+            node = next(iter(node.children.values()))
+            chain.append(node)
+
+        for nd in reversed(chain):
+            if nd.code is None:
+                continue
+            entry = self.cache.get(nd.get_key())
+            if entry is None:
+                continue
+
+            # define the functions and classes again, in a clean namespace
+            saved = dict(env)
+            try:
+                env.clear()
+                env.update({k: saved[k] for k in SKIP if k in saved})
+                redo = []
+                p = nd
+                while p is not None:
+                    if p.redo:
+                        redo.append(p.code)
+                    p = p.parent
+                for code in reversed(redo):
+                    exec(code, env)
+                CheckpointCache.restore(entry, env)
+            except Exception:
+                env.clear()
+                env.update(saved)
+                continue
+
+            paths = []
+            for data in [entry['stdout'], entry['stderr']]:
+                f, path = tempfile.mkstemp(dir=self.tmp)
+                with os.fdopen(f, 'wb') as fo:
+                    fo.write(data)
+                paths.append(path)
+            return nd, paths
+        return None
+
+    def _fail(self, node, rc, outputs):
+        """ Report all universes in the subtree as failed. Never returns. """
+        for uid in node.get_universes():
+            self.report(uid, rc, outputs)
+        self.release()
+        self.exit()
+
+
+def run_tree(folder, scripts, jobs=1, cache=None):
+    """
+    Run the universes as a tree of processes.
+
+    :param folder: the multiverse folder.
+    :param scripts: the file names of the universe scripts.
+    :param jobs: the number of processes that run statements at a time.
+    :param cache: a CheckpointCache, or None.
+    """
+    cwd = os.path.join(folder, DIR_SCRIPT)
+    source = open_script_source(folder)
+    items = []
+    for s in scripts:
+        fn = os.path.join(cwd, s)
+        if os.path.exists(fn) or source is None:
+            with open(fn) as f:
+                code = f.read()
+        else:
+            code = source.render(get_universe_id_from_script(s))
+        items.append((get_universe_id_from_script(s), os.path.abspath(fn),
+                      code))
+
+    root, errors = build_tree(items)
+
+    # keep our stdout for the results, as the universes write to fd 1
+    _flush()
+    tree = _Tree(folder, jobs, os.dup(1), cache)
+    try:
+        if cache is not None:
+            cache.track([tree.tmp])
+
+        for uid, msg in errors:
+            tree.report(uid, 1, [], msg)
+
+        # act like "python script", as far as the scripts can tell
+        os.chdir(cwd)
+        sys.path[0] = os.path.abspath(cwd)
+        sys.argv = [items[0][1]] if items else sys.argv
+        main = types.ModuleType('__main__')
+        main.__file__ = sys.argv[0]
+        sys.modules['__main__'] = main
+        env = main.__dict__
+
+        if root.children or root.ends:
+            tree.acquire()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    tree.walk(root, env, [tree.open_output()])
+                finally:
+                    tree.exit()
+            os.waitpid(pid, 0)
+    finally:
+        shutil.rmtree(tree.tmp, ignore_errors=True)
+
+
+def main():
+    """ Read the arguments from the command line and the scripts, as a json
+    list, from stdin. The optional arguments are the folder of the checkpoint
+    cache and its size in bytes. """
+    folder, jobs = sys.argv[1], int(sys.argv[2])
+    cache = None
+    if len(sys.argv) > 3:
+        cache = CheckpointCache(sys.argv[3], int(sys.argv[4]))
+    scripts = json.load(sys.stdin)
+    sys.stdin.close()
+    run_tree(folder, scripts, jobs, cache)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import math
+from itertools import product
+
+import numpy as np
+
+from .constraintparser import ConstraintParser
+
+# number of rows of the grid we filter at a time, to bound memory
+CHUNK_SIZE = 1 << 18
+
+# largest grid, as the number of rows; we would spend longer filtering a
+# larger cross product than pruning its branches during the enumeration
+MAX_GRID = 1 << 22
+
+# largest truth table of a constraint, as the product of its inputs' options
+MAX_TABLE = 1 << 16
+
+
+class DecisionGrid:
+    """
+    The cross product of the placeholder variables on a code path, as numpy
+    index arrays, which we filter by all constraints at once instead of
+    checking them one branch at a time.
+
+    A constraint only reads a few decisions, so we evaluate its compiled
+    condition once for every combination of the options of its inputs, with
+    the same environment as the enumeration in Parser, where decisions that
+    are bound later are still None. The result is a truth table, and the mask
+    of the constraint over the grid is a lookup into the table with the index
+    arrays of its inputs.
+
+    The grid only works for a code path where no node can be skipped, since a
+    skipped node changes which variables are bound, and where the cross
+    product is not too large. Use DecisionGrid.create, which returns None if
+    the grid does not work for the path.
+    """
+
+    def __init__(self, parser, idx, path):
+        """
+        :param parser: the Parser.
+        :param idx: the index of the code path.
+        :param path: the code path, as a list of (node, chunk).
+        """
+        self.ps = parser
+        self.empty = False
+
+        # link groups that a block on the path has decided
+        decided = {}
+        for nd in parser.paths[idx]:
+            if nd in parser.linked_options:
+                g, k = parser.linked_options[nd]
+                if decided.setdefault(g, k) != k:
+                    self.empty = True
+
+        # the placeholder variables in the order we bind them, and where
+        start = {}
+        self.pos = {}
+        for i, (nd, chunk) in enumerate(path):
+            start.setdefault(nd, i)
+            if chunk.variable and chunk.variable not in self.pos:
+                self.pos[chunk.variable] = i
+        self.variables = list(self.pos.keys())
+
+        # each variable either has an axis of the grid, shared by linked
+        # variables, or an option fixed by a linked block
+        self.shape = []
+        self.axis = {}
+        self.fixed = {}
+        leader = {}
+        for v in self.variables:
+            g = parser.linked_vars.get(v)
+            if g in decided:
+                self.fixed[v] = decided[g]
+            elif g in leader:
+                self.axis[v] = self.axis[leader[g]]
+            else:
+                self.axis[v] = len(self.shape)
+                self.shape.append(parser.dec_parser.get_num_alt_discrete(v))
+                if g is not None:
+                    leader[g] = v
+        if self.size() > MAX_GRID:
+            raise ValueError('The grid is too large')
+
+        # the constraints, as (variable, option index, inputs, table), where
+        # the variable is None for constraints on blocks
+        self.checks = []
+        env = parser._make_env(parser.paths[idx])
+        for v in self.variables:
+            for k in range(parser.dec_parser.get_num_alt_discrete(v)):
+                key = '{}:{}'.format(ConstraintParser.make_index_var(v), k)
+                if key in parser.constraints:
+                    self._add_check(env, key, self.pos[v], v, k)
+        for nd in start:
+            for n in dict.fromkeys([nd, nd.split(':')[0]]):
+                if n in parser.constraints:
+                    self._add_check(env, n, start[nd])
+
+    @staticmethod
+    def create(parser, idx, path):
+        """ Make the grid of a code path, or return None if we can't. """
+        for nd in parser.paths[idx]:
+            for n in [nd, nd.split(':')[0]]:
+                if n in parser.constraints and parser.constraints[n].skip:
+                    return None
+        try:
+            return DecisionGrid(parser, idx, path)
+        except Exception:
+            # the grid or a truth table is too large, or a condition fails on a
+            # combination that we might never reach, so let the enumeration
+            # decide
+            return None
+
+    def _add_check(self, env, key, before, variable=None, k=-1):
+        """ Evaluate a constraint on all options of the inputs that are bound
+        before the given chunk. """
+        ps = self.ps
+        inputs = sorted(set([x for x in ps.constraints[key].inputs
+                             if x in self.pos and self.pos[x] < before]))
+        sizes = [ps.dec_parser.get_num_alt_discrete(x) for x in inputs]
+        if math.prod(sizes) > MAX_TABLE:
+            raise ValueError('The truth table is too large')
+
+        table = np.zeros(sizes, dtype=bool)
+        for ks in product(*[range(n) for n in sizes]):
+            for x, kx in zip(inputs, ks):
+                ps._bind(env, x, str(ps.dec_parser.get_alt_discrete(x, kx)),
+                         kx)
+            try:
+                table[ks] = bool(ps._eval_constraint(env, key))
+            finally:
+                for x in inputs:
+                    ps._unbind(env, x)
+        self.checks.append((variable, k, inputs, table))
+
+    def size(self):
+        return math.prod(self.shape)
+
+    def rows(self):
+        """
+        Iterate over the rows that satisfy all constraints, in the order that
+        Parser enumerates the universes.
+
+        :return: a generator of tuples with the option index of each
+            variable, in the order of self.variables.
+        """
+        if self.empty:
+            return
+        total = self.size()
+        for s in range(0, total, CHUNK_SIZE):
+            n = min(CHUNK_SIZE, total - s)
+            coords = np.unravel_index(np.arange(s, s + n), self.shape) \
+                if self.shape else ()
+            index = {}
+            for v in self.variables:
+                if v in self.fixed:
+                    index[v] = np.full(n, self.fixed[v])
+                else:
+                    index[v] = coords[self.axis[v]]
+
+            mask = np.ones(n, dtype=bool)
+            for v, k, inputs, table in self.checks:
+                ok = table[tuple([index[x] for x in inputs])]
+                if v is not None:
+                    ok = ok | (index[v] != k)
+                mask &= ok
+
+            if not self.variables:
+                yield from [()] * int(mask.sum())
+                continue
+            cols = [index[v][mask].tolist() for v in self.variables]
+            yield from zip(*cols)
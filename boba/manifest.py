@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+
+FILE_MANIFEST = 'manifest.json'
+
+
+class Manifest:
+    """
+    A compact description of the multiverse, from which we can render any
+    universe script on demand.
+
+    blocks: the chunks of each block, as a list of [variable, code].
+    paths: the code paths, as lists of block ids.
+    decisions: names of the placeholder variables.
+    options: the options of each placeholder variable, as strings.
+    outputs: the output code appended to each script, where the row of the
+        universe in summary.csv is the reserved variable {{_n}}.
+    universes: the decision vector of each universe, as [path, indices,
+        skipped], where indices holds the chosen option of each placeholder
+        variable (or -1) and skipped holds the positions of skipped nodes.
+    ids: the id of each universe, if the universes are a sample of the
+        multiverse, or None if they are numbered from 1.
+    """
+    def __init__(self, blocks=None, paths=None, decisions=None, options=None,
+                 outputs='', universes=None, ids=None):
+        self.blocks = blocks or {}
+        self.paths = paths or []
+        self.decisions = decisions or []
+        self.options = options or {}
+        self.outputs = outputs
+        self.universes = universes or []
+        self.ids = ids
+
+        self._lookup = {d: i for i, d in enumerate(self.decisions)}
+
+    @staticmethod
+    def read(folder):
+        """ Read the manifest in the multiverse folder. """
+        with open(os.path.join(folder, FILE_MANIFEST)) as f:
+            return Manifest(**json.load(f))
+
+    def write(self, folder):
+        """ Write the manifest to the multiverse folder. The universes can be
+        any iterable, and are streamed to the file one by one. """
+        res = {'blocks': self.blocks, 'paths': self.paths,
+               'decisions': self.decisions, 'options': self.options,
+               'outputs': self.outputs}
+        if self.ids is not None:
+            res['ids'] = list(self.ids)
+        with open(os.path.join(folder, FILE_MANIFEST), 'w') as f:
+            f.write(json.dumps(res)[:-1] + ', "universes": [')
+            for i, u in enumerate(self.universes):
+                f.write((', ' if i else '') + json.dumps(u))
+            f.write(']}')
+
+    def render(self, universe_id):
+        """ Render the script of a universe. """
+        row = universe_id if self.ids is None else \
+            self.ids.index(universe_id) + 1
+        path, indices, skipped = self.universes[row - 1]
+        skipped = set(skipped)
+
+        code = []
+        for pos, nd in enumerate(self.paths[path]):
+            if pos in skipped:
+                continue
+            for variable, chunk in self.blocks[nd]:
+                code.append(chunk)
+                if variable:
+                    k = indices[self._lookup[variable]]
+                    code.append(self.options[variable][k])
+
+        code = ''.join(code).replace('{{_n}}', str(universe_id))
+        return code + self.outputs.replace('{{_n}}', str(row))
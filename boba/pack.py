@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import struct
+import zlib
+
+FILE_PACK = 'universes.pack'
+
+# the pack file holds the scripts back to back, followed by an index with the
+# offset and length of the script of each universe, and a fixed-size footer
+MAGIC = b'BOBAPACK'
+ENTRY = struct.Struct('<QI')
+FOOTER = struct.Struct('<QQB8s')
+
+
+class PackWriter:
+    """ Write all universe scripts into a single pack file. """
+
+    def __init__(self, path, compress=False):
+        self.compress = compress
+        self.index = []
+        self.f = open(path, 'wb')
+
+    def write(self, code):
+        """
+        Append the script of the next universe.
+
+        :return: the number of bytes written.
+        """
+        data = code.encode('utf-8')
+        if self.compress:
+            data = zlib.compress(data)
+        self.index.append((self.f.tell(), len(data)))
+        self.f.write(data)
+        return len(data)
+
+    def link(self, universe_id):
+        """ Let the next universe share the script of an earlier universe. """
+        self.index.append(self.index[universe_id - 1])
+
+    def close(self, fsync=False):
+        """ Write the index and the footer, then close the file. """
+        offset = self.f.tell()
+        for entry in self.index:
+            self.f.write(ENTRY.pack(*entry))
+        self.f.write(FOOTER.pack(offset, len(self.index), self.compress,
+                                 MAGIC))
+        if fsync:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.f.close()
+
+
+class PackReader:
+    """ Read universe scripts from a pack file. """
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        try:
+            self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # mmap is not available for this file, so read it into memory
+            self.buf = self.f.read()
+
+        if len(self.buf) < FOOTER.size:
+            raise ValueError('{} is not a pack file'.format(path))
+        self.index_offset, self.size, self.compress, magic = \
+            FOOTER.unpack_from(self.buf, len(self.buf) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError('{} is not a pack file'.format(path))
+
+    def render(self, universe_id):
+        """ Get the script of a universe. """
+        if not 0 < universe_id <= self.size:
+            raise IndexError('Universe {} is not in the pack'.format(
+                universe_id))
+
+        pos = self.index_offset + (universe_id - 1) * ENTRY.size
+        offset, length = ENTRY.unpack_from(self.buf, pos)
+        data = self.buf[offset:offset + length]
+        if self.compress:
+            data = zlib.decompress(data)
+        return data.decode('utf-8')
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.f.close()
@@ -2,6 +2,9 @@
 
 import json
 import os
+import time
+import multiprocessing as mp
+from array import array
 from textwrap import wrap
 from dataclasses import dataclass, field
 from typing import List
@@ -13,10 +16,18 @@ from .graphanalyzer import GraphAnalyzer, InvalidGraphError
 from .decisionparser import DecisionParser
 from .constraintparser import ConstraintParser
 from .lang import LangError, Lang
-from .wrangler import Wrangler
+from .wrangler import Wrangler, get_universe_id_from_script
+from .manifest import Manifest
+from .counter import Counter
+from .covering import CoveringArray
+from .grid import DecisionGrid
+from .universeindex import UniverseIndex
 from .adg import ADG
 import boba.util as util
 
+# number of universes shown in the summary after compiling
+PREVIEW_ROWS = 10
+
 
 @dataclass
 class History:
@@ -52,8 +63,14 @@ class Parser:
         self.out = os.path.join(out, 'multiverse/')
 
         self.paths = []
-        self.history = []
+        self.preview = []         # history of the first few universes
+        self.choices = array('i')  # compact choices of all universes
+        self.scripts = array('I')  # the universe whose script each one runs
+        self.ids = None           # ids of the universes, if only a subset
         self.constraints = {}
+        self.linked_vars = {}     # linked variable -> link group
+        self.linked_options = {}  # linked block option -> (link group, index)
+        self.elapsed = 0
 
         # init parser class
         self.code_parser = CodeParser()
@@ -155,8 +172,13 @@ class Parser:
             # expand the graph with options
             nodes, edges = gp.replace_graph(self.code_parser.get_decisions())
 
-            # analyze the graph to get paths
-            self.paths = GraphAnalyzer(nodes, edges).analyze()
+            # analyze the graph to get paths. The graph is a set of edges, so
+            # we sort the paths by the order of the blocks in the template,
+            # which keeps the universe ids the same from one run to the next
+            pos = {b: i for i, b in enumerate(self.code_parser.blocks)}
+            self.paths = sorted(
+                GraphAnalyzer(nodes, edges).analyze(),
+                key=lambda p: [(pos.get(nd, len(pos)), nd) for nd in p])
             # an ugly way to handle the artificial _start node
             if '_start' in self.code_parser.blocks and '_start' not in nodes:
                 for p in self.paths:
@@ -180,30 +202,74 @@ class Parser:
             self.adg.set_constraints(cp.links, cp.procedural)
         except ParseError as e:
             self._throw_spec_error(e.args[0])
+        self._parse_links(cp.links)
+
+    def _parse_links(self, links):
+        """ Put linked decisions into groups. All decisions in a group take the
+        option with the same index, and links that share a decision are
+        merged into one group. """
+        group = {}
+        for g, link in enumerate(links):
+            merged = {group[l] for l in link if l in group}
+            for l in group:
+                if group[l] in merged:
+                    group[l] = g
+            for l in link:
+                group[l] = g
+
+        bl_decs = self.code_parser.get_decisions()
+        for l, g in group.items():
+            if l in bl_decs:
+                for i, opt in enumerate(bl_decs[l]):
+                    self.linked_options[opt] = (g, i)
+            else:
+                self.linked_vars[l] = g
 
-    def _eval_constraint(self, history, con):
-        """ See if the constraint holds true given the choices made. """
-        con = self.constraints[con].condition
-        paths, bdecs = self._nice_path(self._get_skipped_path(history))
-
-        # A dict where the key is each parameter and the value is the chosen
-        # option. For ordinary blocks, key and value are the same.
-        res = {}
+    def _make_env(self, path):
+        """
+        Make the environment to evaluate constraints on a code path, before
+        any choice is made. It is a dict where the key is each parameter and
+        the value is the chosen option. For ordinary blocks, key and value are
+        the same. The enumeration updates it in place as we bind variables and
+        skip nodes.
+        """
+        paths, bdecs = self._nice_path(path)
+        env = {}
         for p in paths:
-            res[p] = p
+            env[p] = p
         for d in bdecs:
             # note that block parameter will override with the actual option
-            res[d.parameter] = d.option
+            env[d.parameter] = d.option
         for d in self.dec_parser.get_decs():
             # unmade decisions will have value None and index -1
-            res[d] = None
-            res[ConstraintParser.make_index_var(d)] = -1
-        for d in history.decisions:
-            res[d.parameter] = d.option
-            res[ConstraintParser.make_index_var(d.parameter)] = d.idx
+            env[d] = None
+            env[ConstraintParser.make_index_var(d)] = -1
+        return env
+
+    @staticmethod
+    def _skip_node(env, nd):
+        """ Remove a skipped node from the environment. """
+        env.pop(nd.split(':')[0], None)
+
+    @staticmethod
+    def _unskip_node(env, nd):
+        """ Put a node back into the environment. """
+        name, _, opt = nd.partition(':')
+        env[name] = opt if opt else name
+
+    @staticmethod
+    def _bind(env, variable, option, k):
+        env[variable] = option
+        env[ConstraintParser.make_index_var(variable)] = k
+
+    @staticmethod
+    def _unbind(env, variable):
+        env[variable] = None
+        env[ConstraintParser.make_index_var(variable)] = -1
 
-        # now evaluate
-        return eval(con, res)
+    def _eval_constraint(self, env, con):
+        """ See if the constraint holds true given the choices made. """
+        return eval(self.constraints[con].code, env)
 
     def _get_code_paths(self):
         """ Convert paths of block to paths of code chunk """
@@ -220,92 +286,569 @@ class Parser:
 
         return res
 
-    def _code_gen_recur(self, path, i, code, history):
+    @staticmethod
+    def _node_spans(path):
+        """ Map the index of the first chunk of each node in a code path to the
+        index right after its last chunk. """
+        spans = {}
+        start = 0
+        for i in range(1, len(path) + 1):
+            if i == len(path) or path[i][0] != path[start][0]:
+                spans[start] = i
+                start = i
+        return spans
+
+    def _check_block(self, env, nd, hoisted=()):
         """
-        Generate code recursively.
+        Evaluate the constraints attached to a node, when we enter the node.
 
-        :param path: the code path we're on.
-        :param i: the index of the current node in the code path.
-        :param code: the generated code so far.
-        :param history: record the choices made.
+        :param env: the environment with the choices made so far.
+        :param nd: the node, which can be a block or a block option.
+        :param hoisted: constraints that are already evaluated earlier.
+        :return: True to keep the node, False to skip it, or None if the
+            universe is invalid.
+        """
+        for n in dict.fromkeys([nd, nd.split(':')[0]]):
+            if n in hoisted:
+                continue
+            if n in self.constraints and not self._eval_constraint(env, n):
+                return False if self.constraints[n].skip else None
+        return True
+
+    def _check_option(self, env, variable, k, mask=None):
+        """ Check if the k-th option of a placeholder variable is allowed. The
+        mask holds the result of constraints that are evaluated earlier. """
+        # always check by index, rather than actual value
+        v = '{}:{}'.format(ConstraintParser.make_index_var(variable), k)
+        if v not in self.constraints:
+            return True
+        if mask and v in mask:
+            return mask[v]
+        return self._eval_constraint(env, v)
+
+    def _get_hoist_point(self, con, before, bind, present):
+        """
+        Find the chunk right after which all inputs of a constraint are bound,
+        if they are bound before the given chunk.
+
+        :param con: the constraint.
+        :param before: index of the chunk where the constraint is evaluated.
+        :param bind: variable -> index of the chunk where it is bound, or None
+            if we are not sure.
+        :param present: blocks that are surely on the path.
+        :return: the index of the chunk, -1 for the start of the path, or None
+            if we can't move the constraint.
+        """
+        h = -1
+        for x in con.inputs:
+            if x in self.dec_parser.decisions:
+                if x in bind:
+                    if bind[x] is None:
+                        return None
+                    if bind[x] < before:
+                        h = max(h, bind[x])
+            elif x not in present:
+                return None
+        return h
+
+    def _schedule_constraints(self, idx, path):
+        """
+        Find the earliest point on a code path where we can evaluate each
+        constraint, so we prune an invalid branch before it fans out. A
+        constraint moves to right after its last input is bound, but only if
+        we know for sure where each input is bound, that is, none of them is
+        in a node that might be skipped. The constraints of a placeholder
+        variable become a mask of its allowed options.
+
+        :param idx: the index of the code path.
+        :param path: the code path, as a list of (node, chunk).
+        :return: (checks, prune, hoisted), where checks maps the index of a
+            chunk, or -1 for the start of the path, to the constraints to
+            evaluate right after we bind the variable in that chunk; prune
+            maps the index of a chunk to the option constraints of variables
+            that we know all options of by then; and hoisted is the set of
+            constraints we have moved.
+        """
+        skippable = set()
+        for nd in self.paths[idx]:
+            for n in [nd, nd.split(':')[0]]:
+                if n in self.constraints and self.constraints[n].skip:
+                    skippable.add(nd)
+        present = {nd.split(':')[0] for nd in self.paths[idx]
+                   if nd not in skippable}
+
+        # where each node starts, and where each variable is first bound
+        start = {}
+        bind = {}
+        for i, (nd, chunk) in enumerate(path):
+            start.setdefault(nd, i)
+            v = chunk.variable
+            if v and v not in bind:
+                bind[v] = None if nd in skippable else i
+
+        checks = {}
+        prune = {}
+        hoisted = set()
+
+        # constraints on blocks
+        for nd in start:
+            if nd in skippable:
+                continue
+            for n in dict.fromkeys([nd, nd.split(':')[0]]):
+                if n not in self.constraints:
+                    continue
+                h = self._get_hoist_point(self.constraints[n], start[nd],
+                                          bind, present)
+                if h is not None:
+                    checks.setdefault(h, []).append(n)
+                    hoisted.add(n)
+
+        # constraints on the options of placeholder variables
+        for v, pos in bind.items():
+            if pos is None:
+                continue
+            keys = ['{}:{}'.format(ConstraintParser.make_index_var(v), k)
+                    for k in range(self.dec_parser.get_num_alt_discrete(v))]
+            hs = []
+            for key in keys:
+                if key not in self.constraints:
+                    continue
+                h = self._get_hoist_point(self.constraints[key], pos, bind,
+                                          present)
+                if h is not None:
+                    checks.setdefault(h, []).append(key)
+                    hoisted.add(key)
+                    hs.append(h)
+            if len(hs) == len(keys):
+                prune.setdefault(max(hs), []).append(keys)
+
+        return checks, prune, hoisted
+
+    def _run_checks(self, env, keys, prune, mask):
         """
+        Evaluate the constraints scheduled at a point of a code path.
 
-        if i >= len(path):
-            # write file
-            fn = self.wrangler.write_universe(code)
-
-            # record history
-            history.filename = fn
-            self.history.append(history)
-        else:
-            nd, chunk = path[i]
-
-            # check if the block has constraints attached to it
-            names = [nd, nd.split(':')[0]]
-            for n in names:
-                if n in self.constraints and\
-                        not self._eval_constraint(history, n):
-                    # constraint met
-                    if self.constraints[n].skip:
-                        # skip the node and continue
-                        history.skipped.append(nd)
-                        self._code_gen_recur(path, i + 1, code, history)
-                        return
-                    else:
-                        # abort codegen
-                        return
-
-            if chunk.variable != '':
-                # check if we have already encountered the placeholder variable
-                prev_idx = None
-                for d in history.decisions:
-                    if d.parameter == chunk.variable:
-                        prev_idx = d.idx
-
-                if prev_idx is not None:
+        :return: whether the branch is still valid.
+        """
+        for key in keys or []:
+            ok = self._eval_constraint(env, key)
+            if self.constraints[key].variable:
+                mask[key] = ok
+            elif not ok:
+                return False
+
+        # a variable ahead has no allowed option
+        for keys in prune or []:
+            if not any(mask[key] for key in keys):
+                return False
+        return True
+
+    def _enumerate(self, idx, path, first=None, render=True):
+        """
+        Lazily enumerate all universes on a code path. We walk the path with an
+        explicit stack of branch points instead of recursion, and keep the
+        generated code as a list of chunks that is joined once per universe.
+
+        :param idx: the index of the code path.
+        :param path: the code path, as a list of (node, chunk).
+        :param first: if set, only take this option at the first branch point,
+            so that the path can be split into disjoint shards.
+        :param render: whether to join the code, or to yield None instead.
+        :return: a generator of (code, history) tuples.
+        """
+        # filter the whole cross product at once if we can
+        grid = DecisionGrid.create(self, idx, path) if first is None else None
+        if grid is not None:
+            yield from self._enumerate_grid(idx, path, grid, render)
+            return
+
+        n = len(path)
+        spans = Parser._node_spans(path)
+
+        # state of the current branch
+        pieces = []
+        history = History(idx)
+        decs = history.decisions
+        skipped = history.skipped
+        bound = {}   # placeholder variable -> index of the chosen option
+        env = self._make_env(self.paths[idx])  # for evaluating constraints
+
+        # constraints we evaluate as soon as their inputs are bound
+        checks, prune, hoisted = self._schedule_constraints(idx, path)
+        mask = {}  # results of the hoisted constraints on options
+        if not self._run_checks(env, checks.get(-1), prune.get(-1), mask):
+            return
+
+        # link group -> [index of the option, the variable that chose it].
+        # Linked blocks on the path fix the index of their group up front.
+        group = {}
+        for nd in self.paths[idx]:
+            if nd in self.linked_options:
+                g, k = self.linked_options[nd]
+                if group.setdefault(g, [k, None])[0] != k:
+                    return
+
+        # each branch point is [chunk index, next option, last option, and the
+        # length of pieces, decisions and skipped when we reached it]
+        stack = []
+
+        i = 0
+        while True:
+            # walk forward until we finish a universe, hit an invalid state,
+            # or reach a placeholder variable that we have not decided yet
+            while i < n:
+                nd, chunk = path[i]
+                if i in spans:
+                    keep = self._check_block(env, nd, hoisted)
+                    if keep is None:
+                        break
+                    if not keep:
+                        skipped.append(nd)
+                        Parser._skip_node(env, nd)
+                        i = spans[i]
+                        continue
+
+                v = chunk.variable
+                if v == '':
+                    pieces.append(chunk.code)
+                elif v in bound:
                     # use the previous value
-                    snippet, opt = self.dec_parser.gen_code(chunk.code, chunk.variable, prev_idx)
-                    self._code_gen_recur(path, i+1, code+snippet, history)
+                    snippet, opt = self.dec_parser.gen_code(chunk.code, v, bound[v])
+                    pieces.append(snippet)
                 else:
-                    # expand the decision
-                    num_alt = self.dec_parser.get_num_alt_discrete(chunk.variable)
-                    for k in range(num_alt):
-                        # check if the option has constraints attached to it
-                        # always check by index, rather than actual value
-                        v = ConstraintParser.make_index_var(chunk.variable)
-                        v = '{}:{}'.format(v, k)
-                        if v in self.constraints and \
-                                not self._eval_constraint(history, v):
-                            # constraint met, abort
-                            continue
-
-                        # code gen
-                        snippet, opt = self.dec_parser.gen_code(chunk.code, chunk.variable, k)
-                        decs = [a for a in history.decisions]
-                        decs.append(DecRecord(chunk.variable, opt, k))
-                        self._code_gen_recur(path, i+1, code + snippet,
-                                             History(history.path, '', decs))
+                    k, end = 0, self.dec_parser.get_num_alt_discrete(v)
+                    # a linked decision has already chosen the option
+                    g = self.linked_vars.get(v)
+                    if g in group:
+                        k, end = group[g][0], group[g][0] + 1
+                    if first is not None and len(stack) == 0:
+                        k, end = max(k, first), min(first + 1, end)
+                    stack.append([i, k, end, len(pieces), len(decs), len(skipped)])
+                    break
+                i += 1
             else:
-                code += chunk.code
-                self._code_gen_recur(path, i+1, code, history)
+                # a universe without any branch point belongs to the first shard
+                if first is None or len(stack) or first == 0:
+                    code = ''.join(pieces) if render else None
+                    yield code, History(idx, '', list(decs), list(skipped))
+
+            # backtrack to the latest branch point with options left to try
+            while stack:
+                frame = stack[-1]
+                j, k, end = frame[0], frame[1], frame[2]
+                del pieces[frame[3]:]
+                for d in decs[frame[4]:]:
+                    Parser._unbind(env, d.parameter)
+                del decs[frame[4]:]
+                for nd in skipped[frame[5]:]:
+                    Parser._unskip_node(env, nd)
+                del skipped[frame[5]:]
+
+                v = path[j][1].variable
+                bound.pop(v, None)
+                g = self.linked_vars.get(v)
+                if g in group and group[g][1] == v:
+                    del group[g]
+                while k < end:
+                    if self._check_option(env, v, k, mask):
+                        snippet, opt = self.dec_parser.gen_code(
+                            path[j][1].code, v, k)
+                        Parser._bind(env, v, opt, k)
+                        if self._run_checks(env, checks.get(j), prune.get(j),
+                                            mask):
+                            break
+                        Parser._unbind(env, v)
+                    k += 1
+                if k >= end:
+                    stack.pop()
+                    continue
+
+                frame[1] = k + 1
+                pieces.append(snippet)
+                decs.append(DecRecord(v, opt, k))
+                bound[v] = k
+                if g is not None and g not in group:
+                    group[g] = [k, v]
+                i = j + 1
+                break
+            else:
+                return
+
+    def _enumerate_grid(self, idx, path, grid, render=True):
+        """ Enumerate the universes on a code path from the rows of its
+        decision grid, see _enumerate. """
+        options = [[self.dec_parser.gen_code('', v, k)[1] for k in
+                    range(self.dec_parser.get_num_alt_discrete(v))]
+                   for v in grid.variables]
+
+        # each chunk is its code, or the code for each option of its variable
+        col = {v: i for i, v in enumerate(grid.variables)}
+        template = []
+        for nd, chunk in path:
+            if chunk.variable:
+                i = col[chunk.variable]
+                template.append((i, [chunk.code + o for o in options[i]]))
+            else:
+                template.append((None, chunk.code))
+
+        # like the enumeration, universes share the records of their choices
+        records = [[DecRecord(v, o, k) for k, o in enumerate(options[i])]
+                   for i, v in enumerate(grid.variables)]
 
-    def _code_gen(self):
+        for row in grid.rows():
+            decs = [records[i][k] for i, k in enumerate(row)]
+            code = None
+            if render:
+                code = ''.join([c if i is None else c[row[i]]
+                                for i, c in template])
+            yield code, History(idx, '', decs, [])
+
+    def _get_shards(self, paths):
+        """
+        Split the universes into disjoint shards, in the order we enumerate
+        them. A shard is a code path and the option taken at the first branch
+        point of the path, or None if the path never branches.
+        """
+        shards = []
+        for idx, p in enumerate(paths):
+            alts = [self.dec_parser.get_num_alt_discrete(ch.variable)
+                    for nd, ch in p if ch.variable != '']
+            if len(alts):
+                shards += [(idx, k) for k in range(max(alts))]
+            else:
+                shards.append((idx, None))
+        return shards
+
+    def _code_gen_parallel(self, paths, jobs):
+        """ Generate code in multiple processes. We first count the universes
+        in every shard, so each worker knows where its numbering starts. The
+        counter does not enumerate the universes, so the workers are the only
+        ones to evaluate the constraints on every universe. """
+        shards = self._get_shards(paths)
+        counter = Counter(self)
+        counts = {}
+        sizes = []
+        for idx, k in shards:
+            if idx not in counts:
+                counts[idx] = counter.count_shards(idx)
+            c = counts[idx]
+            sizes.append(sum(c) if k is None else (c[k] if k < len(c) else 0))
+
+        with mp.Pool(jobs, initializer=_init_worker, initargs=(self,)) as pool:
+            offsets = [0]
+            for size in sizes[:-1]:
+                offsets.append(offsets[-1] + size)
+
+            for res in pool.imap(_gen_shard, zip(shards, offsets)):
+                choices, rows, preview, state = res
+                dup = self.wrangler.merge_state(state)
+                for row in rows:
+                    row[0] = dup.get(row[0], row[0])
+                    self.wrangler.write_summary_row(row)
+                    self.scripts.append(get_universe_id_from_script(row[0]))
+                for h in preview[:PREVIEW_ROWS - len(self.preview)]:
+                    h.filename = dup.get(h.filename, h.filename)
+                    self.preview.append(h)
+                self.choices.extend(choices)
+
+        self.wrangler.counter = sum(sizes)
+
+    def _code_gen(self, jobs=1, writers=1, fsync=False, incremental=False,
+                  dedup=False, virtual=False, pack=False, compress=False,
+                  sample=None, seed=None, cover=None):
         paths = self._get_code_paths()
 
         self.wrangler.counter = 0  # keep track of file name
-        self.history = []          # keep track of choices made for each file
+        self.preview = []
+        self.choices = array('i')
+        self.scripts = array('I')
+        self.ids = None
         self.wrangler.col = 2 + len(self.dec_parser.get_decs())\
             + len(self.code_parser.get_decisions())
+        self.wrangler.writers = writers
+        self.wrangler.fsync = fsync
+        self.wrangler.incremental = incremental
+        self.wrangler.dedup = dedup
+        if dedup and self.wrangler.get_output_template():
+            # the output code of a universe writes its own summary row
+            util.print_warn('Cannot deduplicate universes with outputs, '
+                            'writing all universes')
+            self.wrangler.dedup = False
+        self.wrangler.virtual = virtual
+        self.wrangler.pack = pack
+        self.wrangler.compress = compress
+        self.wrangler.files_written = 0
+        self.wrangler.bytes_written = 0
 
         self.wrangler.create_dir()
-        for idx, p in enumerate(paths):
-            self._code_gen_recur(p, 0, '', History(idx))
+        self.wrangler.open_summary(self._get_summary_header())
+        start = time.time()
+        if jobs == 0:
+            jobs = mp.cpu_count()
+        try:
+            # a pack file is written sequentially by a single process
+            if sample is not None:
+                counter = Counter(self)
+                self._code_gen_subset(paths, counter,
+                                      counter.sample(sample, seed))
+            elif cover is not None:
+                counter = Counter(self)
+                self._code_gen_subset(paths, counter,
+                                      CoveringArray(counter, cover).generate())
+            elif jobs > 1 and not pack:
+                self._code_gen_parallel(paths, jobs)
+            else:
+                self._code_gen_serial(paths)
+        finally:
+            self.wrangler.close_summary()
+        self.elapsed = time.time() - start
+        self.wrangler.write_hashes()
+        self._write_index()
+        if virtual:
+            self._write_manifest()
 
         # write the pre and post execs to a file.
         self.wrangler.write_pre_exe()
         self.wrangler.write_post_exe()
         self.wrangler.write_lang()
 
+    def _code_gen_serial(self, paths):
+        """ Generate code in this process. """
+        render = self.wrangler.dedup or not self.wrangler.virtual
+        self.wrangler.open_writer()
+        try:
+            for idx, p in enumerate(paths):
+                for code, history in self._enumerate(idx, p, None, render):
+                    history.filename = self.wrangler.write_universe(code)
+                    self.wrangler.write_summary_row(self._get_summary_row(
+                        history))
+                    self.choices.extend(self._encode_history(history))
+                    self.scripts.append(
+                        get_universe_id_from_script(history.filename))
+                    if len(self.preview) < PREVIEW_ROWS:
+                        self.preview.append(history)
+        finally:
+            self.wrangler.close_writer()
+
+    def _code_gen_subset(self, paths, counter, ids):
+        """
+        Generate some of the universes, such as a random sample, without
+        enumerating the others. Each universe keeps the id it has in the full
+        multiverse.
+
+        :param counter: a Counter of the multiverse.
+        :param ids: a sorted list of universe ids.
+        """
+        self.ids = ids
+        pos = {u: i + 1 for i, u in enumerate(self.ids)}
+
+        self.wrangler.open_writer()
+        try:
+            for u in self.ids:
+                idx, decisions, skipped = counter.unrank(u)
+                code, history = self._render(idx, paths[idx], dict(decisions),
+                                             skipped)
+                history.filename = self.wrangler.write_universe(code, u)
+                self.wrangler.write_summary_row(self._get_summary_row(
+                    history))
+                self.choices.extend(self._encode_history(history))
+                self.scripts.append(
+                    pos[get_universe_id_from_script(history.filename)])
+                if len(self.preview) < PREVIEW_ROWS:
+                    self.preview.append(history)
+        finally:
+            self.wrangler.close_writer()
+
+    def _render(self, idx, path, bound, skipped):
+        """
+        Generate the code of a universe from its choices.
+
+        :param idx: the index of the code path.
+        :param path: the code path, as a list of (node, chunk).
+        :param bound: a dict of placeholder variable -> option index.
+        :param skipped: the skipped nodes.
+        :return: a tuple (code, history).
+        """
+        history = History(idx, '', [], list(skipped))
+        skipped = set(skipped)
+        seen = set()
+        pieces = []
+        for nd, chunk in path:
+            if nd in skipped:
+                continue
+            v = chunk.variable
+            if v == '':
+                pieces.append(chunk.code)
+                continue
+            snippet, opt = self.dec_parser.gen_code(chunk.code, v, bound[v])
+            pieces.append(snippet)
+            if v not in seen:
+                seen.add(v)
+                history.decisions.append(DecRecord(v, opt, bound[v]))
+        return ''.join(pieces), history
+
+    def _encode_history(self, h):
+        """
+        Convert the history of a universe into a flat list of integers: the
+        path, the option index of each placeholder variable (or -1), the
+        number of skipped nodes, and the position of each skipped node.
+        """
+        decs = self.dec_parser.get_decs()
+        indices = [-1] * len(decs)
+        lookup = {d: i for i, d in enumerate(decs)}
+        for d in h.decisions:
+            indices[lookup[d.parameter]] = d.idx
+
+        path = self.paths[h.path]
+        skipped = [path.index(nd) for nd in h.skipped]
+        return [h.path] + indices + [len(skipped)] + skipped
+
+    def _decode_choices(self):
+        """ Iterate over the choices of all universes, as decision vectors of
+        [path, indices, skipped]. """
+        n = len(self.dec_parser.get_decs())
+        i = 0
+        while i < len(self.choices):
+            n_skipped = self.choices[i + n + 1]
+            yield [self.choices[i], self.choices[i + 1:i + n + 1].tolist(),
+                   self.choices[i + n + 2:i + n + 2 + n_skipped].tolist()]
+            i += n + 2 + n_skipped
+
+    def _get_options(self):
+        """ Get the options of each placeholder variable, as strings. """
+        options = {}
+        for d in self.dec_parser.get_decs():
+            num_alt = self.dec_parser.get_num_alt_discrete(d)
+            options[d] = [str(self.dec_parser.get_alt_discrete(d, k))
+                          for k in range(num_alt)]
+        return options
+
+    def _write_index(self):
+        """ Write the index from universe ids to decisions. """
+        decs = self.dec_parser.get_decs()
+        radices = [self.dec_parser.get_num_alt_discrete(d) for d in decs]
+
+        # the variables of each path in the order we bind them, so the codes
+        # increase with the universes
+        lookup = {d: i for i, d in enumerate(decs)}
+        layout = [list(dict.fromkeys([lookup[ch.variable] for _, ch in p
+                                      if ch.variable in lookup]))
+                  for p in self._get_code_paths()]
+        UniverseIndex.write(self.out, self.paths, decs, radices,
+                            self.lang.get_ext(), self._decode_choices(),
+                            self.scripts, self.ids, layout)
+
+    def _write_manifest(self):
+        """ Write the manifest, from which we can render any universe. """
+        blocks = {}
+        for b, bl in self.code_parser.blocks.items():
+            blocks[b] = [[ch.variable, ch.code] for ch in bl.chunks]
+
+        Manifest(blocks, self.paths, self.dec_parser.get_decs(),
+                 self._get_options(),
+                 self.wrangler.get_output_template(), self._decode_choices(),
+                 self.ids).write(self.out)
+
     @staticmethod
     def _nice_path(path):
         """ Convert the path containing block options back to the simpler path
@@ -319,25 +862,28 @@ class Parser:
         sk = set(h.skipped)
         return [nd for nd in self.paths[h.path] if nd not in sk]
 
-    def _write_csv(self):
-        rows = []
-        decs = self.dec_parser.get_decs() +\
+    def _get_summary_decs(self):
+        return self.dec_parser.get_decs() +\
             [b for b in self.code_parser.get_decisions()]
+
+    def _get_summary_header(self):
+        self._summary_decs = self._get_summary_decs()
         ops = self.wrangler.get_outputs()
-        rows.append(['Filename', 'Code Path'] + decs + ops)
-        for h in self.history:
-            paths, bdecs = self._nice_path(self._get_skipped_path(h))
-            row = [h.filename, '->'.join(paths)]
-            mp = {}
-            for d in h.decisions:
-                mp[d.parameter] = d.option
-            for d in bdecs:
-                mp[d.parameter] = d.option
-            for d in decs:
-                value = mp[d] if d in mp else ''
-                row.append(value)
-            rows.append(row)
-        self.wrangler.write_summary(rows)
+        return ['Filename', 'Code Path'] + self._summary_decs + ops
+
+    def _get_summary_row(self, h):
+        """ Get the row of a universe in the summary table. """
+        paths, bdecs = self._nice_path(self._get_skipped_path(h))
+        row = [h.filename, '->'.join(paths)]
+        mp = {}
+        for d in h.decisions:
+            mp[d.parameter] = d.option
+        for d in bdecs:
+            mp[d.parameter] = d.option
+        for d in self._summary_decs:
+            value = mp[d] if d in mp else ''
+            row.append(value)
+        return row
 
     def _write_server_config(self):
         self.adg.create(self.code_parser.blocks)
@@ -361,12 +907,12 @@ class Parser:
 
     def _print_summary(self):
         w = 80
-        max_rows = 10
+        max_rows = PREVIEW_ROWS
 
         print('=' * w)
         print('{:<20}{:<30}{:<30}'.format('Filename', 'Code Path', 'Decisions'))
         print('=' * w)
-        for idx, h in enumerate(self.history):
+        for idx, h in enumerate(self.preview):
             paths, bdecs = self._nice_path(self._get_skipped_path(h))
             path = wrap('->'.join(paths), width=27)
             decs = ['{}={}'.format(d.parameter, d.option) for d in bdecs + h.decisions]
@@ -384,22 +930,98 @@ class Parser:
             print('-' * w)
 
             if idx >= max_rows - 1:
-                print('... {} more rows'.format(len(self.history) - max_rows))
+                more = self.wrangler.counter - max_rows
+                print('... {} more rows'.format(more))
                 break
 
-    def _warn_size(self):
+    def count(self):
+        """ Count the universes exactly, without generating them. """
+        return Counter(self).count()
+
+    def _warn_size(self, confirm=True, limit=None):
+        """
+        Ask before we create a large multiverse.
+
+        :param confirm: whether to ask the user, or to proceed anyway.
+        :param limit: if set, abort when there are more universes than this.
+        """
+        # the cross product is an upper bound, which is much cheaper to get
         cap = self.dec_parser.get_cross_prod_discrete() * len(self.paths)
-        if cap > 1024:
-            rs = input('\nBoba may create as many as {} scripts. '
-                       'Proceed (y/n)?\n'.format(cap))
+        if cap <= 1024 and (limit is None or cap <= limit):
+            return
+
+        size = self.count()
+        if limit is not None and size > limit:
+            self._throw('Boba would create {} scripts, more than the limit of '
+                        '{}.'.format(size, limit))
+        if size > 1024 and confirm:
+            rs = input('\nBoba will create {} scripts. '
+                       'Proceed (y/n)?\n'.format(size))
             if not rs.strip().lower().startswith('y'):
                 print('Aborted.')
                 exit(0)
 
-    def main(self, verbose=True):
-        self._warn_size()
-        self._code_gen()
-        self._write_csv()
+    def _print_write_stats(self):
+        mb = self.wrangler.bytes_written / 1024 / 1024
+        rate = mb / self.elapsed if self.elapsed > 0 else 0
+        print('Wrote {} files ({:.2f} MB) in {:.2f} s, {:.2f} MB/s'.format(
+            self.wrangler.files_written, mb, self.elapsed, rate))
+        if self.wrangler.incremental:
+            print('{} of {} universes have changed'.format(
+                len(self.wrangler.changed), self.wrangler.counter))
+        if self.wrangler.dedup:
+            print('{} of {} universes are distinct'.format(
+                len(self.wrangler.canonical), self.wrangler.counter))
+
+    def main(self, verbose=True, jobs=1, writers=1, fsync=False,
+             incremental=False, dedup=False, virtual=False, pack=False,
+             compress=False, confirm=True, limit=None, sample=None,
+             seed=None, cover=None):
+        # a sample or a covering array is small by design
+        if sample is None and cover is None:
+            self._warn_size(confirm, limit)
+        self._code_gen(jobs, writers, fsync, incremental, dedup, virtual, pack,
+                       compress, sample, seed, cover)
         self._write_server_config()
         if verbose:
             self._print_summary()
+            self._print_write_stats()
+
+
+# the worker functions can't be in the class because multiprocess
+# does not know how to properly serialize functions in classes
+_worker = None
+
+
+def _init_worker(parser):
+    """ Keep a copy of the parser and the code paths in each worker. """
+    global _worker
+    _worker = (parser, parser._get_code_paths())
+
+
+def _gen_shard(args):
+    """ Write the universes in a shard, numbering them from the offset. """
+    ps, paths = _worker
+    (idx, first), offset = args
+    ps.wrangler.counter = offset
+    ps.wrangler.files_written = 0
+    ps.wrangler.bytes_written = 0
+    ps.wrangler.hashes = {}
+    ps.wrangler.changed = []
+    ps.wrangler.canonical = {}
+
+    choices = array('i')
+    rows = []
+    preview = []
+    render = ps.wrangler.dedup or not ps.wrangler.virtual
+    ps.wrangler.open_writer()
+    try:
+        for code, history in ps._enumerate(idx, paths[idx], first, render):
+            history.filename = ps.wrangler.write_universe(code)
+            rows.append(ps._get_summary_row(history))
+            choices.extend(ps._encode_history(history))
+            if len(preview) < PREVIEW_ROWS:
+                preview.append(history)
+    finally:
+        ps.wrangler.close_writer()
+    return choices, rows, preview, ps.wrangler.export_state()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent R processes to run R universes without starting Rscript and loading
+the packages in every universe.
+
+A worker is a long-running R session that loads the packages once, then reads
+universes from stdin, one at a time. It evaluates each universe in a fresh
+environment and marks the end of the universe on stdout and stderr with a
+line that has a random token, followed by the exit status on stdout.
+"""
+
+import asyncio
+import os
+import re
+import shutil
+import tempfile
+import uuid
+
+# the R side of the worker. The arguments are the token and the packages.
+WORKER_R = r'''
+args <- commandArgs(trailingOnly = TRUE)
+token <- args[1]
+for (p in args[-1]) {
+  suppressPackageStartupMessages(library(p, character.only = TRUE))
+}
+
+done <- function(status) {
+  cat("\n", token, " ", status, "\n", sep = "")
+  flush(stdout())
+  cat("\n", token, "\n", sep = "", file = stderr())
+  flush(stderr())
+}
+
+home <- getwd()
+opts <- options()
+con <- file("stdin", open = "r")
+done(0)
+
+repeat {
+  cwd <- readLines(con, n = 1)
+  script <- readLines(con, n = 1)
+  if (length(script) == 0) break
+
+  # a fresh environment and random seed, as in a new R session
+  setwd(cwd)
+  if (exists(".Random.seed", envir = globalenv())) {
+    rm(".Random.seed", envir = globalenv())
+  }
+  env <- new.env(parent = globalenv())
+  env$quit <- env$q <- function(save = "default", status = 0, runLast = TRUE) {
+    stop(structure(class = c("boba_quit", "condition"),
+                   list(message = "quit", call = NULL, status = status)))
+  }
+
+  status <- tryCatch({
+    withCallingHandlers(
+      # print the value of top-level expressions, like Rscript
+      source(script, local = env, print.eval = TRUE, keep.source = FALSE),
+      warning = function(w) {
+        message("Warning message:\n", conditionMessage(w))
+        invokeRestart("muffleWarning")
+      })
+    0
+  }, boba_quit = function(e) {
+    as.integer(e$status)
+  }, error = function(e) {
+    call <- conditionCall(e)
+    head <- if (is.null(call)) "Error: " else
+      paste0("Error in ", deparse(call)[1], " : ")
+    cat(head, conditionMessage(e), "\nExecution halted\n", sep = "",
+        file = stderr())
+    1
+  })
+
+  # undo what the universe changed outside of its environment
+  while (sink.number() > 0) sink()
+  graphics.off()
+  options(opts)
+  setwd(home)
+  done(status)
+}
+'''
+
+
+def get_r_packages(code):
+    """ Find the packages that an R script loads with library or require. """
+    pattern = r'\b(?:library|require)\(\s*["\']?([A-Za-z][\w.]*)["\']?\s*\)'
+    return list(dict.fromkeys(re.findall(pattern, code)))
+
+
+async def _pump(stream, marker, reader):
+    """
+    Move the data from the stream to the reader, until the marker.
+
+    :return: the rest of the line after the marker, or None if the stream
+        ends before the marker.
+    """
+    buf = b''
+    while True:
+        i = buf.find(marker)
+        if i >= 0:
+            reader.feed_data(buf[:i])
+            reader.feed_eof()
+            rest = buf[i + len(marker):]
+            while b'\n' not in rest:
+                chunk = await stream.read(1 << 16)
+                if not chunk:
+                    break
+                rest += chunk
+            return rest.split(b'\n', 1)[0]
+
+        # keep what might be the start of the marker
+        keep = len(buf) - len(marker) + 1
+        if keep > 0:
+            reader.feed_data(buf[:keep])
+            buf = buf[keep:]
+
+        chunk = await stream.read(1 << 16)
+        if not chunk:
+            reader.feed_data(buf)
+            reader.feed_eof()
+            return None
+        buf += chunk
+
+
+class RUniverse:
+    """
+    A universe that an R worker runs. It has the part of the Process
+    interface of asyncio.create_subprocess_exec that we use.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.stdout = asyncio.StreamReader()
+        self.stderr = asyncio.StreamReader()
+        self.returncode = None
+        p = worker.process
+        self._out = asyncio.ensure_future(
+            _pump(p.stdout, worker.marker, self.stdout))
+        self._err = asyncio.ensure_future(
+            _pump(p.stderr, worker.marker, self.stderr))
+
+    async def wait(self):
+        if self.returncode is None:
+            status, _ = await asyncio.gather(self._out, self._err)
+            if status is None:
+                # the worker died, so use its exit code
+                self.returncode = await self.worker.process.wait()
+            else:
+                self.returncode = int(status)
+        return self.returncode
+
+    def kill(self):
+        self.worker.kill()
+
+
+class RWorker:
+    """ A persistent R process that runs one universe at a time. """
+
+    def __init__(self, packages=None, rscript=None):
+        """
+        :param packages: a list of R packages to load once.
+        :param rscript: the command to run an R script, as a list.
+        """
+        self.packages = packages or []
+        self.rscript = rscript or ['Rscript']
+        self.process = None
+        self.folder = None
+        self.token = None
+        self.marker = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        """
+        Start the R process and wait until it has loaded the packages.
+
+        :raise RuntimeError: if R fails to start, for example when a package
+            is not installed.
+        """
+        await self.stop()
+        self.folder = tempfile.mkdtemp(prefix='boba-')
+        fn = os.path.join(self.folder, 'worker.R')
+        with open(fn, 'w') as f:
+            f.write(WORKER_R)
+
+        self.token = 'boba-' + uuid.uuid4().hex
+        self.marker = ('\n' + self.token).encode('utf-8')
+        self.process = await asyncio.create_subprocess_exec(
+            *self.rscript, fn, self.token, *self.packages,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+
+        # the worker marks the end of the startup like the end of a universe
+        startup = RUniverse(self)
+        rc = await startup.wait()
+        if rc != 0:
+            err = (await startup.stderr.read()).decode('utf-8')
+            await self.stop()
+            raise RuntimeError('Cannot start the R worker:\n' + err)
+
+    async def stop(self):
+        """ Stop the R process and clean up. """
+        if self.process is not None:
+            if self.process.returncode is None:
+                self.process.stdin.close()
+                try:
+                    await asyncio.wait_for(self.process.wait(), 5)
+                except asyncio.TimeoutError:
+                    self.kill()
+                    await self.process.wait()
+            self.process = None
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+
+    def kill(self):
+        if self.is_alive():
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+    async def run(self, script, cwd):
+        """
+        Run a script in the R process, and restart the process if it died in
+        the previous universe.
+
+        :param script: the path of the R script.
+        :param cwd: the working directory of the script.
+        :return: an RUniverse.
+        """
+        if not self.is_alive():
+            await self.start()
+
+        msg = '{}\n{}\n'.format(os.path.abspath(cwd), os.path.abspath(script))
+        self.process.stdin.write(msg.encode('utf-8'))
+        await self.process.stdin.drain()
+        return RUniverse(self)
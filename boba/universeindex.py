@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+import os
+import math
+import mmap
+import json
+import struct
+from array import array
+
+FILE_UNIVERSES = 'universes.bin'
+
+# the file starts with a header and the metadata in JSON, followed by the code
+# of each universe and the universe whose script each universe runs. Universes
+# are referred to by their position, counting from 1, which is also their id
+# unless the metadata lists the ids. The header says whether the codes are
+# increasing, which they are unless a skipped node delays the binding of a
+# variable past the variables that come after it.
+MAGIC = b'BOBAUNIV'
+HEADER = struct.Struct('<8sIQ?')
+ID = struct.Struct('<I')
+
+
+class UniverseIndex:
+    """
+    A compact, random-access index from universe ids to decisions.
+
+    Each universe is encoded as one mixed-radix integer. From the most to the
+    least significant digit, it holds the code path, the option index plus one
+    of each placeholder variable on the path (0 if the variable is not bound),
+    in the order that the path binds them, and one bit per node in the path,
+    which is set if the node is skipped. All codes have the same width, so we
+    decode an id with a single seek. Since we enumerate the universes in the
+    order of their choices, the codes increase with the universe, and we
+    encode a decision assignment by computing its code and searching for it
+    in the codes.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        try:
+            self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # mmap is not available for this file, so read it into memory
+            self.buf = self.f.read()
+
+        magic, n_meta, self.size, self.sorted = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a universe index'.format(path))
+        start = HEADER.size + n_meta
+        meta = json.loads(self.buf[HEADER.size:start].decode('utf-8'))
+
+        self.paths = meta['paths']
+        self.decisions = meta['decisions']
+        self.radices = meta['radices']
+        self.layout = meta['layout']
+        self.ext = meta['ext']
+        self.width = meta['width']
+        # the ids of a sample, or None if the universes are numbered 1 to size
+        self.ids = meta.get('ids')
+        self._pos = None if self.ids is None else \
+            {u: i for i, u in enumerate(self.ids)}
+        self._digits, self._span = UniverseIndex._get_digits(
+            self.paths, self.radices, self.layout)
+
+        self._codes = start
+        self._scripts = self._codes + self.size * self.width
+
+    @staticmethod
+    def read(folder):
+        """ Read the index in the multiverse folder. """
+        return UniverseIndex(os.path.join(folder, FILE_UNIVERSES))
+
+    @staticmethod
+    def write(folder, paths, decisions, radices, ext, universes, scripts,
+              ids=None, layout=None):
+        """
+        Write the index to the multiverse folder.
+
+        :param paths: the code paths, as lists of block ids.
+        :param decisions: names of the placeholder variables.
+        :param radices: number of options of each placeholder variable.
+        :param ext: file extension of the scripts.
+        :param universes: an iterable of [path, indices, skipped] of each
+            universe, where indices holds the option index of each variable
+            (or -1) and skipped holds the positions of skipped nodes. We write
+            the universes as we iterate.
+        :param scripts: the position, counting from 1, of the universe whose
+            script each universe runs, which differs from its own position
+            only if deduplicated.
+        :param ids: the id of each universe, if the universes are a sample of
+            the multiverse.
+        :param layout: for each code path, the positions in decisions of the
+            variables on the path, in the order that the path binds them. By
+            default, each path has all variables.
+        """
+        if layout is None:
+            layout = [list(range(len(decisions)))] * len(paths)
+        _, span = UniverseIndex._get_digits(paths, radices, layout)
+        width = max(1, ((max(1, len(paths)) * span - 1).bit_length() + 7) // 8)
+
+        meta = {'paths': paths, 'decisions': decisions, 'radices': radices,
+                'layout': layout, 'ext': ext, 'width': width}
+        if ids is not None:
+            meta['ids'] = list(ids)
+        meta = json.dumps(meta).encode('utf-8')
+
+        with open(os.path.join(folder, FILE_UNIVERSES), 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(meta), 0, True))
+            f.write(meta)
+            size = 0
+            last = -1
+            increasing = True
+            for u in universes:
+                code = UniverseIndex._to_code(paths, radices, layout, span, *u)
+                increasing = increasing and code > last
+                last = code
+                f.write(code.to_bytes(width, 'big'))
+                size += 1
+            array('I', scripts).tofile(f)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, len(meta), size, increasing))
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.f.close()
+
+    def get_ids(self):
+        """ Get the ids of all universes, in order. """
+        if self.ids is None:
+            return list(range(1, self.size + 1))
+        return list(self.ids)
+
+    def decode(self, universe_id):
+        """
+        Get the decisions of a universe.
+
+        :return: a tuple (path, indices, skipped).
+        """
+        code = int.from_bytes(self._get_code(self._get_pos(universe_id)),
+                              'big')
+        path, code = divmod(code, self._span)
+        digits = []
+        for r in reversed(self._digits[path]):
+            code, d = divmod(code, r)
+            digits.append(d)
+        digits.reverse()
+
+        n = len(self.layout[path])
+        indices = [-1] * len(self.radices)
+        for i, d in zip(self.layout[path], digits[:n]):
+            indices[i] = d - 1
+        skipped = [i for i, d in enumerate(digits[n:]) if d]
+        return path, indices, skipped
+
+    def encode(self, path, indices, skipped=()):
+        """
+        Find the universe with the given decisions.
+
+        :return: the universe id, or None if no such universe exists.
+        """
+        if len(indices) != len(self.radices):
+            return None
+        try:
+            code = UniverseIndex._to_code(self.paths, self.radices,
+                                          self.layout, self._span, path,
+                                          indices, skipped)
+        except (ValueError, IndexError):
+            return None
+        target = code.to_bytes(self.width, 'big')
+
+        if not self.sorted:
+            for i in range(self.size):
+                if self._get_code(i) == target:
+                    return self._get_id(i)
+            return None
+
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_code(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.size and self._get_code(lo) == target:
+            return self._get_id(lo)
+        return None
+
+    def get_script(self, universe_id):
+        """ Get the id of the universe whose script this universe runs. """
+        pos = self._scripts + self._get_pos(universe_id) * ID.size
+        return self._get_id(ID.unpack_from(self.buf, pos)[0] - 1)
+
+    def _get_code(self, i):
+        pos = self._codes + i * self.width
+        return self.buf[pos:pos + self.width]
+
+    def _get_id(self, i):
+        """ Get the id of the universe at a position. """
+        return i + 1 if self.ids is None else self.ids[i]
+
+    def _get_pos(self, universe_id):
+        """ Get the position of a universe, counting from 0. """
+        if self._pos is not None:
+            if universe_id in self._pos:
+                return self._pos[universe_id]
+        elif 0 < universe_id <= self.size:
+            return universe_id - 1
+        raise IndexError('There is no universe {}'.format(universe_id))
+
+    @staticmethod
+    def _get_digits(paths, radices, layout):
+        """ The radices of the digits in the code of each path, after the
+        digit of the path, and the span of the codes of a path. """
+        digits = [[radices[i] + 1 for i in lay] + [2] * len(p)
+                  for p, lay in zip(paths, layout)]
+        span = max([math.prod(d) for d in digits] + [1])
+        return digits, span
+
+    @staticmethod
+    def _to_code(paths, radices, layout, span, path, indices, skipped):
+        if not 0 <= path < len(paths):
+            raise ValueError('Path {} is out of range'.format(path))
+        lay = layout[path]
+        if any(k != -1 for i, k in enumerate(indices) if i not in lay):
+            raise ValueError('A variable is not on the path')
+        digits = [radices[i] + 1 for i in lay] + [2] * len(paths[path])
+        values = [indices[i] + 1 for i in lay] + [0] * len(paths[path])
+        for s in skipped:
+            values[len(lay) + s] = 1
+
+        code = 0
+        for r, d in zip(digits, values):
+            if not 0 <= d < r:
+                raise ValueError('Digit {} is out of range'.format(d))
+            code = code * r + d
+        return path * span + code
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import shutil
 import csv
 import json
+import hashlib
+import queue
+import threading
 from dataclasses import dataclass
 from .baseparser import ParseError
+from .manifest import FILE_MANIFEST
+from .pack import FILE_PACK, PackWriter
 
 
 @dataclass
@@ -15,7 +21,9 @@ class Output:
 
 DIR_SCRIPT = 'code/'
 DIR_LOG = 'boba_logs/'
+DIR_RESULTS = 'results/'
 LOG_EXT = '.txt'
+FILE_HASHES = 'hashes.json'
 
 def get_universe_name(universe_id):
     """ Get the name of a universe """
@@ -42,6 +50,56 @@ def get_universe_error_log(universe_id):
     return 'error_' + str(universe_id) + LOG_EXT
 
 
+class BackgroundWriter:
+    """Write files on background threads, so that code generation and file
+    I/O overlap. Files wait in a bounded queue until a thread is free."""
+    def __init__(self, threads=1, size=256):
+        self.queue = queue.Queue(size)
+        self.lock = threading.Lock()
+        self.error = None
+
+        self.files = 0
+        self.bytes = 0
+
+        self.threads = [threading.Thread(target=self._work, daemon=True)
+                        for _ in range(threads)]
+        for t in self.threads:
+            t.start()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            fn, content = item
+            try:
+                with open(fn, 'w') as f:
+                    f.write(content)
+                    size = f.tell()
+                with self.lock:
+                    self.files += 1
+                    self.bytes += size
+            except Exception as e:
+                # keep working, so a full queue does not block the writer
+                self.error = self.error or e
+
+    def write(self, fn, content):
+        """Queue a file, blocking if the queue is full."""
+        if self.error:
+            raise self.error
+        self.queue.put((fn, content))
+
+    def close(self):
+        """Wait for all queued files to be written."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        if self.error:
+            raise self.error
+
+
 class Wrangler:
     """Handles outputs."""
     def __init__(self, spec, lang, out):
@@ -53,6 +111,33 @@ class Wrangler:
         self.outputs = {}
         self.col = 0  # output column number, will be set by parser
         self.counter = 0
+        self.summary = None  # the summary file, while we stream its rows
+
+        # writing policy, will be set by parser
+        self.writers = 0  # number of background writer threads
+        self.fsync = False  # whether to fsync all files at the end
+        self.writer = None
+        self.written = []  # files waiting for fsync
+        self.files_written = 0
+        self.bytes_written = 0
+
+        # incremental compile
+        self.incremental = False
+        self.old_hashes = {}  # content hash of each script from the last compile
+        self.hashes = {}
+        self.changed = []  # id of the universes whose script has changed
+
+        # virtual multiverse, where we do not write any script
+        self.virtual = False
+
+        # packed output, where all scripts go into a single file
+        self.pack = False
+        self.compress = False
+        self.packer = None
+
+        # deduplication
+        self.dedup = False
+        self.canonical = {}  # hash of the code -> the first script with it
 
         self.pre_exe = ''
         self.post_exe = ''
@@ -81,7 +166,7 @@ class Wrangler:
         self.pre_exe = self._read_optional(self.spec, 'before_execute', '')
         self.post_exe = self._read_optional(self.spec, 'after_execute', '')
 
-    def _codegen_r(self):
+    def _codegen_r(self, row):
         """Generate output code for R scripts."""
         if len(self.outputs) == 0:
             return ''
@@ -95,7 +180,6 @@ class Wrangler:
         # record outputs
         ns = self.get_outputs()
         col = self.col + 1
-        row = self.counter
         for n in ns:
             code += '\ndf[{}, {}] = {}'.format(row, col, self.outputs[n].value)
             col += 1
@@ -106,20 +190,24 @@ class Wrangler:
 
         return code
 
-    def _codegen_python(self):
+    def _codegen_python(self, row):
         if len(self.outputs) == 0:
             return ''
 
         # TODO
 
-    def _gen_code(self):
+    def _gen_code(self, row):
         """Generate output code to be appended to the end of the script."""
         if self.lang.is_r():
-            return self._codegen_r()
+            return self._codegen_r(row)
         if self.lang.is_python():
-            return self._codegen_python()      
+            return self._codegen_python(row)
         return ''
 
+    def get_output_template(self):
+        """Get the output code, with the reserved keyword _n as the row."""
+        return self._gen_code('{{_n}}') or ''
+
     def write_pre_exe(self):
         fn_pre_exec = os.path.join(self.out, 'pre_exe.sh')
         with open(fn_pre_exec, 'w') as f:
@@ -136,31 +224,127 @@ class Wrangler:
             json.dump(self.lang.supported_langs, f)
 
 
-    def write_universe(self, code):
-        """Write the generated code to a universe file."""
+    def write_universe(self, code, universe_id=None):
+        """Write the generated code to a universe file. Universes are
+        numbered by the counter, unless the id is given."""
 
         self.counter += 1
-        fn = get_universe_script(self.counter, self.lang.get_ext())
+        uid = self.counter if universe_id is None else universe_id
+        fn = get_universe_script(uid, self.lang.get_ext())
+        # the row of the universe in summary.csv, which is not its id in a
+        # sample of the multiverse
+        row = self.counter
+
+        # if the same code has appeared before, reuse the existing script.
+        # Universes that use the reserved keyword _n differ by their number
+        if self.dedup:
+            code = code.replace('{{_n}}', str(uid))
+            key = hashlib.sha1(code.encode('utf-8')).hexdigest()
+            if key in self.canonical:
+                if self.packer:
+                    uid = get_universe_id_from_script(self.canonical[key])
+                    self.packer.link(uid)
+                return self.canonical[key]
+            self.canonical[key] = fn
+
+        # in a virtual multiverse, scripts are rendered when we run them
+        if self.virtual:
+            return fn
 
         # replace the reserved keyword _n
-        code = code.replace('{{_n}}', str(self.counter))
+        code = code.replace('{{_n}}', str(uid))
 
         # append output code
-        code += self._gen_code()
+        code += self._gen_code(row)
+
+        # skip the file if it is the same as in the last compile
+        digest = hashlib.sha1(code.encode('utf-8')).hexdigest()
+        self.hashes[fn] = digest
+        path = os.path.join(self.out, DIR_SCRIPT, fn)
+        if self.incremental and self.old_hashes.get(fn) == digest \
+                and os.path.exists(path):
+            return fn
 
         # write file
-        with open(os.path.join(self.out, DIR_SCRIPT, fn), 'w') as f:
-            f.write(code)
-            f.flush()
+        self.changed.append(uid)
+        if self.packer:
+            self.bytes_written += self.packer.write(code)
+            self.files_written += 1
+        else:
+            self._write_file(path, code)
 
         return fn
 
+    def _write_file(self, path, content):
+        """Write a file now, or hand it to the background writer."""
+        if self.fsync:
+            self.written.append(path)
+
+        if self.writer:
+            self.writer.write(path, content)
+        else:
+            with open(path, 'w') as f:
+                f.write(content)
+                self.bytes_written += f.tell()
+            self.files_written += 1
+
+    def open_writer(self):
+        """Start the background writer, if the policy asks for one."""
+        if self.pack:
+            path = os.path.join(self.out, FILE_PACK)
+            self.packer = PackWriter(path, self.compress)
+        elif self.writers > 0:
+            self.writer = BackgroundWriter(self.writers)
+
+    def close_writer(self):
+        """Wait for pending writes, then fsync the files if requested."""
+        if self.writer:
+            self.writer.close()
+            self.files_written += self.writer.files
+            self.bytes_written += self.writer.bytes
+            self.writer = None
+
+        if self.packer:
+            self.packer.close(self.fsync)
+            self.packer = None
+
+        for path in self.written:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.written = []
+
     def write_summary(self, rows):
         """Write the summary CSV file"""
-        with open(self.fn, 'w', newline='') as f:
-            wrt = csv.writer(f)
-            for row in rows:
-                wrt.writerow(row)
+        self.open_summary(rows[0])
+        try:
+            for row in rows[1:]:
+                self.write_summary_row(row)
+        finally:
+            self.close_summary()
+
+    def __getstate__(self):
+        # the open summary file stays with the parent process
+        state = self.__dict__.copy()
+        state['summary'] = None
+        state.pop('_summary_writer', None)
+        return state
+
+    def open_summary(self, header):
+        """Start streaming rows to the summary CSV file"""
+        self.summary = open(self.fn, 'w', newline='')
+        self._summary_writer = csv.writer(self.summary)
+        self._summary_writer.writerow(header)
+
+    def write_summary_row(self, row):
+        self._summary_writer.writerow(row)
+
+    def close_summary(self):
+        if self.summary:
+            self.summary.close()
+            self.summary = None
 
     def write_overview_json(self, res):
         """ Write the overview.json file"""
@@ -189,11 +373,118 @@ class Wrangler:
             f.write(obj)
 
     def create_dir(self):
-        """Create output directories."""
-        if os.path.exists(self.out):
+        """Create output directories. In incremental mode, keep the existing
+        directory and read the script hashes from the last compile."""
+        self.hashes = {}
+        self.changed = []
+        self.old_hashes = {}
+        self.canonical = {}
+
+        if self.incremental:
+            try:
+                with open(os.path.join(self.out, FILE_HASHES)) as f:
+                    self.old_hashes = json.load(f)
+            except (IOError, ValueError):
+                pass
+            # scripts are written now, so we no longer need the manifest
+            for fn in [FILE_MANIFEST, FILE_PACK]:
+                if os.path.exists(os.path.join(self.out, fn)):
+                    os.remove(os.path.join(self.out, fn))
+        elif os.path.exists(self.out):
             shutil.rmtree(self.out)
-        os.makedirs(self.out)
-        os.makedirs(os.path.join(self.out, DIR_SCRIPT))
+        os.makedirs(os.path.join(self.out, DIR_SCRIPT), exist_ok=True)
+
+    def export_state(self):
+        """Get what a compile worker has written, to be merged by the parent."""
+        return {'files_written': self.files_written,
+                'bytes_written': self.bytes_written,
+                'hashes': self.hashes, 'changed': self.changed,
+                'canonical': self.canonical}
+
+    def merge_state(self, state):
+        """
+        Merge the state exported by a compile worker. Workers must be merged
+        in the order of the universes.
+
+        :return: a dict mapping the scripts of the worker that duplicate a
+            script from an earlier worker to the earlier script.
+        """
+        self.files_written += state['files_written']
+        self.bytes_written += state['bytes_written']
+        self.hashes.update(state['hashes'])
+
+        # the worker did not know about scripts in other workers
+        dup = {}
+        removed = set()
+        for key, fn in state['canonical'].items():
+            if key in self.canonical:
+                dup[fn] = self.canonical[key]
+                path = os.path.join(self.out, DIR_SCRIPT, fn)
+                if os.path.exists(path):
+                    os.remove(path)
+                self.hashes.pop(fn, None)
+                removed.add(get_universe_id_from_script(fn))
+            else:
+                self.canonical[key] = fn
+        self.changed += [u for u in state['changed'] if u not in removed]
+        return dup
+
+    def write_hashes(self):
+        """Save the script hashes, and clean up after an incremental compile.
+        Scripts that no longer exist are removed, and the logs and results of
+        universes whose script has changed are invalidated. If the universes
+        write outputs to summary.csv, which we have written anew, all of them
+        are invalidated."""
+        with open(os.path.join(self.out, FILE_HASHES), 'w') as f:
+            json.dump(self.hashes, f)
+
+        if not self.incremental:
+            return
+
+        # remove stale scripts
+        stale = set(self.changed)
+        code_dir = os.path.join(self.out, DIR_SCRIPT)
+        for fn in os.listdir(code_dir):
+            if fn in self.old_hashes and fn not in self.hashes:
+                os.remove(os.path.join(code_dir, fn))
+                stale.add(get_universe_id_from_script(fn))
+
+        # invalidate logs, so the universes will run again
+        log_dir = os.path.join(self.out, DIR_LOG)
+        if self.get_output_template():
+            shutil.rmtree(log_dir, ignore_errors=True)
+            self._clear_results()
+            return
+        self._clear_results(stale)
+        if not os.path.exists(log_dir) or not stale:
+            return
+        for uid in stale:
+            for fn in [get_universe_log(uid), get_universe_error_log(uid)]:
+                if os.path.exists(os.path.join(log_dir, fn)):
+                    os.remove(os.path.join(log_dir, fn))
+
+        fn_log = os.path.join(log_dir, 'logs.csv')
+        if os.path.exists(fn_log):
+            with open(fn_log, newline='') as f:
+                rows = list(csv.reader(f))
+            with open(fn_log, 'w', newline='') as f:
+                wrt = csv.writer(f)
+                wrt.writerows(rows[:1] + [r for r in rows[1:]
+                                          if int(r[0]) not in stale])
+
+    def _clear_results(self, stale=None):
+        """Remove the files of the given universes, or of all universes, from
+        the results folder. Like boba merge, we find the universe id at the
+        end of the file name, such as estimate_12.csv."""
+        res_dir = os.path.join(self.out, DIR_RESULTS)
+        if not os.path.isdir(res_dir):
+            return
+        for fn in os.listdir(res_dir):
+            m = re.search(r'(?<!\d)(\d+)$', os.path.splitext(fn)[0])
+            path = os.path.join(res_dir, fn)
+            if m and (stale is None or int(m.group(1)) in stale) and \
+                    os.path.isfile(path):
+                os.remove(path)
 
     def get_outputs(self):
         """Get a sorted list of output names."""
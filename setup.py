@@ -9,7 +9,8 @@ with open("README.rst", "r") as fh:
 with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = ['Click>=6.0', 'dataclasses>=0.6', 'pandas>=1.0.1']
+requirements = ['Click>=6.0', 'numpy>=1.17',
+                'pandas>=1.0.1']
 
 setup_requirements = []
 
@@ -24,8 +25,10 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     description="Author and execute multiverse analysis",
     entry_points={
@@ -40,6 +43,7 @@ setup(
     keywords='multiverse analysis',
     name='boba',
     packages=find_packages(include=['boba', 'boba.*']),
+    python_requires='>=3.8',
     setup_requires=setup_requirements,
     test_suite='tests',
     tests_require=test_requirements,
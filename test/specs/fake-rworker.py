@@ -0,0 +1,26 @@
+""" A stand-in for the R worker, in python, that speaks the same protocol """
+
+import runpy
+import sys
+
+if __name__ == '__main__':
+    token = sys.argv[2]
+
+    def done(status):
+        sys.stdout.write('\n{} {}\n'.format(token, status))
+        sys.stdout.flush()
+        sys.stderr.write('\n{}\n'.format(token))
+        sys.stderr.flush()
+
+    done(1 if 'no_such_package' in sys.argv[3:] else 0)
+    while True:
+        cwd = sys.stdin.readline()
+        script = sys.stdin.readline().strip()
+        if not script:
+            break
+        status = 0
+        try:
+            runpy.run_path(script)
+        except SystemExit as e:
+            status = e.code
+        done(status)
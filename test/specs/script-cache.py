@@ -0,0 +1,19 @@
+""" Test the checkpoint cache """
+import random
+
+
+def count(x):
+    with open('calls.txt', 'a') as f:
+        f.write(x)
+    print(x)
+
+
+if __name__ == '__main__':
+    # --- (A)
+    count('a')
+    random.seed(0)
+    n = random.randint(0, 1000)
+
+    # --- (B)
+    count({{b = "'b'", "'c'"}})
+    print(n, random.randint(0, 1000))
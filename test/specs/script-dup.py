@@ -0,0 +1,11 @@
+""" Test identical universes """
+
+if __name__ == '__main__':
+    # --- (A) a1
+    a = 1
+
+    # --- (A) a2
+    a = 1
+
+    # --- (B)
+    print(a + {{b = 1, 2}})
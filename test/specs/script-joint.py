@@ -0,0 +1,20 @@
+""" Test continuous decisions that are sampled jointly """
+
+# --- (BOBA_CONFIG)
+{
+  "decisions": [
+    {"var": "a", "options": [
+      {"sample": "uniform", "min": 0.0, "max": 1.0}]},
+    {"var": "b", "options": [
+      {"sample": "normal", "mean": 0.0, "std_dev": 1.0}]},
+    {"var": "c", "options": [0, 1]}
+  ],
+  "joint": [
+    {"method": "lhs", "count": 5, "seed": 0}
+  ]
+}
+# --- (END)
+
+if __name__ == '__main__':
+    # --- (A)
+    print({{a}} + {{b}} * {{c}})
@@ -0,0 +1,21 @@
+""" Test decisions with ranges of options """
+
+# --- (BOBA_CONFIG)
+{
+  "decisions": [
+    {"var": "a", "options": [{"range": [0, 1, 0.01]}, 2.5]},
+    {"var": "b", "options": [{"logspace": [-2, 0, 3]}]}
+  ],
+  "constraints": [
+    {"variable": "a", "option": 0.5, "condition": "b.index == 0"},
+    {"variable": "a", "index": 100, "condition": "b.index == 2"}
+  ]
+}
+# --- (END)
+
+if __name__ == '__main__':
+    # --- (A)
+    b = {{b}}
+
+    # --- (B)
+    print({{a}} * b)
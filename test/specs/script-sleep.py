@@ -0,0 +1,8 @@
+""" Test stopping a running multiverse """
+
+import time
+
+if __name__ == '__main__':
+    # --- (A)
+    time.sleep({{t = 0, 60}})
+    print('done')
@@ -0,0 +1,15 @@
+""" Test universes that share a prefix """
+import sys
+
+if __name__ == '__main__':
+    # --- (A)
+    print('start')
+    a = {{a = 1, 2}}
+
+    # --- (B)
+    b = {{b = 10, 20}}
+    print(a * b)
+    if a * b == 40:
+        sys.exit(3)
+    if a * b == 20:
+        raise ValueError('fail')
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+# Ugly hack to allow import from the root folder
+import sys
+import os
+sys.path.insert(0, os.path.abspath('..'))
+
+import unittest
+from unittest.mock import patch
+import io
+import random
+import shutil
+import tempfile
+import threading
+import time
+from boba.parser import Parser
+from boba.bobarun import BobaRun, run_universe
+import boba.bobarun
+
+
+def abs_path(rel_path):
+    return os.path.join(os.path.dirname(__file__), rel_path)
+
+
+class TestBobaRun(unittest.TestCase):
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_dedup(self, stdout):
+        """ Identical universes run once and share the exit code """
+        base = abs_path('./specs/')
+        Parser(base + 'script-dup.py', base).main(verbose=False, dedup=True)
+
+        br = BobaRun(base + 'multiverse')
+        br.run_multiverse()
+        self.assertListEqual(sorted(br.exit_code), [[1, 0], [2, 0], [3, 0], [4, 0]])
+
+        logs = base + 'multiverse/boba_logs/'
+        self.assertListEqual(sorted(os.listdir(logs)),
+                             ['log_1.txt', 'log_2.txt', 'logs.csv'])
+        with open(logs + 'log_2.txt') as f:
+            self.assertEqual(f.read(), '3\n')
+
+        # run a duplicate universe alone
+        br.run_multiverse([3])
+        self.assertListEqual(br.exit_code, [[3, 0]])
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_virtual(self, stdout):
+        """ Scripts are rendered from the manifest and removed after running """
+        base = abs_path('./specs/')
+        Parser(base + 'script-dup.py', base).main(verbose=False, virtual=True)
+
+        br = BobaRun(base + 'multiverse')
+        br.run_multiverse()
+        self.assertListEqual(sorted(br.exit_code), [[1, 0], [2, 0], [3, 0], [4, 0]])
+        self.assertListEqual(os.listdir(base + 'multiverse/code'), [])
+        with open(base + 'multiverse/boba_logs/log_4.txt') as f:
+            self.assertIn(f.read(), ['2\n', '3\n'])
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_pack(self, stdout):
+        """ Scripts are read from the pack and removed after running """
+        base = abs_path('./specs/')
+        Parser(base + 'script-dup.py', base).main(verbose=False, pack=True,
+                                                  compress=True)
+
+        br = BobaRun(base + 'multiverse')
+        br.run_multiverse()
+        self.assertListEqual(sorted(br.exit_code), [[1, 0], [2, 0], [3, 0], [4, 0]])
+        self.assertListEqual(os.listdir(base + 'multiverse/code'), [])
+        with open(base + 'multiverse/boba_logs/log_4.txt') as f:
+            self.assertIn(f.read(), ['2\n', '3\n'])
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_sample(self, stdout):
+        """ A sample runs and logs the universes under their own ids """
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script-dup.py', base)
+        ps.main(verbose=False, sample=2, seed=0)
+
+        br = BobaRun(base + 'multiverse')
+        self.assertListEqual(br.ids, ps.ids)
+        br.run_from_cli()
+        self.assertListEqual(sorted(br.exit_code), [[u, 0] for u in ps.ids])
+
+        br.run_from_cli(False, ps.ids[1])
+        self.assertListEqual(br.exit_code, [[ps.ids[1], 0]])
+
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_error(self, stdout):
+        """ A universe that we cannot start is logged as failed """
+        base = abs_path('./specs/')
+        Parser(base + 'script-dup.py', base).main(verbose=False)
+        run_script = boba.bobarun._run_script
+
+        async def fail(folder, script, *args):
+            if script == 'universe_2.py':
+                raise OSError('no such interpreter')
+            return await run_script(folder, script, *args)
+
+        br = BobaRun(base + 'multiverse')
+        with patch('boba.bobarun._run_script', fail):
+            br.run_multiverse()
+        self.assertListEqual(sorted(br.exit_code),
+                             [[1, 0], [2, -1], [3, 0], [4, 0]])
+        with open(base + 'multiverse/boba_logs/logs.csv') as f:
+            self.assertIn('2,-1\n', f.readlines())
+
+        # run a universe outside of an event loop
+        self.assertEqual(run_universe(base + 'multiverse', 'universe_2.py',
+                                      br.lang.supported_langs), (2, 0))
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_stop(self, stdout):
+        """ Stopping kills the running universes and skips the rest """
+        base = abs_path('./specs/')
+        Parser(base + 'script-sleep.py', base).main(verbose=False)
+
+        br = BobaRun(base + 'multiverse', jobs=2)
+        th = threading.Thread(target=br.run_multiverse)
+        th.start()
+        start = time.time()
+        while br.exit_code == [] and time.time() - start < 30:
+            time.sleep(0.1)
+        self.assertTrue(br.is_running())
+        br.stop()
+        th.join(30)
+
+        self.assertFalse(th.is_alive())
+        self.assertFalse(br.is_running())
+        self.assertLess(time.time() - start, 30)
+        self.assertListEqual(br.exit_code, [[1, 0]])
+
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_fork(self, stdout):
+        """ Universes fork from the server and behave like a new process """
+        base = abs_path('./specs/')
+        Parser(base + 'script-dup.py', base).main(verbose=False)
+
+        br = BobaRun(base + 'multiverse', jobs=2, preload=['json'])
+        br.run_multiverse()
+        self.assertListEqual(sorted(br.exit_code), [[1, 0], [2, 0], [3, 0], [4, 0]])
+        with open(base + 'multiverse/boba_logs/log_4.txt') as f:
+            self.assertEqual(f.read(), '3\n')
+
+        # the script fails, and the error is logged
+        with open(base + 'multiverse/code/universe_1.py', 'a') as f:
+            f.write('\nraise ValueError("fail")\n')
+        br.run_multiverse([1])
+        self.assertListEqual(br.exit_code, [[1, 1]])
+        with open(base + 'multiverse/boba_logs/error_1.txt') as f:
+            self.assertIn('ValueError: fail', f.read())
+
+        # the server fails to start, so we run without it
+        br = BobaRun(base + 'multiverse', preload=['no_such_module'])
+        br.run_multiverse([2])
+        self.assertListEqual(br.exit_code, [[2, 0]])
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_fork_random(self, stdout):
+        """ Forked universes do not share the random state of the server """
+        with tempfile.TemporaryDirectory() as base:
+            fn = os.path.join(base, 'template.py')
+            with open(fn, 'w') as f:
+                f.write('import random\nimport numpy as np\n'
+                        'a = {{a = 1, 2, 3, 4}}\n'
+                        'print(random.getrandbits(30), '
+                        'np.random.randint(1 << 30))\n')
+            Parser(fn, base).main(verbose=False)
+
+            # the server draws a number, so numpy has seeded its generator
+            warm = os.path.join(base, 'warm.py')
+            with open(warm, 'w') as f:
+                f.write('import numpy\nnumpy.random.random()\n')
+
+            br = BobaRun(os.path.join(base, 'multiverse'), preload=[warm])
+            br.run_multiverse()
+            self.assertListEqual(sorted(br.exit_code),
+                                 [[1, 0], [2, 0], [3, 0], [4, 0]])
+            values = []
+            for u in range(1, 5):
+                log = os.path.join(base, 'multiverse/boba_logs/log_{}.txt')
+                with open(log.format(u)) as f:
+                    values.append(f.read().split())
+            for k in range(2):
+                self.assertEqual(len(set([v[k] for v in values])), 4)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_tree_exit(self, stdout):
+        """ A universe that exits with its token does not stall the tree,
+        and each universe sees its own file name """
+        with tempfile.TemporaryDirectory() as base:
+            fn = os.path.join(base, 'template.py')
+            with open(fn, 'w') as f:
+                f.write('import os\nimport sys\n'
+                        'print(os.path.basename(__file__), '
+                        'os.path.basename(sys.argv[0]))\n'
+                        'a = {{a = 1, 2, 3}}\n'
+                        'if a == 2:\n    os._exit(0)\n')
+            Parser(fn, base).main(verbose=False)
+
+            br = BobaRun(os.path.join(base, 'multiverse'), tree=True)
+            br.run_multiverse()
+            self.assertListEqual(sorted(br.exit_code),
+                                 [[1, 0], [2, -1], [3, 0]])
+            log = os.path.join(base, 'multiverse/boba_logs/log_3.txt')
+            with open(log) as f:
+                self.assertEqual(f.read(), 'universe_3.py universe_3.py\n')
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_tree(self, stdout):
+        """ Universes run the shared prefix once, but log it all """
+        base = abs_path('./specs/')
+        Parser(base + 'script-tree.py', base).main(verbose=False)
+
+        br = BobaRun(base + 'multiverse', jobs=2, tree=True)
+        br.run_multiverse()
+        self.assertListEqual(sorted(br.exit_code),
+                             [[1, 0], [2, 1], [3, 1], [4, 3]])
+        logs = base + 'multiverse/boba_logs/'
+        with open(logs + 'log_4.txt') as f:
+            self.assertEqual(f.read(), 'start\n40\n')
+        with open(logs + 'error_2.txt') as f:
+            self.assertIn('ValueError: fail', f.read())
+        self.assertFalse(os.path.exists(logs + 'error_1.txt'))
+
+        # stop the tree while a universe sleeps
+        Parser(base + 'script-sleep.py', base).main(verbose=False)
+        br = BobaRun(base + 'multiverse', jobs=2, tree=True)
+        th = threading.Thread(target=br.run_multiverse)
+        th.start()
+        start = time.time()
+        while br.exit_code == [] and time.time() - start < 30:
+            time.sleep(0.1)
+        br.stop()
+        th.join(30)
+        self.assertFalse(th.is_alive())
+        self.assertListEqual(br.exit_code, [[1, 0]])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_run_cache(self, stdout):
+        """ A later run loads the checkpoint instead of the shared code """
+        base = abs_path('./specs/')
+        Parser(base + 'script-cache.py', base).main(verbose=False)
+        cache = tempfile.mkdtemp()
+        calls = base + 'multiverse/code/calls.txt'
+        logs = base + 'multiverse/boba_logs/'
+
+        try:
+            br = BobaRun(base + 'multiverse', cache=cache)
+            br.run_multiverse()
+            self.assertListEqual(sorted(br.exit_code), [[1, 0], [2, 0]])
+            with open(calls) as f:
+                self.assertEqual(sorted(f.read()), ['a', 'b', 'c'])
+            with open(logs + 'log_2.txt') as f:
+                expected = f.read()
+            # the random state is the same as in one process
+            random.seed(0)
+            self.assertEqual(expected, 'a\nc\n{} {}\n'.format(
+                random.randint(0, 1000), random.randint(0, 1000)))
+            self.assertEqual(len(os.listdir(cache)), 1)
+
+            br.run_multiverse()
+            with open(calls) as f:
+                self.assertEqual(sorted(f.read()), ['a', 'b', 'b', 'c', 'c'])
+            with open(logs + 'log_2.txt') as f:
+                self.assertEqual(f.read(), expected)
+        finally:
+            shutil.rmtree(cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
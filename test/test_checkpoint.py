@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Ugly hack to allow import from the root folder
+import sys
+import os
+sys.path.insert(0, os.path.abspath('..'))
+
+import unittest
+import json
+import random
+import shutil
+import tempfile
+import types
+from unittest.mock import patch
+from boba.checkpoint import CheckpointCache
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_save(self):
+        # the script runs as __main__, and so does what we restore
+        main = types.ModuleType('__main__')
+        patcher = patch.dict(sys.modules, {'__main__': main})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        cache = CheckpointCache(self.folder)
+        env = main.__dict__
+        exec('import json\nclass A:\n    pass\ndef f():\n    return 1\n'
+             'x = [1, 2]\ny = x\ng = f', env)
+        with open(__file__) as fh:
+            env['fh'] = fh
+        random.seed(0)
+        self.assertTrue(cache.save('k', env, b'out', b''))
+        expected = random.random()
+        self.assertIsNone(cache.get('other'))
+
+        entry = cache.get('k')
+        self.assertEqual(entry['stdout'], b'out')
+        self.assertListEqual(sorted(entry['redo']), ['A', 'f'])
+
+        # the functions and classes are defined again before we load
+        with self.assertRaises(ValueError):
+            CheckpointCache.restore(entry, {})
+
+        env.clear()
+        exec('class A:\n    pass\ndef f():\n    return 2\n', env)
+        res = env
+        CheckpointCache.restore(entry, res)
+        self.assertIs(res['json'], json)
+        self.assertIs(res['x'], res['y'])
+        self.assertEqual(res['g'](), 2)
+        self.assertTrue(res['fh'].closed)
+        self.assertEqual(random.random(), expected)
+
+        # a checkpoint with state that can't be pickled is not saved
+        env['gen'] = (i for i in range(3))
+        self.assertFalse(cache.save('k2', env, b'', b''))
+        self.assertIsNone(cache.get('k2'))
+
+    def test_inputs(self):
+        data = os.path.join(self.folder, 'data.txt')
+        with open(data, 'w') as f:
+            f.write('1')
+
+        cache = CheckpointCache(os.path.join(self.folder, 'cache'))
+        cache.inputs[data] = None
+        cache.save('k', {}, b'', b'')
+        self.assertIsNotNone(cache.get('k'))
+
+        # the same content is still fresh, but not a different one
+        with open(data, 'w') as f:
+            f.write('1')
+        self.assertIsNotNone(cache.get('k'))
+        with open(data, 'w') as f:
+            f.write('2')
+        self.assertIsNone(cache.get('k'))
+
+    def test_evict(self):
+        cache = CheckpointCache(self.folder)
+        cache.save('a', {'x': 'a' * 1000}, b'', b'')
+        size = os.path.getsize(os.path.join(self.folder, os.listdir(
+            self.folder)[0]))
+        cache.max_size = 2 * size + 10
+
+        cache.save('b', {'x': 'b' * 1000}, b'', b'')
+        for fn in os.listdir(self.folder):
+            os.utime(os.path.join(self.folder, fn), ns=(0, 0))
+        cache.get('a')
+        cache.save('c', {'x': 'c' * 1000}, b'', b'')
+
+        # b is the least recently used
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@ import os
 sys.path.insert(0, os.path.abspath('..'))
 
 import unittest
+import pickle
 from boba.constraintparser import ConstraintParser, ParseError
 from boba.conditionparser import ConditionParser, TokenType
 from boba.parser import Parser
@@ -31,7 +32,20 @@ class TestConstraintParser(unittest.TestCase):
         ps = Parser(base + 'script3-7.py')
         cp = ConstraintParser(ps.spec)
         cs = cp.read_constraints(ps.code_parser, ps.dec_parser)
-        self.assertEqual(len(cs), 10)
+        self.assertEqual(len(cs), 0)
+        self.assertListEqual(cp.links, [['a', 'b']])
+
+    def test_compiled(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-1.py')
+        cp = ConstraintParser(ps.spec)
+        cs = cp.read_constraints(ps.code_parser, ps.dec_parser)
+        for c in cs.values():
+            self.assertIsNotNone(c.code)
+            # the compiled condition survives pickling
+            c2 = pickle.loads(pickle.dumps(c))
+            self.assertEqual(c2, c)
+            self.assertIsNotNone(c2.code)
 
     def test_condition_parser(self):
         cond = ''
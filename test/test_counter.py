@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Ugly hack to allow import from the root folder
+import sys
+import os
+sys.path.insert(0, os.path.abspath('..'))
+
+import unittest
+import subprocess
+import tempfile
+from boba.parser import Parser
+from boba.counter import Counter
+
+
+def abs_path(rel_path):
+    return os.path.join(os.path.dirname(__file__), rel_path)
+
+
+class TestCounter(unittest.TestCase):
+
+    @staticmethod
+    def _enumerate(ps):
+        paths = ps._get_code_paths()
+        return [h for i, p in enumerate(paths)
+                for _, h in ps._enumerate(i, p, None, False)]
+
+    def test_count(self):
+        base = abs_path('./specs/')
+        for sc in ['script2-block-param.py', 'script3-1.py', 'script3-3.py',
+                   'script3-5.py', 'script3-6.py', 'script3-7.py',
+                   'script4-2.py']:
+            ps = Parser(base + sc, base)
+            self.assertEqual(Counter(ps).count(), len(self._enumerate(ps)), sc)
+
+    def test_count_skip(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.spec['constraints'] = [
+            {"block": "B", "skippable": True, "condition": "a == if"},
+            {"block": "D", "condition": "b.index == 0 or a == if"}]
+        ps._parse_constraints()
+        self.assertEqual(Counter(ps).count(), len(self._enumerate(ps)))
+
+    def test_breakdown(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        hs = self._enumerate(ps)
+        res = Counter(ps).breakdown()
+        self.assertListEqual(list(res.keys()), ['a', 'b', 'B'])
+
+        for d in ['a', 'b']:
+            expected = [sum([1 for h in hs for r in h.decisions
+                             if r.parameter == d and r.option == o])
+                        for o, _ in res[d]]
+            self.assertListEqual([n for _, n in res[d]], expected)
+        self.assertListEqual(res['B'], [('b1', 4), ('b2', 4)])
+
+    def test_count_large(self):
+        """ Count a space that is too large to enumerate """
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        n = len(self._enumerate(ps))
+        ps.dec_parser.discrete_decisions['a'].value *= 100
+        ps.dec_parser.discrete_decisions['b'].value *= 100
+        self.assertEqual(Counter(ps).count(), n * 100 * 100)
+
+    def test_count_shards(self):
+        """ The counts match the shards of a parallel compile """
+        base = abs_path('./specs/')
+        for sc in ['script2-block-param.py', 'script3-5.py', 'script3-6.py',
+                   'script3-7.py', 'script4-2.py']:
+            ps = Parser(base + sc, base)
+            ct = Counter(ps)
+            paths = ps._get_code_paths()
+            for idx, k in ps._get_shards(paths):
+                n = sum(1 for _ in ps._enumerate(idx, paths[idx], k, False))
+                c = ct.count_shards(idx)
+                res = sum(c) if k is None else (c[k] if k < len(c) else 0)
+                self.assertEqual(res, n, sc)
+
+    def test_unrank(self):
+        base = abs_path('./specs/')
+        for sc in ['script2-block-param.py', 'script3-5.py', 'script3-6.py',
+                   'script4-2.py']:
+            ps = Parser(base + sc, base)
+            ct = Counter(ps)
+            for u, h in enumerate(self._enumerate(ps), 1):
+                decs = [(d.parameter, d.idx) for d in h.decisions]
+                self.assertEqual(ct.unrank(u), (h.path, decs, h.skipped))
+            with self.assertRaises(IndexError):
+                ct.unrank(u + 1)
+            with self.assertRaises(IndexError):
+                ct.unrank(0)
+
+    def test_sample(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.dec_parser.discrete_decisions['a'].value *= 100
+        ps.dec_parser.discrete_decisions['b'].value *= 100
+        ct = Counter(ps)
+        n = ct.count()
+
+        ids = ct.sample(50, seed=0)
+        self.assertEqual(len(set(ids)), 50)
+        self.assertListEqual(ids, sorted(ids))
+        self.assertTrue(all([0 < u <= n for u in ids]))
+        self.assertListEqual(ct.sample(50, seed=0), ids)
+        self.assertEqual(ct.unrank(n)[0], len(ps.paths) - 1)
+
+    # the same sample is the same universes in another process
+    def test_sample_hash_seed(self):
+        code = ('import sys; sys.path.insert(0, {!r}); '
+                'from boba.parser import Parser; '
+                'ps = Parser(sys.argv[1], sys.argv[2]); '
+                'ps.main(verbose=False, sample=4, seed=1); '
+                'print(ps.ids); '
+                'print(open(ps.out + "summary.csv").read())')\
+            .format(abs_path('..'))
+        script = abs_path('./specs/script2-block-param.py')
+        with tempfile.TemporaryDirectory() as base:
+            res = []
+            for seed in ['1', '2', '3']:
+                env = dict(os.environ, PYTHONHASHSEED=seed)
+                res.append(subprocess.run(
+                    [sys.executable, '-c', code, script, base], env=env,
+                    stdout=subprocess.PIPE, check=True).stdout)
+            self.assertEqual(res[0], res[1])
+            self.assertEqual(res[0], res[2])
+
+    def test_limit(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        with self.assertRaises(SystemExit):
+            ps.main(verbose=False, limit=7)
+        ps.main(verbose=False, limit=8)
+        self.assertEqual(ps.wrangler.counter, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Ugly hack to allow import from the root folder
+import sys
+import os
+sys.path.insert(0, os.path.abspath('..'))
+
+import unittest
+from itertools import combinations
+from boba.parser import Parser
+from boba.counter import Counter
+from boba.covering import CoveringArray
+
+
+def abs_path(rel_path):
+    return os.path.join(os.path.dirname(__file__), rel_path)
+
+
+class TestCoveringArray(unittest.TestCase):
+
+    @staticmethod
+    def _get_taken(ps):
+        """ The options that each universe takes, by enumerating them. """
+        paths = ps._get_code_paths()
+        blocks = ps.code_parser.get_decisions()
+        res = []
+        for i, p in enumerate(paths):
+            for _, h in ps._enumerate(i, p, None, False):
+                taken = [(d.parameter, d.idx) for d in h.decisions]
+                for b, opts in blocks.items():
+                    taken += [(b, k) for k, o in enumerate(opts)
+                              if o in ps.paths[i] and o not in h.skipped]
+                res.append(set(taken))
+        return res
+
+    def _check_cover(self, ps, strength):
+        taken = self._get_taken(ps)
+        ids = CoveringArray(Counter(ps), strength).generate()
+        self.assertListEqual(ids, sorted(set(ids)))
+
+        expected = set([frozenset(c) for t in taken
+                        for c in combinations(t, strength)])
+        actual = set([frozenset(c) for u in ids
+                      for c in combinations(taken[u - 1], strength)])
+        self.assertSetEqual(actual, expected)
+        return ids
+
+    def test_cover(self):
+        base = abs_path('./specs/')
+        for sc in ['script2-block-param.py', 'script3-1.py', 'script3-5.py',
+                   'script3-6.py', 'script4-2.py']:
+            ps = Parser(base + sc, base)
+            for strength in [1, 2]:
+                self._check_cover(ps, strength)
+
+    def test_cover_constraint(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.spec['constraints'] = [
+            {"block": "B", "skippable": True, "condition": "a == if"},
+            {"variable": "b", "index": 1, "condition": "a.index == 0"}]
+        ps._parse_constraints()
+        self._check_cover(ps, 2)
+
+        # a universe with b=1 must have a=0
+        ct = Counter(ps)
+        self.assertEqual(ct.count({'a': 1, 'b': 1}), 0)
+        self.assertGreater(ct.count({'a': 0, 'b': 1}), 0)
+
+    def test_cover_size(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.dec_parser.discrete_decisions['a'].value *= 3
+        ps.dec_parser.discrete_decisions['b'].value *= 3
+        ct = Counter(ps)
+
+        # every pair of a and b is needed, and then it is enough
+        ids = self._check_cover(ps, 2)
+        self.assertEqual(len(ids), len(ct.options['a']) * len(ct.options['b']))
+        self.assertLess(len(ids), ct.count())
+        self.assertEqual(len(self._check_cover(ps, 3)), ct.count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,9 @@ sys.path.insert(0, os.path.abspath('..'))
 
 import unittest
 import json
-from boba.decisionparser import DecisionParser, ParseError, DiscretizationError
+import numpy as np
+from boba.decisionparser import DecisionParser, OptionRange, ParseError, \
+    DiscretizationError
 
 
 def abs_path(rel_path):
@@ -185,55 +187,202 @@ class TestDecisionParser(unittest.TestCase):
         dp.read_decisions(spec)
 
         expected_values = {
-            "A" : [4.222109257625241,3.789772014701512,2.102857904154225,
-                   1.2945837514648169,2.5563736068430427,2.0246706872520717,
-                   3.918992945173863,1.5165636303946373,2.3829847707617793,2.916910197275156],
-
-            "B" : [0.3987817096281944, 1.1764726069313014, 32.9219123935226,0.6176463558281531,
-                   1173.2570343189907, 0.0004698113365446915, 3.8755331825795074,
-                   0.0024111006812721804, 0.7666639469566167, 0.23430739939420894],
-            
-            "C" : [-0.9193411054662913, 0.162520645387909, 3.4941384662699027,
-                   -0.48183922507637644, 7.067538950240607, -7.663179355454415,
-                    1.3546832488443061, -6.027671921520947, -0.26570671318718925, -1.4511213531125535],
-            
-            "D" : [4.222109257625241,3.789772014701512, 2.102857904154225, 1.2945837514648169, 2.5563736068430427,
-                   2.0246706872520717, 3.918992945173863, 1.5165636303946373, 2.3829847707617793,2.916910197275156, 17.0],
-            
-            "E" : [0.3987817096281944, 1.1764726069313014, 32.9219123935226, 0.6176463558281531, 1173.2570343189907, 
-                   0.0004698113365446915,3.8755331825795074, 0.0024111006812721804, 0.7666639469566167,
-                   0.23430739939420894, 0.0, 1.0, 2.0],
-
-            "F" : [-0.9193411054662913, 0.162520645387909, 3.4941384662699027,-0.48183922507637644,
-                    7.067538950240607, -7.663179355454415, 1.3546832488443061, -6.027671921520947, -0.26570671318718925,
-                    -1.4511213531125535, 0.0, 1.0, 2.0, 3.0, 4.0],
-                    
-            "G" : [4.222109257625241, 3.789772014701512, 2.102857904154225, 0.3987817096281944,
-                   1.1764726069313014, 32.9219123935226, -0.9193411054662913, 0.162520645387909, 3.4941384662699027],
-
-            "H" : [4.222109257625241, 3.789772014701512, 2.102857904154225, 1.2945837514648169,
-                   10.671821220562006, 14.237168684686164, 13.81887309488307, 11.275345128697108],
-
-            "I" : [4.222109257625241, 3.789772014701512, 2.102857904154225, -1.1, 10.671821220562006, 14.237168684686164,
-                   13.81887309488307, 0.0, 1.0, 2.0, 3.1415],
-
-            "J" : [0.162520645387909, 1.3546832488443061, 0.42367414585227364, 1.0140813138657543,
-                   1.3541129259415663, 0.3987817096281944, 1.1764726069313014, 0.6176463558281531, 
-                   0.0004698113365446915, 0.0024111006812721804],
-
-            "K" : [0.8320454426412622, 1.0330381586298683, 2.011393354799426, 0.9081299035634155,
-                   4.110348384693913, 0.8320454426412622, 1.0330381586298683, 2.011393354799426, 
-                   0.9081299035634155, 4.110348384693913],
-
-            "L" : [-0.18386822109325826, 0.0325041290775818, 0.6988276932539805, -0.09636784501527529, 1.4135077900481214, 
-                   -0.18386822109325826, 0.0325041290775818, 0.6988276932539805, -0.09636784501527529, 1.4135077900481214]
+            "A" : [3.1848084366072715, 1.3489335688193516, 0.20486761968097345,
+                   0.08263817764264547, 4.066351196001362, 4.563777886388609,
+                   3.0331788788358995, 3.647482804919992, 2.7181249573271145,
+                   4.675362118938841],
+
+            "B" : [1.875079588022697, 0.5165804118622594, 24.584428438645435,
+                   1.689614819944315, 0.06867659198703545, 6.098087970268865,
+                   678.5785384611381, 113.90956175881742, 0.029638645468703297,
+                   0.001787196022446197],
+
+            "C" : [0.6286511054669665, -0.6605243164565094, 3.20211325221641,
+                   0.5245005857651985, -2.6783468658055547, 1.8079752745474238,
+                   6.520000225650686, 4.735404815646211, -3.518676179034963,
+                   -6.327107355230263],
+
+            "D" : [3.1848084366072715, 1.3489335688193516, 0.20486761968097345,
+                   0.08263817764264547, 4.066351196001362, 4.563777886388609,
+                   3.0331788788358995, 3.647482804919992, 2.7181249573271145,
+                   4.675362118938841, 17.0],
+
+            "E" : [1.875079588022697, 0.5165804118622594, 24.584428438645435,
+                   1.689614819944315, 0.06867659198703545, 6.098087970268865,
+                   678.5785384611381, 113.90956175881742, 0.029638645468703297,
+                   0.001787196022446197, 0.0, 1.0, 2.0],
+
+            "F" : [0.6286511054669665, -0.6605243164565094, 3.20211325221641,
+                   0.5245005857651985, -2.6783468658055547, 1.8079752745474238,
+                   6.520000225650686, 4.735404815646211, -3.518676179034963,
+                   -6.327107355230263, 0.0, 1.0, 2.0, 3.0, 4.0],
+
+            "G" : [3.1848084366072715, 1.3489335688193516, 0.20486761968097345,
+                   1.875079588022697, 0.5165804118622594, 24.584428438645435,
+                   0.6286511054669665, -0.6605243164565094, 3.20211325221641],
+
+            "H" : [3.1848084366072715, 1.3489335688193516, 0.20486761968097345,
+                   0.08263817764264547, 12.559108123501284, 14.752318481629676,
+                   10.720798063598169, 14.74324723568622],
+
+            "I" : [3.1848084366072715, 1.3489335688193516, 0.20486761968097345, -1.1,
+                   12.559108123501284, 14.752318481629676, 10.720798063598169, 0.0, 1.0, 2.0,
+                   3.1415],
+
+            "J" : [0.8756112068211713, 1.7897339510047618, 2.389194576538041,
+                   2.455159249470051, 0.44868306200727287, 0.1775630758012936,
+                   0.006179882740512708, 4.8468321467504754e-05, 8.012951441889472e-06,
+                   0.6507423417843503],
+
+            "K" : [1.133976204153072, 0.8762491038964166, 1.8972825972005432,
+                   1.1105996749581577, 0.5852773900190299, 1.133976204153072,
+                   0.8762491038964166, 1.8972825972005432, 1.1105996749581577,
+                   0.5852773900190299],
+
+            "L" : [0.1257302210933933, -0.1321048632913019, 0.6404226504432821,
+                   0.10490011715303971, -0.535669373161111, 0.1257302210933933,
+                   -0.1321048632913019, 0.6404226504432821, 0.10490011715303971,
+                   -0.535669373161111]
         }
 
         for var, expected in expected_values.items():
-            self.assertEqual(dp.discrete_decisions[var].value, expected, msg="failed on test " + var)
-
-
+            actual = dp.discrete_decisions[var].value
+            self.assertEqual(len(actual), len(expected), msg="failed on test " + var)
+            for x, y in zip(actual, expected):
+                self.assertAlmostEqual(x, y, msg="failed on test " + var)
+
+    def test_continuous_order(self):
+        """ Each sample has its own generator, so the order does not matter """
+        with open(abs_path('./specs/continuous.json'), 'rb') as f:
+            spec = json.load(f)
+        dp = DecisionParser()
+        dp.read_decisions(spec)
 
+        spec['decisions'].reverse()
+        reverse = DecisionParser()
+        reverse.read_decisions(spec)
+        for var, dec in dp.discrete_decisions.items():
+            self.assertEqual(reverse.discrete_decisions[var].value, dec.value)
+
+    def test_continuous_range(self):
+        """ A narrow range far in the tail is sampled without rejection """
+        options = [{"sample": "normal", "count": 1000, "seed": 0,
+                    "range": [8.0, 8.001], "exclusive": True},
+                   {"sample": "normal", "count": 1000, "seed": 0,
+                    "range": [-30.0, -29.0]},
+                   {"sample": "lognormal", "count": 1000, "seed": 0,
+                    "range": [50.0, 50.5]},
+                   {"sample": "uniform", "count": 1000, "seed": 0,
+                    "min": 1.0, "max": 1.0000001, "exclusive": True}]
+        dp = DecisionParser()
+        dp.read_decisions({"decisions": [{"var": "a", "options": options}]})
+        values = dp.discrete_decisions['a'].value
+        self.assertEqual(len(values), 4000)
+        self.assertTrue(all([8.0 < x < 8.001 for x in values[:1000]]))
+        self.assertTrue(all([-30.0 <= x <= -29.0 for x in values[1000:2000]]))
+        self.assertTrue(all([50.0 <= x <= 50.5 for x in values[2000:3000]]))
+        self.assertTrue(all([1.0 < x < 1.0000001 for x in values[3000:]]))
+
+        # the normal distribution is denser near the mean
+        lower = [x for x in values[1000:2000] if x > -29.5]
+        self.assertGreater(len(lower), 900)
+
+    def test_continuous_joint(self):
+        spec = {
+            'decisions': [
+                {'var': 'a', 'options': [{'sample': 'uniform', 'min': 0.0, 'max': 5.0}]},
+                {'var': 'b', 'options': [{'sample': 'normal', 'mean': 0.0, 'std_dev': 1.0,
+                                          'range': [-1.0, 1.0]}]},
+                {'var': 'c', 'options': [{'sample': 'lognormal', 'count': 3, 'seed': 0}]},
+                {'var': 'd', 'options': [1, 2]}
+            ],
+            'joint': [{'method': 'lhs', 'count': 8, 'seed': 0, 'decisions': ['a', 'b']}]
+        }
+        dp = DecisionParser()
+        dp.read_decisions(spec)
+        self.assertListEqual(dp.joint_links, [['a', 'b']])
+        a = dp.discrete_decisions['a'].value
+        b = dp.discrete_decisions['b'].value
+        self.assertEqual(len(a), 8)
+        self.assertEqual(len(b), 8)
+        self.assertEqual(len(dp.discrete_decisions['c'].value), 3)
+        # each of the 8 intervals has exactly one sample
+        self.assertListEqual(sorted([int(x / 5.0 * 8) for x in a]), list(range(8)))
+        self.assertTrue(all([-1.0 <= x <= 1.0 for x in b]))
+
+        # the same seed gives the same samples
+        again = DecisionParser()
+        again.read_decisions(spec)
+        self.assertListEqual(again.discrete_decisions['a'].value, a)
+
+        # by default, sample all continuous decisions
+        spec['joint'] = [{'method': 'halton', 'count': 4, 'seed': 0}]
+        dp = DecisionParser()
+        dp.read_decisions(spec)
+        self.assertListEqual(dp.joint_links, [['a', 'b', 'c']])
+        self.assertEqual(len(dp.discrete_decisions['c'].value), 4)
+        self.assertListEqual(dp.discrete_decisions['d'].value, [1, 2])
+
+        # invalid groups
+        bad = [{'method': 'sobol', 'count': 4},
+               {'method': 'lhs', 'count': 0},
+               {'method': 'lhs', 'count': 4, 'decisions': ['d']},
+               {'method': 'lhs', 'count': 4, 'decisions': ['a', 'a']},
+               {'method': 'lhs', 'count': 4, 'decisions': []}]
+        for j in bad:
+            spec['joint'] = [j]
+            self.assertRaises(ParseError, DecisionParser().read_decisions, spec)
+
+    def test_joint_points(self):
+        rng = np.random.default_rng(0)
+        for fn in [DecisionParser.latin_hypercube, DecisionParser.halton]:
+            u = fn(rng, 16, 3)
+            self.assertTupleEqual(u.shape, (16, 3))
+            self.assertTrue(((u >= 0) & (u < 1)).all())
+
+        # a shifted Halton sequence in base 2 still has one point in each
+        # of the first 2^k intervals
+        u = DecisionParser.halton(rng, 16, 1)
+        self.assertListEqual(sorted((u[:, 0] * 16).astype(int).tolist()), list(range(16)))
+
+
+    def test_option_range(self):
+        r = OptionRange('range', [0, 1, 0.1])
+        self.assertEqual(len(r), 10)
+        self.assertEqual(r[3], 0.3)
+        self.assertEqual(r[-1], 0.9)
+        self.assertListEqual(list(OptionRange('range', [10, 0, -3])), [10, 7, 4, 1])
+        self.assertListEqual(list(OptionRange('range', [1, 2.2, 0.2])),
+                             [1.0, 1.2, 1.4, 1.6, 1.8, 2.0])
+        self.assertListEqual(list(OptionRange('linspace', [0, 1, 5])),
+                             [0.0, 0.25, 0.5, 0.75, 1.0])
+        self.assertListEqual(list(OptionRange('logspace', [0, 2, 3])), [1.0, 10.0, 100.0])
+        self.assertEqual(len(OptionRange('range', [1, 0, 1])), 0)
+        self.assertRaises(IndexError, r.__getitem__, 10)
+
+        # invalid ranges
+        for kind, args in [('range', [0, 1, 0]), ('range', [0, 1]),
+                           ('range', [0, 'a', 1]), ('linspace', [0, 1, 0.5]),
+                           ('logspace', [0, 1, 0])]:
+            self.assertRaises(ParseError, OptionRange, kind, args)
+
+    def test_lazy_options(self):
+        spec = {'decisions': [{'var': 'a', 'options': [
+            -1, {'range': [0, 1000000, 1]}, 'x', {'linspace': [0, 1, 3]}]}]}
+        dp = DecisionParser()
+        dp.read_decisions(spec)
+        self.assertEqual(dp.get_num_alt_discrete('a'), 1000005)
+        self.assertEqual(dp.get_alt_discrete('a', 0), -1)
+        self.assertEqual(dp.get_alt_discrete('a', 1), 0)
+        self.assertEqual(dp.get_alt_discrete('a', 1000000), 999999)
+        self.assertEqual(dp.get_alt_discrete('a', 1000001), 'x')
+        self.assertEqual(dp.get_alt_discrete('a', 1000004), 1.0)
+
+        # ranges in the value of a single option are expanded
+        spec = {'decisions': [{'var': 'a', 'options': [[{'range': [0, 3, 1]}]]}]}
+        dp = DecisionParser()
+        dp.read_decisions(spec)
+        self.assertListEqual(dp.get_alt_discrete('a', 0), [0, 1, 2])
 
 
 if __name__ == '__main__':
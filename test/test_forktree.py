@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# Ugly hack to allow import from the root folder
+import sys
+import os
+sys.path.insert(0, os.path.abspath('..'))
+
+import unittest
+from boba.forktree import get_statements, build_tree
+
+
+class TestForkTree(unittest.TestCase):
+
+    def test_get_statements(self):
+        code = ('import os\n'
+                'if __name__ == "__main__":\n'
+                '    a = 1\n'
+                '    print(a)\n')
+        res = [key[2] for key, _ in get_statements(code)]
+        self.assertListEqual(res, ['import os', 'a = 1', 'print(a)'])
+
+        # other if statements are not flattened
+        code = 'if __name__ == "__main__":\n    a = 1\nelse:\n    a = 2\n'
+        self.assertEqual(len(get_statements(code)), 1)
+
+        with self.assertRaises(SyntaxError):
+            get_statements('a = (')
+
+    def test_build_tree(self):
+        scripts = [(1, 'u1.py', 'a = 1\nb = 1\n'),
+                   (2, 'u2.py', 'a = 1\nb = 2\n'),
+                   (3, 'u3.py', 'a = 2\nb = 1\n'),
+                   (4, 'u4.py', 'a = (')]
+        root, errors = build_tree(scripts)
+        self.assertListEqual([u for u, _ in errors], [4])
+        self.assertEqual(len(root.children), 2)
+        self.assertListEqual(sorted(root.get_universes()), [1, 2, 3])
+
+        # the shared statement is one node with a branch per universe
+        node = root.children[(1, 0, 'a = 1')]
+        self.assertEqual(node.script, 'u1.py')
+        self.assertEqual(len(node.children), 2)
+        self.assertListEqual(node.get_universes(), [1, 2])
+
+        # identical universes end at the same node
+        root, _ = build_tree([(1, 'u1.py', 'a = 1'), (2, 'u2.py', 'a = 1')])
+        self.assertListEqual(root.children[(1, 0, 'a = 1')].ends, [1, 2])
+
+        # statements that read the file name are not shared
+        code = 'a = 1\nprint(__file__)\n'
+        root, _ = build_tree([(1, 'u1.py', code), (2, 'u2.py', code)])
+        node = root.children[(1, 0, 'a = 1')]
+        self.assertListEqual(list(node.children.keys()),
+                             [(2, 0, 'print(__file__)', 'u1.py'),
+                              (2, 0, 'print(__file__)', 'u2.py')])
+
+
+if __name__ == '__main__':
+    unittest.main()
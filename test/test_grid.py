@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Ugly hack to allow import from the root folder
+import sys
+import os
+sys.path.insert(0, os.path.abspath('..'))
+
+import unittest
+from unittest.mock import patch
+from boba.parser import Parser
+from boba.grid import DecisionGrid
+
+
+def abs_path(rel_path):
+    return os.path.join(os.path.dirname(__file__), rel_path)
+
+
+class TestDecisionGrid(unittest.TestCase):
+
+    @staticmethod
+    def _enumerate(ps, shards=False):
+        """ Enumerate all universes, either at once or shard by shard. The
+        grid only handles a whole code path, so shards never use it. """
+        paths = ps._get_code_paths()
+        if shards:
+            return [u for i, first in ps._get_shards(paths)
+                    for u in ps._enumerate(i, paths[i], first)]
+        return [u for i, p in enumerate(paths) for u in ps._enumerate(i, p)]
+
+    def _check(self, ps):
+        expected = self._enumerate(ps, True)
+        self.assertListEqual(self._enumerate(ps), expected)
+        return expected
+
+    def test_grid(self):
+        base = abs_path('./specs/')
+        for sc in ['script2-block-param.py', 'script3-1.py', 'script3-3.py',
+                   'script3-5.py', 'script3-6.py', 'script3-7.py',
+                   'script4-2.py', 'script4-3.py']:
+            ps = Parser(base + sc, base)
+            self._check(ps)
+
+        # no node can be skipped in this spec
+        ps = Parser(base + 'script4-2.py', base)
+        paths = ps._get_code_paths()
+        for i, p in enumerate(paths):
+            self.assertIsNotNone(DecisionGrid.create(ps, i, p))
+
+    def test_constraint(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.spec['constraints'] = [
+            {"variable": "b", "index": 0, "condition": "a.index == 1"},
+            {"variable": "a", "index": 1, "condition": "b.index == 1"},
+            {"block": "D", "condition": "b == 2.5 or a == if"}]
+        ps._parse_constraints()
+        self.assertGreater(len(self._check(ps)), 0)
+
+    def test_skip(self):
+        """ A path where a node can be skipped needs the enumeration """
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.spec['constraints'] = [
+            {"block": "B", "skippable": True, "condition": "a == if"}]
+        ps._parse_constraints()
+        paths = ps._get_code_paths()
+        for i, p in enumerate(paths):
+            self.assertIsNone(DecisionGrid.create(ps, i, p))
+        self._check(ps)
+
+    def test_chunks(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.spec['constraints'] = [
+            {"variable": "b", "index": 1, "condition": "a.index > 7"}]
+        ps._parse_constraints()
+        ps.dec_parser.discrete_decisions['a'].value *= 10
+        ps.dec_parser.discrete_decisions['b'].value *= 10
+        with patch('boba.grid.CHUNK_SIZE', 7):
+            self._check(ps)
+
+    def test_large_table(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.spec['constraints'] = [
+            {"variable": "b", "index": 0, "condition": "a.index == 1"}]
+        ps._parse_constraints()
+        paths = ps._get_code_paths()
+        with patch('boba.grid.MAX_TABLE', 1):
+            self.assertIsNone(DecisionGrid.create(ps, 0, paths[0]))
+            self._check(ps)
+
+    def test_large_grid(self):
+        """ A large cross product falls back to the enumeration """
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script4-2.py', base)
+        paths = ps._get_code_paths()
+        with patch('boba.grid.MAX_GRID', 1):
+            self.assertIsNone(DecisionGrid.create(ps, 0, paths[0]))
+            self._check(ps)
+
+        # the size does not overflow
+        grid = DecisionGrid.create(ps, 0, paths[0])
+        grid.shape = [1 << 40, 1 << 40]
+        self.assertEqual(grid.size(), 1 << 80)
+
+
+if __name__ == '__main__':
+    unittest.main()
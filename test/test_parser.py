@@ -8,7 +8,15 @@ sys.path.insert(0, os.path.abspath('..'))
 import unittest
 from unittest.mock import patch
 import io
+import tempfile
+import shutil
+import subprocess
+import csv
+import re
 from boba.parser import Parser
+from boba.manifest import Manifest
+from boba.pack import PackReader
+from boba.wrangler import BackgroundWriter
 
 FIRST_SCRIPT = 'multiverse/code/universe_1.py'
 
@@ -54,6 +62,344 @@ class TestParser(unittest.TestCase):
         ps.main(verbose=False)
         self.assertEqual(ps.wrangler.counter, 120)
 
+    # a long template should not hit the recursion limit
+    def test_codegen_long_template(self):
+        with tempfile.TemporaryDirectory() as base:
+            fn = os.path.join(base, 'template.py')
+            with open(fn, 'w') as f:
+                f.write('a = {{a = 1, 2}}\n')
+                f.write('a = {{a}}\n' * sys.getrecursionlimit())
+            ps = Parser(fn, base)
+            ps.main(verbose=False)
+            self.assertEqual(ps.wrangler.counter, 2)
+
+            with open(os.path.join(base, 'multiverse/code/universe_2.py')) as f:
+                self.assertEqual(f.read().count('a = 2\n'),
+                                 sys.getrecursionlimit() + 1)
+
+    # generating code in multiple processes should give the same output
+    def test_codegen_parallel(self):
+        base = abs_path('./specs/')
+        for sc in ['script3-5.py', 'script3-7.py', 'script2-block-param.py']:
+            expected = []
+            for jobs in [1, 3]:
+                ps = Parser(base + sc, base)
+                ps.main(verbose=False, jobs=jobs)
+                out = os.path.join(base, 'multiverse/')
+                with open(out + 'summary.csv') as f:
+                    res = [f.read()]
+                for i in range(1, ps.wrangler.counter + 1):
+                    with open(out + 'code/universe_{}.py'.format(i)) as f:
+                        res.append(f.read())
+                expected = expected or res
+                self.assertListEqual(res, expected)
+
+    # an error on a background thread is raised, and does not block
+    def test_background_writer_error(self):
+        folder = tempfile.mkdtemp()
+        try:
+            bw = BackgroundWriter(threads=1, size=2)
+            bw.write(os.path.join(folder, 'a.txt'), 1)
+            with self.assertRaises(TypeError):
+                for i in range(10):
+                    bw.write(os.path.join(folder, '{}.txt'.format(i)), 'x')
+                bw.close()
+        finally:
+            shutil.rmtree(folder)
+
+    # writing files in the background should give the same output
+    def test_codegen_writers(self):
+        base = abs_path('./specs/')
+        expected = None
+        for writers, fsync in [(0, False), (4, True)]:
+            ps = Parser(base + 'script2-block-param.py', base)
+            ps.main(verbose=False, writers=writers, fsync=fsync)
+            self.assertEqual(ps.wrangler.files_written, 9)
+
+            res = []
+            for i in range(1, ps.wrangler.counter + 1):
+                with open(base + 'multiverse/code/universe_{}.py'.format(i)) as f:
+                    res.append(f.read())
+            self.assertEqual(ps.wrangler.bytes_written, len(''.join(res)))
+            expected = expected or res
+            self.assertListEqual(res, expected)
+
+    # the universe ids do not depend on the hash seed of the process
+    def test_codegen_hash_seed(self):
+        code = ('import sys; sys.path.insert(0, {!r}); '
+                'from boba.parser import Parser; '
+                'ps = Parser(sys.argv[1], sys.argv[2]); '
+                'ps.main(verbose=False, incremental=True); '
+                'print(ps.wrangler.files_written)').format(abs_path('..'))
+        with tempfile.TemporaryDirectory() as base:
+            res = []
+            for seed in ['1', '2', '3']:
+                env = dict(os.environ, PYTHONHASHSEED=seed)
+                out = subprocess.run(
+                    [sys.executable, '-c', code,
+                     abs_path('./specs/script2-block-param.py'), base],
+                    env=env, stdout=subprocess.PIPE, check=True).stdout
+                res.append(int(out))
+            self.assertListEqual(res, [9, 0, 0])
+
+    # recompiling incrementally should only touch the changed universes
+    def test_codegen_incremental(self):
+        with tempfile.TemporaryDirectory() as base:
+            fn = os.path.join(base, 'template.py')
+            with open(abs_path('./specs/script3-4.py')) as f:
+                template = f.read()
+            with open(fn, 'w') as f:
+                f.write(template)
+            Parser(fn, base).main(verbose=False)
+
+            # pretend that we have run all universes
+            code = os.path.join(base, 'multiverse/code/')
+            logs = os.path.join(base, 'multiverse/boba_logs/')
+            os.makedirs(logs)
+            with open(logs + 'logs.csv', 'w') as f:
+                f.write('uid,exit_code\n1,0\n2,0\n3,0\n4,0\n')
+            results = os.path.join(base, 'multiverse/results/')
+            os.makedirs(results)
+            for i in range(1, 5):
+                open(logs + 'log_{}.txt'.format(i), 'w').close()
+                open(results + 'estimate_{}.csv'.format(i), 'w').close()
+            open(results + 'notes.txt', 'w').close()
+
+            # change the code in block B:b2, and recompile
+            with open(fn, 'w') as f:
+                f.write(template.replace('b = 2 + {{b}}', 'b = 3 + {{b}}'))
+            ps = Parser(fn, base)
+            ps.main(verbose=False, incremental=True)
+            self.assertEqual(ps.wrangler.counter, 4)
+            self.assertEqual(ps.wrangler.files_written, 2)
+            changed = ps.wrangler.changed
+            kept = [i for i in range(1, 5) if i not in changed]
+            for i in range(1, 5):
+                with open(code + 'universe_{}.py'.format(i)) as f:
+                    self.assertEqual('b = 3 +' in f.read(), i in changed)
+                exists = os.path.exists(logs + 'log_{}.txt'.format(i))
+                self.assertEqual(exists, i in kept)
+                exists = os.path.exists(results + 'estimate_{}.csv'.format(i))
+                self.assertEqual(exists, i in kept)
+            self.assertTrue(os.path.exists(results + 'notes.txt'))
+            with open(logs + 'logs.csv') as f:
+                self.assertEqual(f.read().split(), ['uid,exit_code'] +
+                                 ['{},0'.format(i) for i in kept])
+
+            # remove a universe
+            with open(fn, 'w') as f:
+                f.write(template.replace('["if", "else"]', '["if"]'))
+            ps = Parser(fn, base)
+            ps.main(verbose=False, incremental=True)
+            self.assertEqual(ps.wrangler.counter, 2)
+            self.assertListEqual(sorted(os.listdir(code)),
+                                 ['universe_1.py', 'universe_2.py'])
+
+    # outputs in summary.csv are written anew, so all universes run again
+    def test_codegen_incremental_outputs(self):
+        ex = abs_path('../example/fertility_r/')
+        with tempfile.TemporaryDirectory() as base:
+            Parser(ex + 'template.R', base).main(verbose=False)
+            logs = os.path.join(base, 'multiverse/boba_logs/')
+            results = os.path.join(base, 'multiverse/results/')
+            os.makedirs(logs)
+            os.makedirs(results)
+            with open(logs + 'logs.csv', 'w') as f:
+                f.write('uid,exit_code\n1,0\n')
+            open(results + 'estimate_1.csv', 'w').close()
+
+            ps = Parser(ex + 'template.R', base)
+            ps.main(verbose=False, incremental=True)
+            self.assertEqual(ps.wrangler.files_written, 0)
+            self.assertFalse(os.path.exists(logs))
+            self.assertListEqual(os.listdir(results), [])
+
+    # identical universes should share one script
+    def test_codegen_dedup(self):
+        base = abs_path('./specs/')
+        for jobs in [1, 2]:
+            ps = Parser(base + 'script-dup.py', base)
+            ps.main(verbose=False, jobs=jobs, dedup=True)
+            self.assertEqual(ps.wrangler.counter, 4)
+            self.assertEqual(len(ps.wrangler.canonical), 2)
+            self.assertListEqual(sorted(os.listdir(base + 'multiverse/code')),
+                                 ['universe_1.py', 'universe_2.py'])
+
+            with open(base + 'multiverse/summary.csv') as f:
+                fns = [row['Filename'] for row in csv.DictReader(f)]
+            self.assertListEqual(fns, ['universe_1.py', 'universe_2.py'] * 2)
+
+    # universes that use _n are not identical
+    def test_codegen_dedup_n(self):
+        with tempfile.TemporaryDirectory() as base:
+            fn = os.path.join(base, 'template.py')
+            with open(abs_path('./specs/script-dup.py')) as f:
+                template = f.read()
+            with open(fn, 'w') as f:
+                f.write(template + "\n    print('result_{{_n}}.csv')\n")
+            for jobs in [1, 2]:
+                ps = Parser(fn, base)
+                ps.main(verbose=False, jobs=jobs, dedup=True)
+                self.assertEqual(len(ps.wrangler.canonical), 4)
+                for i in range(1, 5):
+                    script = 'multiverse/code/universe_{}.py'.format(i)
+                    with open(os.path.join(base, script)) as f:
+                        self.assertIn('result_{}.csv'.format(i), f.read())
+
+    # the output code of each universe writes its own summary row
+    def test_codegen_dedup_outputs(self):
+        ex = abs_path('../example/fertility_r/')
+        with tempfile.TemporaryDirectory() as base:
+            ps = Parser(ex + 'template.R', base)
+            with patch('sys.stdout', new_callable=io.StringIO):
+                ps.main(verbose=False, dedup=True)
+            self.assertFalse(ps.wrangler.dedup)
+            code = os.path.join(base, 'multiverse/code')
+            self.assertEqual(len(os.listdir(code)), ps.wrangler.counter)
+
+    def test_codegen_virtual(self):
+        base = abs_path('./specs/')
+        code_dir = base + 'multiverse/code/'
+        ps = Parser(base + 'script3-5.py', base)
+        ps.main(verbose=False)
+        expected = []
+        for fn in os.listdir(code_dir):
+            with open(code_dir + fn) as f:
+                expected.append(f.read())
+
+        ps = Parser(base + 'script3-5.py', base)
+        ps.main(verbose=False, virtual=True)
+        self.assertListEqual(os.listdir(code_dir), [])
+
+        m = Manifest.read(base + 'multiverse')
+        self.assertEqual(len(m.universes), ps.wrangler.counter)
+        actual = [m.render(i + 1) for i in range(len(m.universes))]
+        self.assertListEqual(sorted(actual), sorted(expected))
+
+    def test_codegen_pack(self):
+        base = abs_path('./specs/')
+        code_dir = base + 'multiverse/code/'
+        ps = Parser(base + 'script3-5.py', base)
+        ps.main(verbose=False)
+        expected = []
+        for fn in os.listdir(code_dir):
+            with open(code_dir + fn) as f:
+                expected.append(f.read())
+
+        for compress in [False, True]:
+            ps = Parser(base + 'script3-5.py', base)
+            ps.main(verbose=False, pack=True, compress=compress)
+            self.assertListEqual(os.listdir(code_dir), [])
+
+            pr = PackReader(base + 'multiverse/universes.pack')
+            self.assertEqual(pr.size, ps.wrangler.counter)
+            actual = [pr.render(i + 1) for i in range(pr.size)]
+            pr.close()
+            self.assertListEqual(sorted(actual), sorted(expected))
+
+        # duplicates point to the script of the first identical universe
+        ps = Parser(base + 'script-dup.py', base)
+        ps.main(verbose=False, dedup=True, pack=True)
+        self.assertEqual(ps.wrangler.files_written, 2)
+        pr = PackReader(base + 'multiverse/universes.pack')
+        self.assertEqual(pr.size, 4)
+        self.assertEqual(pr.render(1), pr.render(3))
+        self.assertEqual(pr.render(2), pr.render(4))
+        pr.close()
+
+    def test_codegen_sample(self):
+        base = abs_path('./specs/')
+        code_dir = base + 'multiverse/code/'
+        ps = Parser(base + 'script3-5.py', base)
+        ps.main(verbose=False)
+        expected = {}
+        for fn in os.listdir(code_dir):
+            with open(code_dir + fn) as f:
+                expected[fn] = f.read()
+        with open(base + 'multiverse/summary.csv') as f:
+            rows = list(csv.reader(f))
+
+        ps = Parser(base + 'script3-5.py', base)
+        ps.main(verbose=False, sample=3, seed=1)
+        self.assertEqual(ps.wrangler.counter, 3)
+        self.assertListEqual(ps.ids, sorted(ps.ids))
+
+        # the universes keep their id and their code
+        fns = ['universe_{}.py'.format(u) for u in ps.ids]
+        self.assertListEqual(sorted(os.listdir(code_dir)), sorted(fns))
+        for fn in fns:
+            with open(code_dir + fn) as f:
+                self.assertEqual(f.read(), expected[fn])
+        with open(base + 'multiverse/summary.csv') as f:
+            actual = list(csv.reader(f))
+        self.assertListEqual(actual, [rows[0]] + [rows[u] for u in ps.ids])
+
+        # the same seed gives the same sample
+        ids = ps.ids
+        ps.main(verbose=False, sample=3, seed=1)
+        self.assertListEqual(ps.ids, ids)
+
+        # a sample larger than the multiverse has every universe
+        ps.main(verbose=False, sample=100)
+        self.assertListEqual(ps.ids, list(range(1, len(expected) + 1)))
+
+    # the outputs of a sampled universe go to its row in summary.csv
+    def test_codegen_sample_outputs(self):
+        ex = abs_path('../example/fertility_r/')
+        with tempfile.TemporaryDirectory() as base:
+            ps = Parser(ex + 'template.R', base)
+            ps.main(verbose=False, sample=3, seed=1)
+            code_dir = os.path.join(base, 'multiverse/code/')
+            for i, u in enumerate(ps.ids):
+                with open(code_dir + 'universe_{}.R'.format(u)) as f:
+                    rows = set(re.findall(r'\ndf\[(\d+), ', f.read()))
+                self.assertSetEqual(rows, {str(i + 1)})
+
+            # the same rows when the scripts are rendered from the manifest
+            ps.main(verbose=False, sample=3, seed=1, virtual=True)
+            mf = Manifest.read(os.path.join(base, 'multiverse/'))
+            for i, u in enumerate(ps.ids):
+                rows = set(re.findall(r'\ndf\[(\d+), ', mf.render(u)))
+                self.assertSetEqual(rows, {str(i + 1)})
+
+    def test_codegen_cover(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.main(verbose=False, cover=1)
+        self.assertEqual(ps.wrangler.counter, 2)
+        fns = ['universe_{}.py'.format(u) for u in ps.ids]
+        self.assertListEqual(sorted(os.listdir(base + 'multiverse/code/')),
+                             sorted(fns))
+
+    # the outputs of a covering universe go to its row in summary.csv
+    def test_codegen_cover_outputs(self):
+        ex = abs_path('../example/fertility_r/')
+        with tempfile.TemporaryDirectory() as base:
+            ps = Parser(ex + 'template.R', base)
+            ps.main(verbose=False, cover=2)
+            self.assertLess(len(ps.ids), 120)
+            code_dir = os.path.join(base, 'multiverse/code/')
+            for i, u in enumerate(ps.ids):
+                with open(code_dir + 'universe_{}.R'.format(u)) as f:
+                    rows = set(re.findall(r'\ndf\[(\d+), ', f.read()))
+                self.assertSetEqual(rows, {str(i + 1)})
+
+    def test_codegen_joint(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script-joint.py', base)
+        self.assertDictEqual(ps.linked_vars, {'a': 0, 'b': 0})
+        ps.main(verbose=False)
+        # the joint samples are linked, so 5 samples * 2 options of c
+        self.assertEqual(ps.wrangler.counter, 10)
+
+    def test_codegen_range(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script-range.py', base)
+        self.assertEqual(ps.dec_parser.get_num_alt_discrete('a'), 101)
+        ps.main(verbose=False)
+        # 101 * 3, minus the universes that the constraints remove
+        self.assertEqual(ps.wrangler.counter, 299)
+
     # the spec has one decision and no graphs; should work
     def test_codegen_decision_only(self):
         base = abs_path('./specs/')
@@ -183,6 +529,25 @@ class TestParser(unittest.TestCase):
         ps.main(verbose=False)
         self.assertEqual(ps.wrangler.counter, 6)
 
+    def test_constraint_hoist(self):
+        """ Constraints are evaluated as soon as their inputs are bound """
+        base = abs_path('./specs/')
+        ps = Parser(base+'script3-5.py', base)
+        ps.spec['constraints'] = [
+            {"block": "D", "condition": "a == if"},
+            {"variable": "b", "index": 1, "condition": "a == else"},
+            {"block": "C", "skippable": True, "condition": "a == if"}]
+        ps._parse_constraints()
+
+        path = ps._get_code_paths()[0]
+        checks, prune, hoisted = ps._schedule_constraints(0, path)
+        self.assertSetEqual(hoisted, {'D', '_i_b:1'})
+        a = [i for i, (nd, ch) in enumerate(path) if ch.variable == 'a'][0]
+        self.assertListEqual(sorted(checks[a]), ['D', '_i_b:1'])
+
+        ps.main(verbose=False)
+        self.assertEqual(ps.wrangler.counter, 2)
+
     def test_constraint_7(self):
         """ Linked decisions """
         base = abs_path('./specs/')
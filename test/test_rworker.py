@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Ugly hack to allow import from the root folder
+import sys
+import os
+sys.path.insert(0, os.path.abspath('..'))
+
+import unittest
+import asyncio
+import shutil
+import tempfile
+from boba.rworker import RWorker, get_r_packages
+
+
+def abs_path(rel_path):
+    return os.path.join(os.path.dirname(__file__), rel_path)
+
+
+FAKE = [sys.executable, abs_path('./specs/fake-rworker.py')]
+
+
+class TestRWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, code):
+        fn = os.path.join(self.folder, name)
+        with open(fn, 'w') as f:
+            f.write(code)
+        return fn
+
+    def test_get_r_packages(self):
+        code = 'library(tidyverse)\nrequire("MASS")\nlibrary( brms )\n' \
+               'x <- my_library(a)\nlibrary(MASS)'
+        self.assertListEqual(get_r_packages(code), ['tidyverse', 'MASS', 'brms'])
+
+    def test_run(self):
+        """ The worker runs universes one after another """
+        a = self._write('a.py', 'print("a")\nprint("no newline", end="")')
+        b = self._write('b.py', 'import sys\nsys.stderr.write("oops")\nsys.exit(3)')
+
+        async def run():
+            w = RWorker(rscript=FAKE)
+            await w.start()
+            res = []
+            try:
+                for fn in [a, b, a]:
+                    u = await w.run(fn, self.folder)
+                    out = await u.stdout.read()
+                    err = await u.stderr.read()
+                    res.append((out, err, await u.wait()))
+            finally:
+                await w.stop()
+            return res
+
+        res = asyncio.run(run())
+        self.assertEqual(res[0], (b'a\nno newline', b'', 0))
+        self.assertEqual(res[1], (b'', b'oops', 3))
+        self.assertEqual(res[2], res[0])
+
+    def test_kill(self):
+        """ A killed worker restarts for the next universe """
+        a = self._write('a.py', 'print("a")')
+        b = self._write('b.py', 'import time\ntime.sleep(60)')
+
+        async def run():
+            w = RWorker(rscript=FAKE)
+            await w.start()
+            try:
+                u = await w.run(b, self.folder)
+                u.kill()
+                rc = await u.wait()
+                u = await w.run(a, self.folder)
+                return rc, await u.stdout.read(), await u.wait()
+            finally:
+                await w.stop()
+
+        rc, out, rc2 = asyncio.run(run())
+        self.assertNotEqual(rc, 0)
+        self.assertEqual((out, rc2), (b'a\n', 0))
+
+    def test_start_error(self):
+        w = RWorker(['no_such_package'], rscript=FAKE)
+        self.assertRaises(RuntimeError, asyncio.run, w.start())
+        self.assertIsNone(w.process)
+
+    @unittest.skipUnless(shutil.which('Rscript'), 'requires R')
+    def test_run_r(self):
+        fn = self._write('a.R', 'x <- 1\ncat(x + 1, "\\n")\nquit(status = 2)')
+
+        async def run():
+            w = RWorker(['stats'])
+            await w.start()
+            try:
+                u = await w.run(fn, self.folder)
+                return await u.stdout.read(), await u.wait()
+            finally:
+                await w.stop()
+
+        self.assertEqual(asyncio.run(run()), (b'2 \n', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
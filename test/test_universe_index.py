@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Ugly hack to allow import from the root folder
+import sys
+import os
+sys.path.insert(0, os.path.abspath('..'))
+
+import unittest
+import csv
+import subprocess
+import tempfile
+from boba.parser import Parser
+from boba.universeindex import UniverseIndex
+
+
+def abs_path(rel_path):
+    return os.path.join(os.path.dirname(__file__), rel_path)
+
+
+class TestUniverseIndex(unittest.TestCase):
+
+    def test_decode(self):
+        base = abs_path('./specs/')
+        for sc in ['script3-5.py', 'script4-2.py', 'script3-7.py']:
+            ps = Parser(base + sc, base)
+            ps.main(verbose=False)
+
+            index = UniverseIndex.read(base + 'multiverse')
+            self.assertEqual(index.size, ps.wrangler.counter)
+            expected = [tuple(u) for u in ps._decode_choices()]
+            actual = [index.decode(u) for u in range(1, index.size + 1)]
+            self.assertListEqual(actual, expected)
+            index.close()
+
+    def test_decode_options(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script4-2.py', base)
+        ps.main(verbose=False)
+        options = ps._get_options()
+
+        index = UniverseIndex.read(base + 'multiverse')
+        with open(base + 'multiverse/summary.csv') as f:
+            rows = list(csv.DictReader(f))
+        for u, row in enumerate(rows, 1):
+            path, indices, skipped = index.decode(u)
+            self.assertEqual(index.ext, '.py')
+            self.assertEqual(index.get_script(u), u)
+            for d, k in zip(index.decisions, indices):
+                value = options[d][k] if k >= 0 else ''
+                self.assertEqual(row[d], value)
+        index.close()
+
+    def test_encode(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script3-5.py', base)
+        ps.main(verbose=False)
+
+        index = UniverseIndex.read(base + 'multiverse')
+        for u in range(1, index.size + 1):
+            self.assertEqual(index.encode(*index.decode(u)), u)
+
+        # decisions that do not exist
+        path, indices, skipped = index.decode(1)
+        self.assertIsNone(index.encode(path, indices + [0], skipped))
+        self.assertIsNone(index.encode(len(index.paths), indices, skipped))
+        self.assertIsNone(index.encode(path, [100] * len(indices), skipped))
+        with self.assertRaises(IndexError):
+            index.decode(index.size + 1)
+        index.close()
+
+    # a universe is the same universe in another process
+    def test_hash_seed(self):
+        code = ('import sys; sys.path.insert(0, {!r}); '
+                'from boba.parser import Parser; '
+                'Parser(sys.argv[1], sys.argv[2]).main(verbose=False)')\
+            .format(abs_path('..'))
+        script = abs_path('./specs/script2-block-param.py')
+        with tempfile.TemporaryDirectory() as base:
+            data = []
+            for seed in ['1', '2']:
+                out = os.path.join(base, seed)
+                env = dict(os.environ, PYTHONHASHSEED=seed)
+                subprocess.run([sys.executable, '-c', code, script, out],
+                               env=env, check=True)
+                with open(os.path.join(out, 'multiverse/universes.bin'),
+                          'rb') as f:
+                    data.append(f.read())
+            self.assertEqual(data[0], data[1])
+
+            ps = Parser(script, base)
+            ps.main(verbose=False)
+            expected = [tuple(u) for u in ps._decode_choices()]
+            index = UniverseIndex.read(os.path.join(base, '1/multiverse'))
+            actual = [index.decode(u) for u in range(1, index.size + 1)]
+            self.assertListEqual(actual, expected)
+            index.close()
+
+    def test_unsorted(self):
+        """ Codes that do not increase are still found """
+        with tempfile.TemporaryDirectory() as base:
+            universes = [[0, [1, 0], []], [0, [0, 1], [1]], [1, [-1, 2], []]]
+            UniverseIndex.write(base, [['a', 'b'], ['a']], ['x', 'y'], [2, 3],
+                                '.py', iter(universes), [1, 2, 3],
+                                layout=[[0, 1], [1]])
+            index = UniverseIndex.read(base)
+            self.assertFalse(index.sorted)
+            for u, (path, indices, skipped) in enumerate(universes, 1):
+                self.assertEqual(index.decode(u), (path, indices, skipped))
+                self.assertEqual(index.encode(path, indices, skipped), u)
+
+            # a variable that is not on the path
+            self.assertIsNone(index.encode(1, [0, 2], []))
+            index.close()
+
+    def test_dedup(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script-dup.py', base)
+        ps.main(verbose=False, dedup=True)
+
+        index = UniverseIndex.read(base + 'multiverse')
+        scripts = [index.get_script(u) for u in range(1, index.size + 1)]
+        self.assertListEqual(scripts, [1, 2, 1, 2])
+        index.close()
+
+    def test_sample(self):
+        base = abs_path('./specs/')
+        ps = Parser(base + 'script4-2.py', base)
+        ps.main(verbose=False)
+        index = UniverseIndex.read(base + 'multiverse')
+        expected = {u: index.decode(u) for u in range(1, index.size + 1)}
+        index.close()
+
+        ps.main(verbose=False, sample=4, seed=0)
+        index = UniverseIndex.read(base + 'multiverse')
+        self.assertListEqual(index.get_ids(), ps.ids)
+        for u in ps.ids:
+            self.assertEqual(index.decode(u), expected[u])
+            self.assertEqual(index.encode(*expected[u]), u)
+            self.assertEqual(index.get_script(u), u)
+        others = [u for u in expected if u not in ps.ids]
+        with self.assertRaises(IndexError):
+            index.decode(others[0])
+        self.assertIsNone(index.encode(*expected[others[0]]))
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()